@@ -0,0 +1,325 @@
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import Counter
+from urllib.parse import parse_qs, urlencode, urlparse
+import json
+import random
+import threading
+import time
+import zlib
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+# The open pull requests of one repository, with their comments and statuses,
+# generated from a seed so that every run serves the same ones. Most have a
+# handful of comments, a few have long discussions that take several pages.
+class Fixtures:
+    def __init__(self, pulls=100, seed=0, owner='owner', name='repo'):
+        rand = random.Random(seed)
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+
+        self.owner = owner
+        self.name = name
+        self.pulls = []
+
+        comment_id = 1
+        for num in range(1, pulls + 1):
+            head_sha = '{:040x}'.format(rand.getrandbits(160))
+            author = 'user{}'.format(rand.randrange(50))
+
+            issue_comments = []
+            count = 120 if rand.random() < 0.05 else rand.randrange(9)
+            for _ in range(count):
+                issue_comments.append({
+                    'id': comment_id,
+                    'body': 'Comment {} on #{}'.format(comment_id, num),
+                    'login': 'user{}'.format(rand.randrange(50)),
+                    'created_at': now - timedelta(minutes=comment_id),
+                })
+                comment_id += 1
+
+            review_comments = []
+            for _ in range(rand.randrange(5)):
+                review_comments.append({
+                    'id': comment_id,
+                    'body': 'Nit {} on #{}'.format(comment_id, num),
+                    'login': 'user{}'.format(rand.randrange(50)),
+                    'commit_id': head_sha,
+                    'created_at': now - timedelta(minutes=comment_id),
+                })
+                comment_id += 1
+
+            self.pulls.append({
+                'number': num,
+                'title': 'Pull request {}'.format(num),
+                'body': 'Description of #{}.\n\n'.format(num) + 'x' * 500,
+                'head_sha': head_sha,
+                'head_ref': 'branch-{}'.format(num),
+                'author': author,
+                'base_ref': 'master' if rand.random() < 0.9 else 'beta',
+                'assignee': 'user{}'.format(rand.randrange(10))
+                            if rand.random() < 0.5 else None,
+                'updated_at': now - timedelta(hours=rand.randrange(1, 1000)),
+                'status': rand.choice([None, 'success', 'failure']),
+                'issue_comments': issue_comments,
+                'review_comments': review_comments,
+            })
+
+    def pull(self, num):
+        return next(x for x in self.pulls if x['number'] == num)
+
+
+# Serves the fixtures through the parts of GitHub's REST and GraphQL APIs that
+# synchronization uses, answering every request after `latency` seconds, like
+# a round trip to GitHub would. Requests are counted by kind.
+class FixtureServer:
+    def __init__(self, fixtures, latency=0.05):
+        self.fixtures = fixtures
+        self.latency = latency
+
+        self.lock = threading.Lock()
+        self.requests = Counter()
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_port)
+        self.api_url = self.url + '/api/v3'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset(self):
+        with self.lock:
+            requests = self.requests
+            self.requests = Counter()
+        return requests
+
+    def count(self, kind):
+        with self.lock:
+            self.requests[kind] += 1
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                time.sleep(server.latency)
+                url = urlparse(self.path)
+                status, body, headers = server.get(
+                    url.path, {k: v[0] for k, v in parse_qs(url.query).items()})
+                self.respond(status, body, headers)
+
+            def do_POST(self):
+                time.sleep(server.latency)
+                length = int(self.headers.get('Content-Length', 0))
+                status, body = server.post(self.path,
+                                           json.loads(self.rfile.read(length)))
+                self.respond(status, body, {})
+
+            def respond(self, status, body, headers):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def repo_url(self):
+        return '{}/repos/{}/{}'.format(self.api_url, self.fixtures.owner,
+                                       self.fixtures.name)
+
+    def user(self, login):
+        return {'login': login, 'id': zlib.crc32(login.encode('utf-8')),
+                'type': 'User'}
+
+    def page(self, path, params, items):
+        per_page = int(params.get('per_page', 30))
+        number = int(params.get('page', 1))
+        start = (number - 1) * per_page
+        headers = {}
+        if start + per_page < len(items):
+            query = dict(params, page=number + 1, per_page=per_page)
+            headers['Link'] = '<{}{}?{}>; rel="next"'.format(
+                self.url, path, urlencode(query))
+        return 200, items[start:start + per_page], headers
+
+    def get(self, path, params):
+        fixtures = self.fixtures
+        repo_path = '/api/v3/repos/{}/{}'.format(fixtures.owner, fixtures.name)
+
+        if path == '/api/v3/rate_limit':
+            self.count('rate_limit')
+            limit = {'limit': 5000, 'remaining': 5000, 'reset': 0}
+            return 200, {'resources': {'core': limit}, 'rate': limit}, {}
+
+        if path == repo_path:
+            self.count('repository')
+            return 200, self.rest_repo(), {}
+
+        if not path.startswith(repo_path + '/'):
+            return 404, {'message': 'Not Found'}, {}
+        parts = path[len(repo_path) + 1:].split('/')
+
+        if parts == ['pulls']:
+            self.count('pulls')
+            return self.page(path, params,
+                             [self.rest_pull(x) for x in fixtures.pulls])
+
+        if parts[0] == 'statuses':
+            self.count('statuses')
+            pull = next(x for x in fixtures.pulls if x['head_sha'] == parts[1])
+            statuses = [{'id': pull['number'], 'state': pull['status'],
+                         'context': 'homu', 'description': '',
+                         'target_url': None,
+                         'creator': self.user(fixtures.owner)}] if pull['status'] else []
+            return 200, statuses, {}
+
+        if parts[0] in ['issues', 'pulls'] and parts[2:] == ['comments']:
+            pull = fixtures.pull(int(parts[1]))
+            if parts[0] == 'issues':
+                self.count('issue_comments')
+                comments = [self.rest_comment(x)
+                            for x in pull['issue_comments']]
+            else:
+                self.count('review_comments')
+                comments = [dict(self.rest_comment(x),
+                                 commit_id=x['commit_id'],
+                                 original_commit_id=x['commit_id'])
+                            for x in pull['review_comments']]
+            return self.page(path, params, comments)
+
+        return 404, {'message': 'Not Found'}, {}
+
+    def rest_repo(self):
+        fixtures = self.fixtures
+        return {
+            'id': 1,
+            'name': fixtures.name,
+            'full_name': '{}/{}'.format(fixtures.owner, fixtures.name),
+            'owner': self.user(fixtures.owner),
+            'url': self.repo_url(),
+            'html_url': '',
+        }
+
+    def rest_pull(self, pull):
+        fixtures = self.fixtures
+        return {
+            'id': pull['number'],
+            'number': pull['number'],
+            'state': 'open',
+            'title': pull['title'],
+            'body': pull['body'],
+            'user': self.user(pull['author']),
+            'assignee': self.user(pull['assignee'])
+                        if pull['assignee'] else None,
+            'updated_at': pull['updated_at'].strftime(TIME_FORMAT),
+            'head': {
+                'ref': pull['head_ref'],
+                'sha': pull['head_sha'],
+                'label': '{}:{}'.format(pull['author'], pull['head_ref']),
+                'user': self.user(pull['author']),
+                'repo': {'name': fixtures.name,
+                         'owner': self.user(pull['author'])},
+            },
+            'base': {
+                'ref': pull['base_ref'],
+                'sha': '0' * 40,
+                'label': '{}:{}'.format(fixtures.owner, pull['base_ref']),
+                'user': self.user(fixtures.owner),
+                'repo': {'name': fixtures.name,
+                         'owner': self.user(fixtures.owner)},
+            },
+            'url': '{}/pulls/{}'.format(self.repo_url(), pull['number']),
+            'issue_url': '{}/issues/{}'.format(self.repo_url(),
+                                               pull['number']),
+        }
+
+    def rest_comment(self, comment):
+        created_at = comment['created_at'].strftime(TIME_FORMAT)
+        return {
+            'id': comment['id'],
+            'body': comment['body'],
+            'user': self.user(comment['login']),
+            'created_at': created_at,
+            'updated_at': created_at,
+        }
+
+    def post(self, path, data):
+        if path != '/api/v3/graphql':
+            return 404, {'message': 'Not Found'}
+        self.count('graphql')
+
+        variables = data['variables']
+        if 'pullRequests(' in data['query']:
+            return 200, {'data': {'repository': self.graphql_pulls(
+                variables['cursor'])}}
+
+        pull = self.fixtures.pull(variables['number'])
+        comments = self.graphql_comments(pull['issue_comments'],
+                                         variables['cursor'])
+        return 200, {'data': {'repository': {
+            'pullRequest': {'comments': comments}}}}
+
+    def graphql_page(self, items, cursor, first):
+        start = int(cursor) if cursor else 0
+        end = start + first
+        return items[start:end], {'hasNextPage': end < len(items),
+                                  'endCursor': str(min(end, len(items)))}
+
+    def graphql_comments(self, comments, cursor):
+        nodes, page_info = self.graphql_page(comments, cursor, 100)
+        return {
+            'pageInfo': page_info,
+            'nodes': [{'databaseId': x['id'], 'body': x['body'],
+                       'author': {'login': x['login']}} for x in nodes],
+        }
+
+    def graphql_pulls(self, cursor):
+        pulls, page_info = self.graphql_page(self.fixtures.pulls, cursor, 50)
+        return {'pullRequests': {
+            'pageInfo': page_info,
+            'nodes': [self.graphql_pull(x) for x in pulls],
+        }}
+
+    def graphql_pull(self, pull):
+        status = {'context': {'state': pull['status'].upper()}} \
+            if pull['status'] else None
+        return {
+            'number': pull['number'],
+            'title': pull['title'],
+            'body': pull['body'],
+            'updatedAt': pull['updated_at'].strftime(TIME_FORMAT),
+            'headRefOid': pull['head_sha'],
+            'headRefName': pull['head_ref'],
+            'headRepositoryOwner': {'login': pull['author']},
+            'baseRefName': pull['base_ref'],
+            'assignees': {'nodes': [{'login': pull['assignee']}]
+                          if pull['assignee'] else []},
+            'commits': {'nodes': [{'commit': {'status': status}}]},
+            'comments': self.graphql_comments(pull['issue_comments'], None),
+            'reviews': {
+                'pageInfo': {'hasNextPage': False},
+                'nodes': [{
+                    'comments': {
+                        'pageInfo': {'hasNextPage': False},
+                        'nodes': [{
+                            'databaseId': x['id'],
+                            'body': x['body'],
+                            'createdAt': x['created_at'].strftime(TIME_FORMAT),
+                            'author': {'login': x['login']},
+                            'originalCommit': {'oid': x['commit_id']},
+                        }],
+                    },
+                } for x in pull['review_comments']],
+            },
+        }
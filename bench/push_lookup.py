@@ -0,0 +1,65 @@
+# Times finding the pull requests a push affects, those targeting the pushed
+# branch and the one whose head was pushed over, in a repository with many
+# open pull requests: by scanning every state, as the push handler used to,
+# and with the indexes of RepoStates.
+#
+# Run from the root of the repository:
+#
+#     python -m bench.push_lookup --pulls 10000 --on-ref 100
+
+import argparse
+import random
+import timeit
+
+from homu.indexes import RepoStates
+from homu.main import PullReqState
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pulls', type=int, default=10000)
+    parser.add_argument('--on-ref', type=int, default=100,
+                        help='pull requests targeting the pushed branch')
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    repos = {'repo': None}
+
+    states = RepoStates()
+    on_ref = set(rand.sample(range(1, args.pulls + 1), args.on_ref))
+    for num in range(1, args.pulls + 1):
+        state = PullReqState(num, '{:040x}'.format(rand.getrandbits(160)), '',
+                             'repo', None, None, 'owner', 'name', repos)
+        state.base_ref = 'master' if num in on_ref \
+            else 'branch-{}'.format(num % 500)
+        states[num] = state
+
+    ref = 'master'
+    before = states[rand.randrange(1, args.pulls + 1)].head_sha
+
+    def scan():
+        targets, advanced = [], []
+        for state in list(states.values()):
+            if state.base_ref == ref:
+                targets.append(state)
+            if state.head_sha == before:
+                advanced.append(state)
+        return targets, advanced
+
+    def indexes():
+        return (states.find('base_ref', ref),
+                states.find('head_sha', before))
+
+    assert [len(x) for x in scan()] == [len(x) for x in indexes()]
+
+    print('{} pull requests, {} on {}'.format(args.pulls, args.on_ref, ref))
+    for name, func in [('full scan', scan), ('indexes', indexes)]:
+        seconds = min(timeit.repeat(func, number=args.repeat, repeat=5))
+        print('  {:10} {:.3f} ms'.format(name + ':',
+                                         seconds / args.repeat * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Measures the memory a pull request's state keeps once it has been loaded,
+# with tracemalloc: synthetic pull requests with bodies of `--body` bytes,
+# written to a SQLite database like synchronize does, then the size retained
+# divided by their number.
+#
+# Run from the root of the repository:
+#
+#     python -m bench.state_memory --pulls 5000
+
+import argparse
+import gc
+import os
+import random
+import tempfile
+import tracemalloc
+
+from homu.database import Database
+from homu.indexes import RepoStates
+from homu.main import PullReqState
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pulls', type=int, default=5000)
+    parser.add_argument('--body', type=int, default=2048,
+                        help='bytes in the body of each pull request')
+    parser.add_argument('--authors', type=int, default=50)
+    parser.add_argument('--reviewers', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    db = Database({'engine': 'sqlite', 'path': os.path.join(tmp, 'homu.db')})
+    db.init_schema()
+
+    rand = random.Random(args.seed)
+    repos = {'repo': None}
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    # Strings are built as they would have been read from GitHub, and only
+    # what the states keep of them is left once the rows are gone.
+    rows = []
+    for num in range(1, args.pulls + 1):
+        author = 'user{}'.format(rand.randrange(args.authors))
+        rows.append({
+            'num': num,
+            'head_sha': '{:040x}'.format(rand.getrandbits(160)),
+            'title': 'Pull request {}'.format(num),
+            'body': ''.join(rand.choice('abcdefgh ')
+                            for _ in range(args.body)),
+            'head_ref': '{}:branch-{}'.format(author, num),
+            'base_ref': ''.join(['mas', 'ter']),
+            'assignee': ''.join(['user', str(rand.randrange(args.authors))]),
+            'approved_by': ''.join(
+                ['reviewer', str(rand.randrange(args.reviewers))]),
+        })
+
+    states = RepoStates()
+    for row in rows:
+        with db.unit_of_work():
+            state = PullReqState(row['num'], row['head_sha'], '', 'repo',
+                                 None, None, 'owner', 'name', repos)
+            state.title = row['title']
+            state.body = row['body']
+            state.head_ref = row['head_ref']
+            state.base_ref = row['base_ref']
+            state.assignee = row['assignee']
+            state.approved_by = row['approved_by']
+            state.save()
+        states[row['num']] = state
+
+    del rows, row
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print('{} pull requests, {} byte bodies: {:.0f} bytes per pull request'
+          .format(len(states), args.body, (after - before) / len(states)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# Compares the REST and GraphQL engines of the synchronization of pull
+# requests, by the number of API requests and the wall-clock time they take
+# per 100 pull requests. Each engine synchronizes the same repository, served
+# by a local fixture server that answers after a simulated round trip, first
+# from scratch and then again with nothing changed.
+#
+# Run from the root of the repository:
+#
+#     python -m bench.sync_bench --pulls 100 --latency 0.05
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+import github3
+
+from homu import sync
+from homu.database import Database
+from homu.main import synchronize
+from homu.mergeability import MergeabilityQueue
+
+from .github_fixtures import Fixtures, FixtureServer
+
+
+def run(server, engine, states, workers, full):
+    fixtures = server.fixtures
+    repo_cfg = {'owner': fixtures.owner, 'name': fixtures.name,
+                'reviewers': [], 'sync': engine}
+
+    gh = github3.GitHubEnterprise(server.url, token='token')
+    # rate_limit() is not made relative to the enterprise URL.
+    gh._github_url = server.api_url
+
+    job = sync.SyncJob(engine, full, ThreadPoolExecutor(workers))
+
+    server.reset()
+    start = time.monotonic()
+    synchronize(engine, repo_cfg, logging.getLogger('bench'), gh, states,
+                {}, MergeabilityQueue(), 'homu', {}, full=full, job=job)
+    elapsed = time.monotonic() - start
+    return server.reset(), elapsed, len(states[engine])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pulls', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds the fixture server takes per request')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='threads synchronizing pull requests')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    tmp = tempfile.mkdtemp()
+    db = Database({'engine': 'sqlite', 'path': os.path.join(tmp, 'homu.db')})
+    db.init_schema()
+
+    server = FixtureServer(Fixtures(args.pulls, args.seed), args.latency)
+    scale = 100 / args.pulls
+
+    print('{} pull requests, {:.0f} ms per request, {} workers'.format(
+        args.pulls, args.latency * 1000, args.workers))
+    print('{:8} {:8} {:>14} {:>12}  {}'.format(
+        'engine', 'sync', 'requests/100', 'seconds/100', 'requests by kind'))
+
+    try:
+        for engine in ['rest', 'graphql']:
+            states = {}
+            for full, label in [(True, 'scratch'), (False, 'again')]:
+                requests, elapsed, count = run(server, engine, states,
+                                               args.workers, full)
+                assert count == args.pulls, count
+                print('{:8} {:8} {:>14.1f} {:>12.2f}  {}'.format(
+                    engine, label, sum(requests.values()) * scale,
+                    elapsed * scale,
+                    ', '.join('{} {}'.format(k, v)
+                              for k, v in sorted(requests.items()))))
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,505 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import datetime
+import functools
+import re
+import threading
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+
+API_URL = 'https://api.github.com/'
+
+# Priorities of GitHub requests. Merges, ref updates and statuses keep the
+# queue moving, comments can wait a little, and mergeability polling and
+# resynchronization can wait until the rate limit resets.
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+PRIORITY_NAMES = ['high', 'normal', 'low']
+
+# Requests of a priority are held back once no more than this many requests
+# are left in the current rate limit window.
+RESERVES = [0, 100, 500]
+
+# Writes that are high priority wherever they are made from.
+HIGH_PRIORITY_WRITES = re.compile(r'/repos/[^/]+/[^/]+/(git/refs|merges|statuses)(/|$)')
+
+# How long a response may be reused without asking GitHub again, by path.
+# Anything else is revalidated on every request, which still does not count
+# against the rate limit when it has not changed.
+CACHE_TTLS = [
+    (r'/user$', 3600),
+    (r'/repos/[^/]+/[^/]+$', 300),
+    (r'/repos/[^/]+/[^/]+/collaborators/[^/]+$', 300),
+]
+
+
+local = threading.local()
+
+
+@contextmanager
+def priority(level):
+    old_level = getattr(local, 'priority', None)
+    local.priority = level
+    try:
+        yield
+    finally:
+        local.priority = old_level
+
+
+def prioritized(level):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with priority(level):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def request_priority(request):
+    level = getattr(local, 'priority', None)
+    if level is not None:
+        return level
+    if request.method != 'GET' and \
+            HIGH_PRIORITY_WRITES.match(urllib.parse.urlsplit(request.url).path):
+        return HIGH
+    return NORMAL
+
+
+# Shares the rate limit between everything that talks to GitHub. The remaining
+# requests are read from the X-RateLimit-* headers of every response, and
+# requests that are in flight are counted against them. Lower priority
+# requests wait while the remaining requests are within their reserve, or
+# while a higher priority request is waiting, and are let through again when
+# the rate limit resets. Without reserves, the rate limit is only tracked.
+class RateLimiter:
+    def __init__(self, *, reserves=RESERVES):
+        self.reserves = reserves
+
+        self.cond = threading.Condition()
+        self.limit = None
+        self.remaining = None
+        self.reset = 0
+        self.in_flight = 0
+        self.waiting = [0] * len(PRIORITY_NAMES)
+
+        self.requests = [0] * len(PRIORITY_NAMES)
+        self.deferred = [0] * len(PRIORITY_NAMES)
+        self.wait_total = [0.0] * len(PRIORITY_NAMES)
+
+    # Requests that can still be made in the current window.
+    def headroom(self):
+        with self.cond:
+            if self.remaining is None or time.time() >= self.reset:
+                return float('inf')
+            return self.remaining - self.in_flight
+
+    def allowed(self, level):
+        if self.reserves is None:
+            return True
+
+        if any(self.waiting[:level]):
+            return False
+
+        if self.remaining is None:
+            return True
+
+        if time.time() >= self.reset:
+            # A new window has started, the next response tells how much of
+            # it is left.
+            self.remaining = None
+            return True
+
+        return self.remaining - self.in_flight > self.reserves[level]
+
+    def acquire(self, level):
+        start = time.time()
+
+        with self.cond:
+            if not self.allowed(level):
+                self.deferred[level] += 1
+                self.waiting[level] += 1
+                try:
+                    while not self.allowed(level):
+                        self.cond.wait(max(self.reset - time.time(), 0) + 1)
+                finally:
+                    self.waiting[level] -= 1
+                    self.cond.notify_all()
+
+            self.in_flight += 1
+            self.requests[level] += 1
+            self.wait_total[level] += time.time() - start
+
+    def release(self, headers):
+        with self.cond:
+            self.in_flight -= 1
+
+            # Search and GraphQL requests have separate limits.
+            if headers.get('X-RateLimit-Resource', 'core') == 'core' and \
+                    'X-RateLimit-Remaining' in headers:
+                self.limit = int(headers['X-RateLimit-Limit'])
+                self.remaining = int(headers['X-RateLimit-Remaining'])
+                self.reset = int(headers['X-RateLimit-Reset'])
+
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'limit': self.limit,
+                'remaining': self.remaining,
+                'reset': self.reset,
+                'in_flight': self.in_flight,
+                'priorities': {
+                    name: {
+                        'requests': self.requests[i],
+                        'deferred': self.deferred[i],
+                        'waiting': self.waiting[i],
+                        'wait_total': self.wait_total[i],
+                    }
+                    for i, name in enumerate(PRIORITY_NAMES)
+                },
+            }
+
+
+def is_rate_limited(resp):
+    if resp.status_code == 429:
+        return True
+    return resp.status_code == 403 and (
+        resp.headers.get('X-RateLimit-Remaining') == '0' or
+        'Retry-After' in resp.headers)
+
+
+# One token homu can use, with its own rate limit.
+class Credential:
+    def __init__(self, name, token, limiter):
+        self.name = name
+        self.authorization = 'token ' + token
+        self.limiter = limiter
+
+
+# A GitHub App installation homu can use, with its own rate limit. Its
+# installation tokens last an hour, and a new one is minted with a JWT signed
+# by the app's private key shortly before the current one expires.
+class AppCredential:
+    RENEW_BEFORE = 300
+
+    def __init__(self, name, app_id, private_key, installation_id, limiter, *,
+                 session=None):
+        import jwt
+        self.jwt = jwt
+
+        self.name = name
+        self.app_id = app_id
+        self.private_key = private_key
+        self.installation_id = installation_id
+        self.limiter = limiter
+        # Tokens are minted outside of the adapter, which would replace the
+        # JWT with a token.
+        self.session = session or requests.Session()
+
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires = 0
+
+    @property
+    def authorization(self):
+        with self.lock:
+            if time.time() >= self.expires - self.RENEW_BEFORE:
+                self.token, self.expires = self.mint()
+            return 'token ' + self.token
+
+    def app_token(self):
+        now = int(time.time())
+        token = self.jwt.encode({
+            # Allows for clock drift.
+            'iat': now - 60,
+            'exp': now + 540,
+            'iss': str(self.app_id),
+        }, self.private_key, algorithm='RS256')
+        # PyJWT before 2.0 returns bytes.
+        return token.decode('ascii') if isinstance(token, bytes) else token
+
+    def mint(self):
+        resp = self.session.post(
+            '{}app/installations/{}/access_tokens'.format(
+                API_URL, self.installation_id),
+            headers={
+                'Authorization': 'Bearer ' + self.app_token(),
+                'Accept': 'application/vnd.github.v3+json',
+            })
+        resp.raise_for_status()
+
+        info = resp.json()
+        expires = datetime.datetime.strptime(
+            info['expires_at'], '%Y-%m-%dT%H:%M:%SZ',
+        ).replace(tzinfo=datetime.timezone.utc).timestamp()
+        return info['token'], expires
+
+
+# The tokens requests to GitHub are made with. Writes to a repository are
+# always made with the credential the repository is configured with, the
+# primary one by default, so that comments, statuses and merges keep the same
+# author. Reads go to whichever credential has the most requests left.
+class CredentialPool:
+    def __init__(self, credentials, repo_credentials):
+        self.credentials = credentials
+        self.repo_credentials = repo_credentials
+
+    def __len__(self):
+        return len(self.credentials)
+
+    def for_write(self, request):
+        path = urllib.parse.urlsplit(request.url).path.split('/')
+        if len(path) > 3 and path[1] == 'repos':
+            index = self.repo_credentials.get((path[2].lower(), path[3].lower()))
+            if index is not None:
+                return self.credentials[index]
+        return self.credentials[0]
+
+    def for_read(self, exclude=()):
+        return max((x for x in self.credentials if x not in exclude),
+                   key=lambda x: x.limiter.headroom())
+
+    def stats(self):
+        return {x.name: x.limiter.stats() for x in self.credentials}
+
+
+class CacheEntry:
+    __slots__ = ['etag', 'last_modified', 'status_code', 'headers', 'content',
+                 'encoding', 'expires']
+
+    def __init__(self, resp, expires):
+        self.etag = resp.headers.get('ETag')
+        self.last_modified = resp.headers.get('Last-Modified')
+        self.status_code = resp.status_code
+        self.headers = dict(resp.headers)
+        self.content = resp.content
+        self.encoding = resp.encoding
+        self.expires = expires
+
+
+# Responses to GET requests, least recently used first, bounded by both their
+# number and their total size.
+class ResponseCache:
+    def __init__(self, *, size=1000, max_bytes=50 * 1024 * 1024, ttls=None):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.ttls = [(re.compile(pattern), ttl)
+                     for pattern, ttl in (CACHE_TTLS if ttls is None else ttls)]
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def ttl(self, url):
+        path = urllib.parse.urlsplit(url).path
+        for pattern, ttl in self.ttls:
+            if pattern.match(path):
+                return ttl
+        return 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.bytes -= len(old.content)
+
+            if len(entry.content) > self.max_bytes:
+                return
+
+            self.entries[key] = entry
+            self.bytes += len(entry.content)
+
+            while len(self.entries) > self.size or self.bytes > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.bytes -= len(old.content)
+                self.evictions += 1
+
+    # Drops the responses for a resource that has just been written to.
+    def invalidate(self, url):
+        with self.lock:
+            for key in [x for x in self.entries if x[0].split('?')[0] == url]:
+                self.bytes -= len(self.entries.pop(key).content)
+
+    def count(self, result):
+        with self.lock:
+            setattr(self, result, getattr(self, result) + 1)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.revalidated + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'revalidated': self.revalidated,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits + self.revalidated) / total
+                            if total else 0.0,
+            }
+
+
+# Transport for every request github3 makes to the GitHub API. GET requests
+# are made conditional on the ETag or Last-Modified of the cached response,
+# and a 304 Not Modified is answered from the cache. Requests that reach
+# GitHub are made with a credential from the pool and go through its rate
+# limiter. Reads that hit a rate limit are retried with the other credentials.
+class GitHubAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, credentials, *, cache=None, **kwargs):
+        super().__init__(**kwargs)
+        self.credentials = credentials
+        self.cache = cache
+
+    def send_as(self, credential, request, level, **kwargs):
+        request.headers['Authorization'] = credential.authorization
+
+        credential.limiter.acquire(level)
+        headers = {}
+        try:
+            resp = super().send(request, **kwargs)
+            headers = resp.headers
+            return resp
+        finally:
+            credential.limiter.release(headers)
+
+    def send_limited(self, request, **kwargs):
+        level = request_priority(request)
+
+        if request.method != 'GET':
+            return self.send_as(self.credentials.for_write(request), request,
+                                level, **kwargs)
+
+        tried = []
+        while True:
+            credential = self.credentials.for_read(tried)
+            resp = self.send_as(credential, request, level, **kwargs)
+            tried.append(credential)
+
+            if not is_rate_limited(resp) or len(tried) == len(self.credentials):
+                return resp
+            resp.close()
+
+    def send(self, request, **kwargs):
+        if not self.cache:
+            return self.send_limited(request, **kwargs)
+
+        url = request.url.split('?')[0]
+
+        if request.method != 'GET':
+            resp = self.send_limited(request, **kwargs)
+            self.cache.invalidate(url)
+            return resp
+
+        key = (request.url, request.headers.get('Accept'))
+        entry = self.cache.get(key)
+
+        if entry and entry.expires > time.time():
+            self.cache.count('hits')
+            return self.build_cached(request, entry)
+
+        if entry:
+            if entry.etag:
+                request.headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                request.headers['If-Modified-Since'] = entry.last_modified
+
+        resp = self.send_limited(request, **kwargs)
+
+        if entry and resp.status_code == 304:
+            self.cache.count('revalidated')
+            resp.close()
+            entry.expires = time.time() + self.cache.ttl(url)
+            return self.build_cached(request, entry, resp.headers)
+
+        self.cache.count('misses')
+        if resp.status_code == 200 and ('ETag' in resp.headers or
+                                        'Last-Modified' in resp.headers):
+            self.cache.put(key, CacheEntry(
+                resp, time.time() + self.cache.ttl(url)))
+
+        return resp
+
+    def build_cached(self, request, entry, headers=None):
+        resp = requests.Response()
+        resp.status_code = entry.status_code
+        resp.headers = requests.structures.CaseInsensitiveDict(entry.headers)
+        # The rate limit headers of the 304 are the current ones.
+        if headers:
+            resp.headers.update({k: v for k, v in headers.items()
+                                 if k.startswith('X-RateLimit-')})
+        resp._content = entry.content
+        resp.encoding = entry.encoding
+        resp.url = request.url
+        resp.request = request
+        resp.connection = self
+        resp.reason = 'OK'
+        return resp
+
+    def stats(self):
+        return {
+            'cache': self.cache.stats() if self.cache else None,
+            'credentials': self.credentials.stats(),
+        }
+
+
+def mount(gh, cfg):
+    github_cfg = cfg['github']
+
+    cache_cfg = github_cfg.get('cache', {})
+    cache = ResponseCache(
+        size=cache_cfg.get('size', 1000),
+        max_bytes=cache_cfg.get('max_bytes', 50 * 1024 * 1024),
+        ttls=list(cache_cfg.get('ttl', {}).items()) + CACHE_TTLS,
+    ) if cache_cfg.get('enabled', True) else None
+
+    limiter_cfg = github_cfg.get('rate_limit', {})
+    reserves = limiter_cfg.get('reserves', RESERVES) \
+        if limiter_cfg.get('enabled', True) else None
+
+    tokens = [github_cfg['access_token']] + github_cfg.get('access_tokens', [])
+    credentials = [Credential('primary' if i == 0 else str(i), token,
+                              RateLimiter(reserves=reserves))
+                   for i, token in enumerate(tokens)]
+
+    for app_cfg in github_cfg.get('app_installations', []):
+        with open(app_cfg['private_key']) as f:
+            private_key = f.read()
+        credentials.append(AppCredential(
+            str(len(credentials)), app_cfg['app_id'], private_key,
+            app_cfg['installation_id'], RateLimiter(reserves=reserves)))
+
+    repo_credentials = {}
+    for repo_cfg in cfg['repo'].values():
+        index = repo_cfg.get('github', {}).get('credential')
+        if index is not None:
+            key = (repo_cfg['owner'].lower(), repo_cfg['name'].lower())
+            repo_credentials[key] = index
+
+    adapter = GitHubAdapter(CredentialPool(credentials, repo_credentials),
+                            cache=cache)
+    gh._session.mount(API_URL, adapter)
+    return adapter
+
+
+def get_adapter(gh):
+    adapter = gh._session.get_adapter(API_URL)
+    return adapter if isinstance(adapter, GitHubAdapter) else None
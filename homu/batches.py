@@ -0,0 +1,267 @@
+import threading
+
+from .database import Database
+
+
+# Approved pull requests of one base branch, merged on top of each other and
+# tested together by building the merge of the last one. The merge of every
+# pull request is also the merge of all the ones before it, so each prefix of
+# the batch can be built and landed on its own.
+#
+# When a build fails, the prefixes between the last one that landed and the
+# failing one are bisected: a prefix that passes is landed right away, and
+# once the failing prefix is only one pull request longer than the landed one,
+# that pull request is the culprit and the ones after it go back to the queue.
+class Batch:
+    def __init__(self, repo_label, base_ref, states, *, landed=0,
+                 failing=None, testing=None):
+        self.repo_label = repo_label
+        self.base_ref = base_ref
+        self.states = states
+        self.merge_shas = [x.merge_sha for x in states]
+
+        # Lengths of the longest prefix that landed, the shortest one known to
+        # fail, and the one being built or None between builds.
+        self.landed = landed
+        self.failing = failing
+        self.testing = testing
+
+    def __repr__(self):
+        return 'Batch:{}:{}({})'.format(
+            self.repo_label, self.base_ref,
+            ', '.join('#{}'.format(x.num) for x in self.states))
+
+    # The pull request whose merge is being built.
+    def tested(self):
+        return self.states[self.testing - 1] if self.testing else None
+
+    # The pull requests built by the current build that have not landed yet.
+    def under_test(self):
+        return self.states[self.landed:self.testing or self.landed]
+
+    # Whether the pull requests that have not landed are still the ones that
+    # were merged, unchanged and waiting for their build.
+    def valid(self):
+        return all(x.repo_states is not None and
+                   x.repo_states.get(x.num) is x and
+                   x.status == 'pending' and x.merge_sha == sha
+                   for x, sha in zip(self.states[self.landed:],
+                                     self.merge_shas[self.landed:]))
+
+    # Records that the prefix being built passed and has been landed. Returns
+    # the pull requests that landed with it.
+    def passed(self):
+        landed = self.under_test()
+        self.landed = self.testing
+        self.testing = None
+        return landed
+
+    def failed(self):
+        self.failing = self.testing
+        self.testing = None
+
+    def done(self):
+        return self.landed == len(self.states) or self.culprit() is not None
+
+    # The pull request that broke the build, once bisection has found it.
+    def culprit(self):
+        if self.failing is not None and self.failing - self.landed == 1:
+            return self.states[self.landed]
+        return None
+
+    # The pull requests that were merged after the culprit.
+    def rest(self):
+        return self.states[self.failing:] if self.failing else []
+
+    # Picks the next prefix to build. The whole batch is built first.
+    def advance(self):
+        if self.failing is None:
+            self.testing = len(self.states)
+        else:
+            self.testing = (self.landed + self.failing) // 2
+        return self.tested()
+
+    def save(self):
+        Database().save_batch(self.repo_label, self.base_ref,
+                              [x.num for x in self.states], self.landed,
+                              self.failing, self.testing)
+
+    def delete(self):
+        Database().delete_batch(self.repo_label, self.base_ref)
+
+
+# The result of the build of a pull request's merge: True once every builder
+# passed, False once one failed and None while it is running.
+def build_result(state):
+    results = [x['res'] for x in state.build_res.values()]
+    if False in results:
+        return False
+    if results and all(results):
+        return True
+    return None
+
+
+# Pull requests of one base branch that are built at the same time, each merged
+# on top of the one before it as if those had landed already. A pull request
+# whose build passes lands as soon as every one before it has. One whose build
+# fails is blamed once every one before it has landed, and the ones after it,
+# which were built on top of it, go back to the queue straight away.
+class Pipeline:
+    def __init__(self, repo_label, base_ref, states=()):
+        self.repo_label = repo_label
+        self.base_ref = base_ref
+        self.states = list(states)
+        self.merge_shas = [x.merge_sha for x in self.states]
+
+    def __repr__(self):
+        return 'Pipeline:{}:{}({})'.format(
+            self.repo_label, self.base_ref,
+            ', '.join('#{}'.format(x.num) for x in self.states))
+
+    # The pull request the next one is merged on top of.
+    def tail(self):
+        return self.states[-1] if self.states else None
+
+    def valid(self):
+        return all(x.repo_states is not None and
+                   x.repo_states.get(x.num) is x and
+                   x.status == 'pending' and x.merge_sha == sha
+                   for x, sha in zip(self.states, self.merge_shas))
+
+    # Whether a build failed whose pull request has not been blamed yet.
+    def blocked(self):
+        return any(build_result(x) is False for x in self.states)
+
+    def append(self, state):
+        self.states.append(state)
+        self.merge_shas.append(state.merge_sha)
+
+    # Removes and returns the pull requests after state, or all of them.
+    def cut(self, state=None):
+        i = self.states.index(state) + 1 if state else 0
+        rest = self.states[i:]
+        del self.states[i:]
+        del self.merge_shas[i:]
+        return rest
+
+    # Removes the pull request, and returns the ones after it, which were
+    # merged on top of it.
+    def drop(self, state):
+        i = self.states.index(state)
+        rest = self.states[i + 1:]
+        del self.states[i:]
+        del self.merge_shas[i:]
+        return rest
+
+    # Removes and returns the first pull request if its build has finished.
+    def pop_finished(self):
+        if self.states and build_result(self.states[0]) is not None:
+            del self.merge_shas[0]
+            return self.states.pop(0)
+        return None
+
+    def save(self):
+        Database().save_pipeline(self.repo_label, self.base_ref,
+                                 [x.num for x in self.states])
+
+    def delete(self):
+        Database().delete_pipeline(self.repo_label, self.base_ref)
+
+
+# Returns a pull request that was merged into a batch to the queue.
+def release(state):
+    state.merge_sha = ''
+    state.set_status('')
+
+
+# The batches and pipelines being built, at most one per repository and base
+# branch, and the size of the next batch of each of them. The size grows by
+# one with every batch that lands whole, and is halved by every batch that
+# fails.
+class Batches:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batches = {}
+        self.sizes = {}
+
+    def get(self, repo_label, base_ref):
+        with self.lock:
+            return self.batches.get((repo_label, base_ref))
+
+    def of(self, state):
+        with self.lock:
+            for batch in self.batches.values():
+                if batch.repo_label == state.repo_label and \
+                        state in batch.states:
+                    return batch
+        return None
+
+    def of_repo(self, repo_label):
+        with self.lock:
+            return [x for x in self.batches.values()
+                    if x.repo_label == repo_label]
+
+    def add(self, batch):
+        with self.lock:
+            self.batches[batch.repo_label, batch.base_ref] = batch
+        batch.save()
+
+    def remove(self, batch):
+        with self.lock:
+            if self.batches.get((batch.repo_label, batch.base_ref)) is batch:
+                del self.batches[batch.repo_label, batch.base_ref]
+        batch.delete()
+
+    def size(self, repo_label, base_ref, max_size):
+        with self.lock:
+            return self.sizes.get((repo_label, base_ref), max_size)
+
+    def resize(self, repo_label, base_ref, max_size, passed):
+        key = repo_label, base_ref
+        with self.lock:
+            size = self.sizes.get(key, max_size)
+            size = min(size + 1, max_size) if passed else max(size // 2, 1)
+            self.sizes[key] = size
+
+    def load(self, db, states):
+        for repo_label, base_ref, nums, landed, failing, testing in \
+                db.iter_batches():
+            repo_states = states.get(repo_label, {})
+            batch_states = [repo_states.get(x) for x in nums]
+            if None in batch_states:
+                for state in batch_states[landed:]:
+                    if state and state.status == 'pending':
+                        release(state)
+                db.delete_batch(repo_label, base_ref)
+                continue
+
+            with self.lock:
+                self.batches[repo_label, base_ref] = Batch(
+                    repo_label, base_ref, batch_states, landed=landed,
+                    failing=failing, testing=testing)
+
+        for repo_label, base_ref, nums in db.iter_pipelines():
+            repo_states = states.get(repo_label, {})
+            pipeline_states = [repo_states.get(x) for x in nums]
+            if None in pipeline_states:
+                for state in pipeline_states:
+                    if state and state.status == 'pending':
+                        release(state)
+                db.delete_pipeline(repo_label, base_ref)
+                continue
+
+            with self.lock:
+                self.batches[repo_label, base_ref] = Pipeline(
+                    repo_label, base_ref, pipeline_states)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'batches': {'{}:{}'.format(*key): repr(batch)
+                            for key, batch in self.batches.items()},
+                'sizes': {'{}:{}'.format(*key): size
+                          for key, size in self.sizes.items()},
+            }
+
+
+batches = Batches()
@@ -1,9 +1,17 @@
+from collections import OrderedDict, deque
 from contextlib import contextmanager
-from mysql.connector.pooling import MySQLConnectionPool
-from mysql.connector.errors import PoolError
+import logging
+import os
+import sqlite3
 import threading
 import time
-import yaml
+import traceback
+
+PULL_COLUMNS = ['status', 'merge_sha', 'title', 'body', 'head_sha',
+                'head_ref', 'base_ref', 'assignee', 'approved_by', 'priority',
+                'try_', 'rollup']
+
+UNSET = object()
 
 
 class Singleton(type):
@@ -18,44 +26,754 @@ class Singleton(type):
         return cls.__instance
 
 
-class Database(object, metaclass=Singleton):
-    def __init__(self):
-        cfg = self.__get_cfg()
-        self.pool = MySQLConnectionPool(pool_name='dbpool',
-                                        pool_size=5,
-                                        **cfg)
+class PoolError(Exception):
+    pass
+
+
+class MySQLEngine:
+    schema = 'schema.sql'
+
+    def __init__(self, cfg):
+        import mysql.connector
+        self.mysql = mysql.connector
+        self.Error = mysql.connector.Error
+
+        self.cfg, self.pool_cfg = self.__get_cfg()
 
     def __get_cfg(self):
+        import yaml
+
         with open('database.yml') as f:
             cfg = yaml.load(f.read())['production']
 
         keys = ['username', 'password', 'host', 'port', 'database', 'ssl_ca',
                 'ssl_cert', 'ssl_key']
 
+        # Rails names for the pool settings, so database.yml can be shared.
+        pool_cfg = {}
+        if 'pool' in cfg:
+            pool_cfg['pool_size'] = cfg['pool']
+        if 'checkout_timeout' in cfg:
+            pool_cfg['pool_timeout'] = cfg['checkout_timeout']
+
         no_ = lambda s: s.replace('_', '')
         cfg = { k: cfg.get(no_(k)) for k in keys if no_(k) in cfg }
         cfg['ssl_verify_cert'] = True
         # Mysql documentation incorrectly says 'username' is an alias of 'user'.
         cfg['user'] = cfg.pop('username')
-        return cfg
+        return cfg, pool_cfg
+
+    def connect(self):
+        return self.mysql.connect(**self.cfg)
+
+    def check(self, cnx):
+        try:
+            cnx.ping(reconnect=True, attempts=1)
+        except self.Error:
+            return False
+        return True
+
+    def release(self, cnx):
+        # The next user of the connection fails with an unread result.
+        if cnx.unread_result:
+            cnx.get_rows()
+
+    def init_schema(self, cnx, schema):
+        # execute with multi=True requires enumeration.
+        list(cnx.cursor().execute(multi=True, operation=schema))
+        cnx.commit()
+
+
+class SQLiteCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        self.cursor.execute(sql.replace('%s', '?'), params)
+
+    def executemany(self, sql, seq):
+        self.cursor.executemany(sql.replace('%s', '?'), seq)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+
+# Lets the MySQL-flavoured SQL in this module (%s placeholders, REPLACE INTO)
+# run unchanged on SQLite.
+class SQLiteConnection:
+    def __init__(self, cnx):
+        self.cnx = cnx
+
+    def cursor(self):
+        return SQLiteCursor(self.cnx.cursor())
+
+    def commit(self):
+        self.cnx.commit()
+
+    def rollback(self):
+        self.cnx.rollback()
+
+    def close(self):
+        self.cnx.close()
+
+
+class SQLiteEngine:
+    schema = 'schema_sqlite.sql'
+    Error = sqlite3.Error
+
+    def __init__(self, cfg):
+        self.path = cfg.get('path', 'homu.db')
+        self.pool_cfg = {}
+        # Every connection to :memory: opens a separate database.
+        if self.path == ':memory:':
+            self.pool_cfg['pool_size'] = 1
+
+    def connect(self):
+        cnx = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        cnx.execute('PRAGMA journal_mode = WAL')
+        cnx.execute('PRAGMA synchronous = NORMAL')
+        return SQLiteConnection(cnx)
+
+    def check(self, cnx):
+        try:
+            cnx.cnx.execute('SELECT 1')
+        except sqlite3.Error:
+            return False
+        return True
+
+    def release(self, cnx):
+        pass
+
+    def init_schema(self, cnx, schema):
+        cnx.cnx.executescript(schema)
+        cnx.commit()
+
+
+ENGINES = {
+    'mysql': MySQLEngine,
+    'sqlite': SQLiteEngine,
+}
+
+
+# A fixed-size pool whose callers queue up in arrival order when every
+# connection is checked out. Connections are handed directly to the longest
+# waiting caller when they are returned.
+class ConnectionPool:
+    WAIT_BUCKETS = [0.001, 0.01, 0.1, 1, 10]
+    NEW = object()
+
+    def __init__(self, connect, check, *, size=5, timeout=30):
+        self.connect = connect
+        self.check = check
+        self.size = size
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.idle = []
+        self.waiters = deque()
+        self.created = 0
+        self.in_use = 0
+
+        self.checkouts = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.high_water = 0
+        self.wait_total = 0.0
+        self.wait_hist = [0] * (len(self.WAIT_BUCKETS) + 1)
+
+    def get_connection(self):
+        start = time.monotonic()
+        waiter = None
+
+        with self.lock:
+            if self.idle:
+                cnx = self.idle.pop()
+            elif self.created < self.size:
+                self.created += 1
+                cnx = None
+            else:
+                waiter = [threading.Event(), None]
+                self.waiters.append(waiter)
+
+        if waiter:
+            waiter[0].wait(self.timeout)
+            with self.lock:
+                if waiter[1] is None:
+                    self.waiters.remove(waiter)
+                    self.timeouts += 1
+                    raise PoolError('No connection available after {}s'
+                                    .format(self.timeout))
+            cnx = waiter[1] if waiter[1] is not self.NEW else None
+
+        try:
+            if cnx is None:
+                cnx = self.connect()
+            elif not self.check(cnx):
+                with self.lock:
+                    self.reconnects += 1
+                try: cnx.close()
+                except Exception: pass
+                cnx = self.connect()
+        except:
+            self.discard()
+            raise
+
+        wait = time.monotonic() - start
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.high_water = max(self.high_water, self.in_use)
+            self.wait_total += wait
+            for i, bucket in enumerate(self.WAIT_BUCKETS):
+                if wait < bucket:
+                    break
+            else:
+                i = len(self.WAIT_BUCKETS)
+            self.wait_hist[i] += 1
+
+        return cnx
+
+    def put_connection(self, cnx):
+        with self.lock:
+            self.in_use -= 1
+            if self.waiters:
+                waiter = self.waiters.popleft()
+                waiter[1] = cnx
+                waiter[0].set()
+            else:
+                self.idle.append(cnx)
+
+    # Gives up a slot whose connection could not be established.
+    def discard(self):
+        with self.lock:
+            if self.waiters:
+                # The waiter takes over the slot and opens its own connection.
+                waiter = self.waiters.popleft()
+                waiter[1] = self.NEW
+                waiter[0].set()
+            else:
+                self.created -= 1
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+            self.created -= len(idle)
+        for cnx in idle:
+            try: cnx.close()
+            except Exception: pass
+
+    def stats(self):
+        labels = ['<{}s'.format(x) for x in self.WAIT_BUCKETS] + \
+                 ['>={}s'.format(self.WAIT_BUCKETS[-1])]
+        with self.lock:
+            return {
+                'size': self.size,
+                'open': self.created,
+                'in_use': self.in_use,
+                'idle': len(self.idle),
+                'waiting': len(self.waiters),
+                'high_water': self.high_water,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'reconnects': self.reconnects,
+                'wait_total': self.wait_total,
+                'wait_time': dict(zip(labels, self.wait_hist)),
+            }
+
+
+class PendingPull:
+    def __init__(self):
+        self.deleted = False
+        self.row = None
+        self.fields = {}
+        self.mergeable = UNSET
+        self.build_res_reset = False
+        self.build_res = OrderedDict()
+
+    def update(self, fields):
+        if self.row is not None:
+            self.row.update(fields)
+        else:
+            self.fields.update(fields)
+
+    def merge(self, other):
+        if other.deleted:
+            self.__init__()
+            self.deleted = True
+
+        if other.row is not None:
+            self.row = dict(self.row or self.fields, **other.row)
+            self.fields = {}
+        self.update(other.fields)
+
+        if other.mergeable is not UNSET:
+            self.mergeable = other.mergeable
+
+        if other.build_res_reset:
+            self.build_res_reset = True
+            self.build_res = OrderedDict()
+        self.build_res.update(other.build_res)
+
+
+# Collects writes to the pull, mergeable and build_res tables and applies
+# them in a single transaction. Repeated writes to the same row are coalesced
+# so only the final value reaches the database.
+class UnitOfWork:
+    def __init__(self):
+        self.pulls = OrderedDict()
+        self.callbacks = []
+
+    def __bool__(self):
+        return bool(self.pulls or self.callbacks)
+
+    def pull(self, repo, num):
+        try:
+            return self.pulls[repo, num]
+        except KeyError:
+            pull = self.pulls[repo, num] = PendingPull()
+            return pull
+
+    def save_pull(self, repo, num, row):
+        pull = self.pull(repo, num)
+        pull.row = dict(pull.row or pull.fields, **row)
+        pull.fields = {}
+
+    def update_pull(self, repo, num, **fields):
+        self.pull(repo, num).update(fields)
+
+    def delete_pull(self, repo, num):
+        pull = self.pull(repo, num)
+        pull.__init__()
+        pull.deleted = True
+
+    def set_mergeable(self, repo, num, mergeable):
+        self.pull(repo, num).mergeable = mergeable
+
+    def reset_build_res(self, repo, num):
+        pull = self.pull(repo, num)
+        pull.build_res_reset = True
+        pull.build_res = OrderedDict()
+
+    def set_build_res(self, repo, num, builder, res, url, merge_sha):
+        self.pull(repo, num).build_res[builder] = (res, url, merge_sha)
+
+    def on_commit(self, callback):
+        self.callbacks.append(callback)
+
+    def merge(self, other):
+        for key, pull in other.pulls.items():
+            self.pull(*key).merge(pull)
+        self.callbacks += other.callbacks
+
+    def flush(self, db_conn):
+        cursor = db_conn.cursor()
+
+        for (repo, num), pull in self.pulls.items():
+            if pull.deleted:
+                for tbl in ['pull', 'build_res', 'mergeable', 'sync_cursors']:
+                    cursor.execute('DELETE FROM {} WHERE repo = %s AND '
+                                   'num = %s'.format(tbl), [repo, num])
+
+            # A row without every column (typically one whose body was never
+            # loaded) updates the existing row instead of replacing it.
+            if pull.row is not None and set(PULL_COLUMNS) <= set(pull.row):
+                cursor.execute('REPLACE INTO pull (repo, num, {}) VALUES '
+                               '({})'.format(', '.join(PULL_COLUMNS),
+                                             ', '.join(['%s'] * (len(PULL_COLUMNS) + 2))),
+                               [repo, num] + [pull.row[x] for x in PULL_COLUMNS])
+            elif pull.row or pull.fields:
+                fields = pull.row or pull.fields
+                cursor.execute('UPDATE pull SET {} WHERE repo = %s AND '
+                               'num = %s'.format(', '.join('{} = %s'.format(x)
+                                                           for x in fields)),
+                               list(fields.values()) + [repo, num])
+
+            if pull.mergeable is None:
+                cursor.execute('DELETE FROM mergeable WHERE repo = %s AND '
+                               'num = %s', [repo, num])
+            elif pull.mergeable is not UNSET:
+                cursor.execute('REPLACE INTO mergeable (repo, num, mergeable) '
+                               'VALUES (%s, %s, %s)',
+                               [repo, num, pull.mergeable])
+
+            if pull.build_res_reset:
+                cursor.execute('DELETE FROM build_res WHERE repo = %s AND '
+                               'num = %s', [repo, num])
+            for builder, (res, url, merge_sha) in pull.build_res.items():
+                cursor.execute('REPLACE INTO build_res (repo, num, builder, '
+                               'res, url, merge_sha) VALUES '
+                               '(%s, %s, %s, %s, %s, %s)',
+                               [repo, num, builder, res, url, merge_sha])
+
+        db_conn.commit()
+
+    def run_callbacks(self):
+        for callback in self.callbacks:
+            callback()
+
+
+class Database(object, metaclass=Singleton):
+    def __init__(self, cfg=None):
+        cfg = cfg or {}
+        self.logger = logging.getLogger('homu').getChild('database')
+
+        self.engine = ENGINES[cfg.get('engine', 'mysql')](cfg)
+
+        pool_cfg = {k: cfg[k] for k in ['pool_size', 'pool_timeout']
+                    if k in cfg}
+        pool_cfg.update(self.engine.pool_cfg)
+        self.pool = ConnectionPool(self.engine.connect, self.engine.check,
+                                   size=int(pool_cfg.get('pool_size', 5)),
+                                   timeout=float(pool_cfg.get('pool_timeout', 30)))
+
+        self.local = threading.local()
+
+        # With write_behind set, units of work are merged into a shared
+        # buffer that is flushed every write_behind seconds instead of being
+        # committed as soon as they finish.
+        self.write_behind = float(cfg.get('write_behind', 0))
+        self.behind = UnitOfWork()
+        self.behind_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        if self.write_behind:
+            threading.Thread(target=self.write_behind_loop,
+                             daemon=True).start()
 
     @contextmanager
     def get_connection(self):
-        def get_conn(attempt=0):
+        connection = self.pool.get_connection()
+        try:
+            yield connection
+        except:
+            try: connection.rollback()
+            except self.engine.Error: pass
+            raise
+        finally:
+            self.engine.release(connection)
+            self.pool.put_connection(connection)
+
+    def stats(self):
+        stats = {'pool': self.pool.stats()}
+        with self.behind_lock:
+            stats['write_behind'] = len(self.behind.pulls)
+        return stats
+
+    @contextmanager
+    def unit_of_work(self):
+        uow = getattr(self.local, 'uow', None)
+        if uow is not None:
+            yield uow
+            return
+
+        # The writes of a unit of work that fails are discarded, along with
+        # its callbacks.
+        uow = self.local.uow = UnitOfWork()
+        try:
+            yield uow
+        finally:
+            self.local.uow = None
+        if self.write_behind:
+            with self.behind_lock:
+                self.behind.merge(uow)
+        else:
+            self.commit(uow)
+
+    def commit(self, uow):
+        if uow.pulls:
+            with self.get_connection() as db_conn:
+                uow.flush(db_conn)
+        uow.run_callbacks()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.behind_lock:
+                uow, self.behind = self.behind, UnitOfWork()
+            try:
+                self.commit(uow)
+            except Exception:
+                # Keep the writes around so the next flush retries them.
+                with self.behind_lock:
+                    uow.merge(self.behind)
+                    self.behind = uow
+                raise
+
+    def write_behind_loop(self):
+        while True:
+            time.sleep(self.write_behind)
             try:
-                return self.pool.get_connection()
-            except PoolError:
-                if 20 > attempt:
-                    time.sleep(0.2)
-                    return get_conn(attempt + 1)
-                else:
-                    raise
-        connection = get_conn()
-        yield connection
-        # connection.close() will fail with an unread_result.
-        if connection._cnx.unread_result:
-            connection._cnx.get_rows()
-        connection.close()
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def init_schema(self):
+        schema_path = os.path.join(os.path.dirname(__file__),
+                                   self.engine.schema)
+        with open(schema_path) as f:
+            schema = f.read()
+
+        with self.get_connection() as db_conn:
+            self.engine.init_schema(db_conn, schema)
+
+    def get_pull(self, repo, num):
+        with self.get_connection() as db_conn:
+            cursor = db_conn.cursor()
+            cursor.execute('SELECT {} FROM pull WHERE repo = %s AND num = %s'
+                           .format(', '.join(PULL_COLUMNS)), [repo, num])
+            row = cursor.fetchone()
+
+        return dict(zip(PULL_COLUMNS, row)) if row else None
+
+    def get_pull_body(self, repo, num):
+        with self.get_connection() as db_conn:
+            cursor = db_conn.cursor()
+            cursor.execute('SELECT body FROM pull WHERE repo = %s AND '
+                           'num = %s', [repo, num])
+            row = cursor.fetchone()
+
+        return row[0] if row else None
+
+    def get_pull_status(self, repo, num):
+        with self.get_connection() as db_conn:
+            cursor = db_conn.cursor()
+            cursor.execute('SELECT status FROM pull WHERE repo = %s AND '
+                           'num = %s', [repo, num])
+            row = cursor.fetchone()
+
+        return row[0] if row else None
+
+    # The iter_* methods stream their rows rather than fetching whole tables.
+    # Bodies are left out, they are read on demand by get_pull_body.
+    def iter_pulls(self):
+        columns = ['repo', 'num'] + [x for x in PULL_COLUMNS if x != 'body']
+        with self.get_connection() as db_conn:
+            cursor = db_conn.cursor()
+            cursor.execute('SELECT {} FROM pull'.format(', '.join(columns)))
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def iter_build_res(self):
+        with self.get_connection() as db_conn:
+            cursor = db_conn.cursor()
+            cursor.execute('SELECT repo, num, builder, res, url, merge_sha '
+                           'FROM build_res')
+            return cursor.fetchall()
+
+    def iter_mergeable(self):
+        with self.get_connection() as db_conn:
+            cursor = db_conn.cursor()
+            cursor.execute('SELECT repo, num, mergeable FROM mergeable')
+            return cursor.fetchall()
+
+    def delete_orphans(self, repos, build_res_keys=()):
+        repos = list(repos)
+        repos_sql = ', '.join(['%s'] * len(repos)) or 'NULL'
+
+        with self.get_connection() as db_conn:
+            cursor = db_conn.cursor()
+            cursor.execute('DELETE FROM build_res WHERE repo NOT IN ({}) OR '
+                           'NOT EXISTS (SELECT 1 FROM pull WHERE '
+                           'pull.repo = build_res.repo AND '
+                           'pull.num = build_res.num AND '
+                           'pull.merge_sha = build_res.merge_sha)'
+                           .format(repos_sql), repos)
+            build_res_count = cursor.rowcount
+
+            if build_res_keys:
+                cursor.executemany('DELETE FROM build_res WHERE repo = %s AND '
+                                   'num = %s AND builder = %s',
+                                   list(build_res_keys))
+                build_res_count += len(build_res_keys)
+
+            cursor.execute('DELETE FROM mergeable WHERE repo NOT IN ({}) OR '
+                           'NOT EXISTS (SELECT 1 FROM pull WHERE '
+                           'pull.repo = mergeable.repo AND '
+                           'pull.num = mergeable.num)'.format(repos_sql),
+                           repos)
+            mergeable_count = cursor.rowcount
+
+            cursor.execute('DELETE FROM sync_cursors WHERE repo NOT IN ({})'
+                           .format(repos_sql), repos)
+            cursor.execute('DELETE FROM batches WHERE repo NOT IN ({})'
+                           .format(repos_sql), repos)
+            cursor.execute('DELETE FROM pipelines WHERE repo NOT IN ({})'
+                           .format(repos_sql), repos)
+
+            db_conn.commit()
+
+        return build_res_count, mergeable_count
+
+    def delete_repo(self, repo):
+        with self.get_connection() as db_conn:
+            for tbl in ['pull', 'build_res', 'mergeable', 'sync_cursors',
+                        'batches', 'pipelines']:
+                db_conn.cursor().execute('DELETE FROM {} WHERE repo = %s'
+                                         .format(tbl), [repo])
+            db_conn.commit()
+
+    # What synchronize saw of each pull request the last time, so that it can
+    # skip the ones that have not changed since.
+    def get_sync_cursors(self, repo):
+        with self.get_connection() as db_conn:
+            cursor = db_conn.cursor()
+            cursor.execute('SELECT num, updated_at, head_sha, '
+                           'issue_comment_id, review_comment_id '
+                           'FROM sync_cursors WHERE repo = %s', [repo])
+            return {row[0]: row[1:] for row in cursor}
+
+    def set_sync_cursor(self, repo, num, updated_at, head_sha,
+                        issue_comment_id, review_comment_id):
+        with self.get_connection() as db_conn:
+            db_conn.cursor().execute('REPLACE INTO sync_cursors (repo, num, '
+                                     'updated_at, head_sha, issue_comment_id, '
+                                     'review_comment_id) '
+                                     'VALUES (%s, %s, %s, %s, %s, %s)',
+                                     [repo, num, updated_at, head_sha,
+                                      issue_comment_id, review_comment_id])
+            db_conn.commit()
+
+    def delete_sync_cursors(self, repo, nums):
+        with self.get_connection() as db_conn:
+            db_conn.cursor().executemany('DELETE FROM sync_cursors WHERE '
+                                         'repo = %s AND num = %s',
+                                         [[repo, num] for num in nums])
+            db_conn.commit()
+
+    def save_batch(self, repo, base_ref, nums, landed, failing, testing):
+        with self.get_connection() as db_conn:
+            db_conn.cursor().execute('REPLACE INTO batches (repo, base_ref, '
+                                     'nums, landed, failing, testing) '
+                                     'VALUES (%s, %s, %s, %s, %s, %s)',
+                                     [repo, base_ref,
+                                      ' '.join(str(x) for x in nums), landed,
+                                      failing, testing])
+            db_conn.commit()
+
+    def delete_batch(self, repo, base_ref):
+        with self.get_connection() as db_conn:
+            db_conn.cursor().execute('DELETE FROM batches WHERE repo = %s '
+                                     'AND base_ref = %s', [repo, base_ref])
+            db_conn.commit()
+
+    def iter_batches(self):
+        with self.get_connection() as db_conn:
+            cursor = db_conn.cursor()
+            cursor.execute('SELECT repo, base_ref, nums, landed, failing, '
+                           'testing FROM batches')
+            return [(repo, base_ref, [int(x) for x in nums.split()], landed,
+                     failing, testing)
+                    for repo, base_ref, nums, landed, failing, testing
+                    in cursor.fetchall()]
+
+    def save_pipeline(self, repo, base_ref, nums):
+        with self.get_connection() as db_conn:
+            db_conn.cursor().execute('REPLACE INTO pipelines (repo, base_ref, '
+                                     'nums) VALUES (%s, %s, %s)',
+                                     [repo, base_ref,
+                                      ' '.join(str(x) for x in nums)])
+            db_conn.commit()
+
+    def delete_pipeline(self, repo, base_ref):
+        with self.get_connection() as db_conn:
+            db_conn.cursor().execute('DELETE FROM pipelines WHERE repo = %s '
+                                     'AND base_ref = %s', [repo, base_ref])
+            db_conn.commit()
+
+    def iter_pipelines(self):
+        with self.get_connection() as db_conn:
+            cursor = db_conn.cursor()
+            cursor.execute('SELECT repo, base_ref, nums FROM pipelines')
+            return [(repo, base_ref, [int(x) for x in nums.split()])
+                    for repo, base_ref, nums in cursor.fetchall()]
+
+    def add_build_trigger(self, branch, trigger_sha, target_sha, build_count):
+        with self.get_connection() as db_conn:
+            db_conn.cursor().execute('REPLACE INTO build_triggers '
+                                     '(branch, trigger_sha, target_sha, '
+                                     'build_count) VALUES (%s, %s, %s, %s)',
+                                     [branch, trigger_sha, target_sha,
+                                      build_count])
+            db_conn.commit()
+
+    def get_build_trigger(self, trigger_sha):
+        with self.get_connection() as db_conn:
+            cursor = db_conn.cursor()
+            cursor.execute('SELECT branch, target_sha, build_count '
+                           'FROM build_triggers WHERE trigger_sha = %s',
+                           [trigger_sha])
+            return cursor.fetchone()
+
+    def set_build_trigger_count(self, trigger_sha, build_count):
+        with self.get_connection() as db_conn:
+            db_conn.cursor().execute('UPDATE build_triggers SET '
+                                     'build_count = %s WHERE trigger_sha = %s',
+                                     [build_count, trigger_sha])
+            db_conn.commit()
+
+    def add_event(self, source, key, headers, payload, received_at):
+        with self.get_connection() as db_conn:
+            cursor = db_conn.cursor()
+            cursor.execute('INSERT INTO webhook_events (source, '
+                           'partition_key, headers, payload, received_at) '
+                           'VALUES (%s, %s, %s, %s, %s)',
+                           [source, key, headers, payload, received_at])
+            db_conn.commit()
+            return cursor.lastrowid
+
+    def iter_events(self):
+        with self.get_connection() as db_conn:
+            cursor = db_conn.cursor()
+            cursor.execute('SELECT id, source, partition_key, headers, '
+                           'payload, received_at FROM webhook_events '
+                           'ORDER BY id')
+            return cursor.fetchall()
+
+    def delete_event(self, event_id):
+        with self.get_connection() as db_conn:
+            db_conn.cursor().execute('DELETE FROM webhook_events WHERE id = %s',
+                                     [event_id])
+            db_conn.commit()
+
+    def add_delivery(self, delivery_id, received_at):
+        with self.get_connection() as db_conn:
+            db_conn.cursor().execute('REPLACE INTO webhook_deliveries '
+                                     '(delivery_id, received_at) '
+                                     'VALUES (%s, %s)',
+                                     [delivery_id, received_at])
+            db_conn.commit()
+
+    def delete_delivery(self, delivery_id):
+        with self.get_connection() as db_conn:
+            db_conn.cursor().execute('DELETE FROM webhook_deliveries '
+                                     'WHERE delivery_id = %s', [delivery_id])
+            db_conn.commit()
+
+    def iter_deliveries(self, since):
+        with self.get_connection() as db_conn:
+            cursor = db_conn.cursor()
+            cursor.execute('SELECT delivery_id, received_at '
+                           'FROM webhook_deliveries WHERE received_at >= %s '
+                           'ORDER BY received_at', [since])
+            return cursor.fetchall()
+
+    def delete_deliveries(self, before):
+        with self.get_connection() as db_conn:
+            db_conn.cursor().execute('DELETE FROM webhook_deliveries '
+                                     'WHERE received_at < %s', [before])
+            db_conn.commit()
 
     def close_all(self):
-        self.pool.reset_session()
+        self.flush()
+        self.pool.close()
@@ -0,0 +1,180 @@
+from collections import OrderedDict
+import json
+from queue import Queue
+import threading
+import time
+import traceback
+import zlib
+
+from .database import Database
+
+
+# Webhook payloads that have been acknowledged but not processed yet. Events
+# are stored in the database before they are acknowledged, so the ones still
+# queued when homu stops are processed after it restarts.
+#
+# Events with the same key are handled by the same worker in the order they
+# arrived, while different keys are spread over all the workers.
+class EventQueue:
+    def __init__(self, handler, workers, logger):
+        self.handler = handler
+        self.logger = logger
+        self.db = Database()
+
+        self.lock = threading.Lock()
+        self.depth = 0
+        self.processed = 0
+        self.failed = 0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.lag_total = 0.0
+
+        self.queues = [Queue() for _ in range(workers)]
+        for que in self.queues:
+            threading.Thread(target=self.work, args=[que], daemon=True).start()
+
+    def put(self, source, key, headers, payload):
+        received_at = time.time()
+        event_id = self.db.add_event(source, key, json.dumps(headers), payload,
+                                     received_at)
+        self.dispatch(event_id, source, key, headers, payload, received_at)
+
+    def replay(self):
+        events = list(self.db.iter_events())
+        for event_id, source, key, headers, payload, received_at in events:
+            self.dispatch(event_id, source, key, json.loads(headers), payload,
+                          received_at)
+
+        if events:
+            self.logger.info('Replaying {} queued events'.format(len(events)))
+
+    def dispatch(self, event_id, source, key, headers, payload, received_at):
+        que = self.queues[zlib.crc32(key.encode('utf-8')) % len(self.queues)]
+
+        with self.lock:
+            self.depth += 1
+        que.put([event_id, source, headers, payload, received_at])
+
+    def work(self, que):
+        while True:
+            event_id, source, headers, payload, received_at = que.get()
+
+            failed = False
+            try:
+                with self.db.unit_of_work():
+                    self.handler(source, headers, payload)
+            except Exception:
+                failed = True
+                self.logger.error('Failed to process {} event {}:\n{}'.format(
+                    source, event_id, traceback.format_exc()))
+
+            # Failed events are dropped too, retrying them would most likely
+            # fail the same way.
+            try:
+                self.db.delete_event(event_id)
+            except Exception:
+                traceback.print_exc()
+
+            lag = time.time() - received_at
+            with self.lock:
+                self.depth -= 1
+                self.processed += 1
+                self.failed += failed
+                self.lag_last = lag
+                self.lag_max = max(self.lag_max, lag)
+                self.lag_total += lag
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': len(self.queues),
+                'depth': self.depth,
+                'worker_depth': [x.qsize() for x in self.queues],
+                'processed': self.processed,
+                'failed': self.failed,
+                'lag_last': self.lag_last,
+                'lag_max': self.lag_max,
+                'lag_avg': self.lag_total / self.processed if self.processed else 0.0,
+            }
+
+
+# Deliveries that have already been handled, so that webhooks GitHub or a CI
+# server sends again are dropped instead of being handled twice. Deliveries
+# are forgotten after `ttl` seconds, or earlier once more than `size` of them
+# are remembered. With `persist`, they are also stored in the database and
+# remembered across restarts.
+class DeliveryCache:
+    def __init__(self, *, size=10000, ttl=3600, persist=False):
+        self.size = size
+        self.ttl = ttl
+        self.db = Database() if persist else None
+
+        self.lock = threading.Lock()
+        self.expiry = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.pruned_at = time.time()
+
+        if self.db:
+            for key, received_at in self.db.iter_deliveries(time.time() - ttl):
+                self.expiry[key] = received_at + ttl
+            self.evict(time.time())
+
+    def evict(self, now):
+        # Every delivery lives for the same time, so they expire in the order
+        # they were added.
+        while self.expiry:
+            key, expiry = next(iter(self.expiry.items()))
+            if expiry > now and len(self.expiry) <= self.size:
+                break
+            del self.expiry[key]
+
+    def seen(self, key):
+        with self.lock:
+            self.evict(time.time())
+            if key in self.expiry:
+                self.hits += 1
+                return True
+            return False
+
+    # Remembers the delivery. Returns False if it was already known, as when
+    # the same delivery arrives twice at once.
+    def add(self, key):
+        now = time.time()
+
+        with self.lock:
+            if key in self.expiry and self.expiry[key] > now:
+                self.hits += 1
+                return False
+            self.misses += 1
+            self.expiry.pop(key, None)
+            self.expiry[key] = now + self.ttl
+            self.evict(now)
+
+            prune = self.db and now - self.pruned_at > self.ttl
+            if prune:
+                self.pruned_at = now
+
+        if self.db:
+            self.db.add_delivery(key, now)
+            if prune:
+                self.db.delete_deliveries(now - self.ttl)
+
+        return True
+
+    # Forgets a delivery that could not be handled, so that it can be sent
+    # again.
+    def discard(self, key):
+        with self.lock:
+            self.expiry.pop(key, None)
+
+        if self.db:
+            self.db.delete_delivery(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.expiry),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,273 @@
+import base64
+from collections import namedtuple, OrderedDict
+from datetime import datetime, timezone
+import os
+import subprocess
+import threading
+
+# The result of a merge, in place of the github3 commit create_merge returns
+# when merging with the GitHub API.
+Commit = namedtuple('Commit', ['sha'])
+
+
+class GitError(Exception):
+    pass
+
+
+# The environment git authenticates to GitHub with token in. It is passed there
+# rather than in the URL or on the command line, so that it does not show up
+# in remotes, error messages or the process list.
+def auth_env(token):
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    if token:
+        auth = base64.b64encode('x-access-token:{}'.format(token)
+                                .encode('utf-8')).decode('ascii')
+        env.update({
+            'GIT_CONFIG_COUNT': '1',
+            'GIT_CONFIG_KEY_0': 'http.extraHeader',
+            'GIT_CONFIG_VALUE_0': 'Authorization: Basic ' + auth,
+        })
+    return env
+
+
+# A bare mirror of a GitHub repository that merges are computed in. Merge
+# commits are created with merge-tree and commit-tree without a work tree,
+# and the branches they are meant for are updated with a single push.
+class Mirror:
+    REFSPECS = ['+refs/heads/*:refs/heads/*', '+refs/pull/*/head:refs/pull/*/head']
+
+    def __init__(self, path, url, token='', cache_size=10000):
+        self.path = path
+        self.url = url
+        self.env = auth_env(token)
+
+        # Whether heads merge cleanly into bases, by (base_sha, head_sha).
+        self.cache_lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+        self.fetching = False
+        self.refetch = False
+
+    def git(self, *args, input=None, env=None, check=True):
+        res = subprocess.run(['git', '--git-dir', self.path] + list(args),
+                             input=input, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, env=env or self.env)
+        if check and res.returncode:
+            raise GitError('git {} failed: {}'.format(
+                args[0], res.stderr.decode('utf-8', 'replace').strip()))
+        return res
+
+    def output(self, *args, **kwargs):
+        return self.git(*args, **kwargs).stdout.decode('utf-8').strip()
+
+    # Clones the repository the first time it is used. Callers hold the lock.
+    def init(self):
+        if os.path.exists(self.path):
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.git('init', '--bare', '--quiet')
+        self.git('remote', 'add', 'origin', self.url)
+        self.git('config', '--unset-all', 'remote.origin.fetch')
+        for refspec in self.REFSPECS:
+            self.git('config', '--add', 'remote.origin.fetch', refspec)
+        self.fetch()
+
+    def fetch(self, *refspecs):
+        self.git('fetch', '--quiet', '--prune', 'origin', *refspecs)
+
+    # Fetches in the background, once more if it was asked for again while
+    # fetching.
+    def fetch_async(self):
+        with self.fetch_lock:
+            if self.fetching:
+                self.refetch = True
+                return
+            self.fetching = True
+
+        def run():
+            while True:
+                try:
+                    with self.lock:
+                        if os.path.exists(self.path):
+                            self.fetch()
+                        else:
+                            self.init()
+                except GitError:
+                    pass
+
+                with self.fetch_lock:
+                    if not self.refetch:
+                        self.fetching = False
+                        return
+                    self.refetch = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def has_commit(self, sha):
+        return self.git('cat-file', '-e', sha + '^{commit}',
+                        check=False).returncode == 0
+
+    # The latest commit of a branch, fetched from GitHub first.
+    def branch_sha(self, branch):
+        self.fetch('+refs/heads/{0}:refs/heads/{0}'.format(branch))
+        return self.output('rev-parse', 'refs/heads/' + branch)
+
+    # The latest commit of a branch, as the mirror knows it. The branch is
+    # fetched first if it does not contain sha, the commit it was just pushed
+    # to.
+    def base_sha(self, branch, sha=None):
+        ref = 'refs/heads/' + branch
+        if sha and self.git('merge-base', '--is-ancestor', sha, ref,
+                            check=False).returncode != 0:
+            return self.branch_sha(branch)
+        res = self.git('rev-parse', '--verify', '--quiet', ref, check=False)
+        if res.returncode:
+            return self.branch_sha(branch)
+        return res.stdout.decode('utf-8').strip()
+
+    def ensure_pull(self, num, sha):
+        if not self.has_commit(sha):
+            self.fetch('+refs/pull/{0}/head:refs/pull/{0}/head'.format(num))
+        if not self.has_commit(sha):
+            raise GitError('Commit {} of #{} not found'.format(sha, num))
+
+    def commit_tree(self, tree, parents, message, author):
+        env = dict(self.env)
+        date = datetime.now(timezone.utc).isoformat()
+        for role in ['AUTHOR', 'COMMITTER']:
+            env['GIT_{}_NAME'.format(role)] = author['name']
+            env['GIT_{}_EMAIL'.format(role)] = author['email']
+            env['GIT_{}_DATE'.format(role)] = date
+
+        args = ['commit-tree', tree]
+        for parent in parents:
+            args += ['-p', parent]
+        return self.output(*args, input=message.encode('utf-8'), env=env)
+
+    # The tree of head merged into base, or None if they conflict. Neither
+    # needs the lock, merge-tree only reads the commits and adds objects.
+    def merge_tree(self, base_sha, head_sha):
+        res = self.git('merge-tree', '--write-tree', '--no-messages',
+                       base_sha, head_sha, check=False)
+        if res.returncode > 1:
+            raise GitError('git merge-tree failed: {}'.format(
+                res.stderr.decode('utf-8', 'replace').strip()))
+
+        tree = res.stdout.decode('utf-8').splitlines()[0] \
+            if res.returncode == 0 else None
+        self.remember((base_sha, head_sha), tree is not None)
+        return tree
+
+    def remember(self, key, mergeable):
+        with self.cache_lock:
+            self.cache[key] = mergeable
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    # Whether head merges into base without conflicts.
+    def mergeable(self, base_sha, head_sha):
+        key = base_sha, head_sha
+        with self.cache_lock:
+            if key in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            self.misses += 1
+
+        return self.merge_tree(base_sha, head_sha) is not None
+
+    # Merges head into base. Returns the merge commit, or None if they
+    # conflict.
+    def merge(self, base_sha, head_sha, message, author):
+        tree = self.merge_tree(base_sha, head_sha)
+        if tree is None:
+            return None
+        return self.commit_tree(tree, [base_sha, head_sha], message, author)
+
+    # A commit on top of parent that adds a file, used to trigger builds.
+    def add_file(self, parent, path, content, message, author):
+        blob = self.output('hash-object', '-w', '--stdin', input=content)
+        entries = [x for x in self.output('ls-tree', parent).splitlines()
+                   if x.split('\t', 1)[1] != path]
+        entries.append('100644 blob {}\t{}'.format(blob, path))
+        tree = self.output('mktree', input='\n'.join(entries).encode('utf-8'))
+        return self.commit_tree(tree, [parent], message, author)
+
+    # Points branches at commits with one atomic push, to the mirrored
+    # repository or to url with token.
+    def push(self, branches, url=None, token=None):
+        refspecs = ['{}:refs/heads/{}'.format(sha, branch)
+                    for branch, sha in branches.items()]
+        if url:
+            self.git('push', '--quiet', '--atomic', '--force', url, *refspecs,
+                     env=auth_env(token))
+            return
+
+        self.git('push', '--quiet', '--atomic', '--force', 'origin', *refspecs)
+        for branch, sha in branches.items():
+            self.git('update-ref', 'refs/heads/' + branch, sha)
+
+
+# The mirrors of all repositories, kept under one directory. Disabled unless
+# the git section of the configuration enables it.
+class Mirrors:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.mirrors = {}
+
+    def configure(self, cfg):
+        git_cfg = cfg.get('git', {})
+        self.enabled = git_cfg.get('enabled', False)
+        self.path = git_cfg.get('path', 'git')
+        self.url = git_cfg.get('url', 'https://github.com/{owner}/{name}.git')
+        self.cache_size = git_cfg.get('mergeable_cache_size', 10000)
+        self.author = {
+            'name': git_cfg.get('author', {}).get('name', 'homu'),
+            'email': git_cfg.get('author', {}).get('email', 'homu@invalid'),
+        }
+        self.tokens = [cfg['github']['access_token']] + \
+            cfg['github'].get('access_tokens', [])
+
+    def url_for(self, owner, name):
+        return self.url.format(owner=owner, name=name)
+
+    def get(self, repo_cfg):
+        key = repo_cfg['owner'], repo_cfg['name']
+
+        with self.lock:
+            mirror = self.mirrors.get(key)
+            if not mirror:
+                credential = repo_cfg.get('github', {}).get('credential', 0)
+                mirror = self.mirrors[key] = Mirror(
+                    os.path.join(self.path, '{}/{}.git'.format(*key)),
+                    self.url_for(*key),
+                    self.tokens[credential],
+                    self.cache_size)
+        return mirror
+
+    def stats(self):
+        with self.lock:
+            mirrors = list(self.mirrors.values())
+
+        hits = sum(x.hits for x in mirrors)
+        misses = sum(x.misses for x in mirrors)
+        return {
+            'mirrors': len(mirrors),
+            'mergeable_cache': {
+                'count': sum(len(x.cache) for x in mirrors),
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            },
+        }
+
+
+mirrors = Mirrors()
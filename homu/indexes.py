@@ -0,0 +1,246 @@
+from bisect import bisect_left
+import sys
+from threading import Lock, RLock
+
+
+class MergeShaIndex:
+    def __init__(self):
+        self.lock = Lock()
+        self.states = {}
+
+    def update(self, state, old_sha, new_sha):
+        with self.lock:
+            if old_sha and self.states.get(old_sha) is state:
+                del self.states[old_sha]
+            if new_sha:
+                self.states[new_sha] = state
+
+    def discard(self, state):
+        self.update(state, state.merge_sha, '')
+
+    def find(self, sha):
+        with self.lock:
+            return self.states[sha]
+
+    def __len__(self):
+        return len(self.states)
+
+    def check(self, states):
+        errors = []
+
+        with self.lock:
+            indexed = dict(self.states)
+
+        for sha, state in indexed.items():
+            if state.merge_sha != sha:
+                errors.append('{!r} is indexed under {} but has merge_sha {}'
+                              .format(state, sha, state.merge_sha))
+
+        for repo_states in states.values():
+            for state in repo_states.values():
+                if state.merge_sha and indexed.get(state.merge_sha) is not state:
+                    errors.append('{!r} is missing from the index'.format(state))
+
+        if errors:
+            raise AssertionError('\n'.join(errors))
+
+
+merge_shas = MergeShaIndex()
+
+
+# An attribute of PullReqState stored in the slot of the same name prefixed
+# with an underscore. Strings are interned, as refs and user names repeat
+# across many pull requests.
+class Field:
+    def __init__(self, *, intern=False):
+        self.intern = intern
+
+    def __set_name__(self, owner, name):
+        self.attr = '_' + name
+
+    def __get__(self, state, owner=None):
+        if state is None:
+            return self
+        return getattr(state, self.attr)
+
+    def __set__(self, state, value):
+        if self.intern and isinstance(value, str):
+            value = sys.intern(value)
+        setattr(state, self.attr, value)
+
+
+# A field that takes part in the sort key. Assigning it moves the state to
+# its new position in the repository's queue.
+class SortField(Field):
+    def __set__(self, state, value):
+        super().__set__(state, value)
+        state.sort_key_changed()
+
+
+# A field the repository's states are looked up by, see RepoStates.find.
+class IndexedField(Field):
+    def __set__(self, state, value):
+        repo_states = state.repo_states
+        if repo_states is None:
+            super().__set__(state, value)
+            return
+
+        with repo_states.lock:
+            old_value = getattr(state, self.attr)
+            super().__set__(state, value)
+            repo_states.reindex(self.attr[1:], state, old_value,
+                                getattr(state, self.attr))
+
+
+# States ordered by their sort keys, kept in blocks of at most 2 * LOAD
+# entries. Finding a position is a binary search over the last keys of the
+# blocks and then within one block, and inserting or removing only shifts
+# that block, so neither grows with the number of states.
+class SortedStates:
+    LOAD = 256
+
+    def __init__(self):
+        self.keys = []
+        self.states = []
+        self.maxes = []
+
+    def insert(self, key, state):
+        if not self.maxes:
+            self.keys.append([key])
+            self.states.append([state])
+            self.maxes.append(key)
+            return
+
+        i = min(bisect_left(self.maxes, key), len(self.maxes) - 1)
+        keys, states = self.keys[i], self.states[i]
+        j = bisect_left(keys, key)
+        keys.insert(j, key)
+        states.insert(j, state)
+        self.maxes[i] = keys[-1]
+
+        if len(keys) > 2 * self.LOAD:
+            self.keys[i:i + 1] = [keys[:self.LOAD], keys[self.LOAD:]]
+            self.states[i:i + 1] = [states[:self.LOAD], states[self.LOAD:]]
+            self.maxes[i:i + 1] = [keys[self.LOAD - 1], keys[-1]]
+
+    def remove(self, key, state):
+        i = bisect_left(self.maxes, key)
+        while i < len(self.maxes):
+            keys, states = self.keys[i], self.states[i]
+            j = bisect_left(keys, key)
+            while j < len(keys) and keys[j] == key:
+                if states[j] is state:
+                    del keys[j]
+                    del states[j]
+                    if keys:
+                        self.maxes[i] = keys[-1]
+                    else:
+                        del self.keys[i]
+                        del self.states[i]
+                        del self.maxes[i]
+                    return
+                j += 1
+            if j < len(keys):
+                return
+            i += 1
+
+    def __iter__(self):
+        for states in self.states:
+            yield from states
+
+    def __len__(self):
+        return sum(len(x) for x in self.states)
+
+
+# The states of one repository, keyed by pull request number, that also keeps
+# them ordered by their cached sort keys in a SortedStates. A state whose sort
+# key changes is moved instead of re-sorting the whole repository.
+#
+# States are also indexed by their base ref and head SHA, so that a push only
+# has to visit the pull requests it affects.
+class RepoStates(dict):
+    INDEXES = ['base_ref', 'head_sha']
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.lock = RLock()
+        self.sorted_states = SortedStates()
+        self.indexes = {x: {} for x in self.INDEXES}
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, num, state):
+        with self.lock:
+            self.pop(num, None)
+            super().__setitem__(num, state)
+            state.repo_states = self
+            self.insert(state)
+            self.index(state)
+
+    def __delitem__(self, num):
+        self.pop(num)
+
+    def pop(self, num, *default):
+        with self.lock:
+            if num not in self:
+                if default:
+                    return default[0]
+                raise KeyError(num)
+            state = super().pop(num)
+            self.remove(state, state.cached_sort_key)
+            self.unindex(state)
+            state.repo_states = None
+            return state
+
+    def update(self, *args, **kwargs):
+        for num, state in dict(*args, **kwargs).items():
+            self[num] = state
+
+    def clear(self):
+        for num in list(self):
+            self.pop(num)
+
+    def reindex(self, field, state, old_value, new_value):
+        index = self.indexes[field]
+
+        states = index.get(old_value)
+        if states is not None:
+            states.discard(state)
+            if not states:
+                del index[old_value]
+
+        index.setdefault(new_value, set()).add(state)
+
+    def find(self, field, value):
+        with self.lock:
+            return list(self.indexes[field].get(value, ()))
+
+    def index(self, state):
+        for field, index in self.indexes.items():
+            index.setdefault(getattr(state, field), set()).add(state)
+
+    def unindex(self, state):
+        for field, index in self.indexes.items():
+            value = getattr(state, field)
+            states = index.get(value)
+            if states is not None:
+                states.discard(state)
+                if not states:
+                    del index[value]
+
+    def insert(self, state):
+        self.sorted_states.insert(state.cached_sort_key, state)
+
+    def remove(self, state, key):
+        self.sorted_states.remove(key, state)
+
+    def reposition(self, state, update_key):
+        with self.lock:
+            old_key = state.cached_sort_key
+            update_key()
+            if state.cached_sort_key != old_key:
+                self.remove(state, old_key)
+                self.insert(state)
+
+    def ordered(self):
+        with self.lock:
+            return list(self.sorted_states)
@@ -1,11 +1,20 @@
 import argparse
+from collections import Counter, OrderedDict, deque
 from datetime import datetime, timezone
 import github3
 import os
+import sys
 import toml
 import json
 import re
+from .batches import Batch, Pipeline, batches, release
 from .database import Database
+from .indexes import merge_shas, RepoStates, Field, IndexedField, SortField
+from .mergeability import MergeabilityQueue
+from .slots import SlotScheduler, build_pools
+from . import api
+from . import git
+from . import sync
 from . import utils
 import logging
 from threading import Thread, Lock
@@ -15,7 +24,6 @@ import requests
 from contextlib import contextmanager
 from functools import partial
 from itertools import chain
-from queue import Queue
 import signal
 
 STATUS_TO_PRIORITY = {
@@ -43,31 +51,92 @@ def buildbot_sess(repo_cfg):
 
     sess.get(repo_cfg['buildbot']['url'] + '/logout', allow_redirects=False)
 
+# Shared by every PullReqState of a repository, so that each state only
+# stores a single reference to it.
+class RepoContext:
+    __slots__ = ['repo_label', 'owner', 'name', 'mergeable_que', 'gh', 'repos']
+
+    contexts = {}
+    lock = Lock()
+
+    @classmethod
+    def get(cls, repo_label, owner, name, mergeable_que, gh, repos):
+        with cls.lock:
+            ctx = cls.contexts.get(repo_label)
+            if not ctx or (ctx.owner, ctx.name) != (owner, name) or \
+                    ctx.mergeable_que is not mergeable_que or \
+                    ctx.gh is not gh or ctx.repos is not repos:
+                ctx = cls.contexts[repo_label] = cls()
+                ctx.repo_label = sys.intern(repo_label)
+                ctx.owner = sys.intern(owner)
+                ctx.name = sys.intern(name)
+                ctx.mergeable_que = mergeable_que
+                ctx.gh = gh
+                ctx.repos = repos
+            return ctx
+
+def context_property(name):
+    return property(lambda state: getattr(state.ctx, name))
+
+# Marks a body that is not held in memory and has to be read from the
+# database.
+UNLOADED = object()
+
 class PullReqState:
-    num = 0
-    priority = 0
-    rollup = False
-    title = ''
-    body = ''
-    head_ref = ''
-    base_ref = ''
-    assignee = ''
+    __slots__ = ['ctx', '_num', '_priority', '_rollup', '_status',
+                 '_approved_by', '_mergeable', '_merge_sha', '_head_ref',
+                 '_base_ref', '_assignee', '_body', '_body_hash', 'title',
+                 '_head_sha',
+                 'build_res', 'try_', 'try_by', 'cached_sort_key',
+                 'repo_states', 'interrupt_token']
+
+    num = SortField()
+    priority = SortField()
+    rollup = SortField()
+    status = SortField()
+    approved_by = SortField(intern=True)
+    mergeable = SortField()
+    head_ref = Field(intern=True)
+    base_ref = IndexedField(intern=True)
+    head_sha = IndexedField()
+    assignee = Field(intern=True)
+
+    repo_label = context_property('repo_label')
+    owner = context_property('owner')
+    name = context_property('name')
+    mergeable_que = context_property('mergeable_que')
+    gh = context_property('gh')
+    repos = context_property('repos')
+
+    db = property(lambda state: Database())
 
     def __init__(self, num, head_sha, status, repo_label, mergeable_que, gh,
                  owner, name, repos):
+        self.ctx = RepoContext.get(repo_label, owner, name, mergeable_que, gh,
+                                   repos)
+
+        self._num = num
+        self._priority = 0
+        self._rollup = False
+        self._status = ''
+        self._approved_by = ''
+        self._mergeable = None
+        self._merge_sha = ''
+        self._head_ref = ''
+        self._base_ref = ''
+        self._assignee = ''
+        self._head_sha = ''
+        self._body = UNLOADED
+        self._body_hash = None
+        self.title = ''
+        self.cached_sort_key = None
+        self.repo_states = None
+        self.interrupt_token = ''
+
         self.head_advanced('', use_db=False)
 
-        self.num = num
         self.head_sha = head_sha
         self.status = status
-        self.repo_label = repo_label
-        self.mergeable_que = mergeable_que
-        self.gh = gh
-        self.owner = owner
-        self.name = name
-        self.repos = repos
-
-        self.db = Database()
 
     def head_advanced(self, head_sha, *, use_db=True):
         self.head_sha = head_sha
@@ -76,6 +145,7 @@ class PullReqState:
         self.merge_sha = ''
         self.build_res = {}
         self.try_ = False
+        self.try_by = ''
         self.mergeable = None
 
         if use_db:
@@ -83,6 +153,43 @@ class PullReqState:
             self.set_mergeable(None)
             self.init_build_res([])
 
+    # The body is written through to the database and only kept in memory
+    # until that write is committed. Its hash is kept instead, so that
+    # body_changed doesn't have to read it back.
+    @property
+    def body(self):
+        body = self._body
+        if body is UNLOADED:
+            body = self.db.get_pull_body(self.repo_label, self.num)
+            self._body_hash = hash(body)
+        return body
+
+    @body.setter
+    def body(self, body):
+        self._body = body
+        self._body_hash = hash(body)
+
+        with self.db.unit_of_work() as uow:
+            uow.update_pull(self.repo_label, self.num, body=body)
+            uow.on_commit(partial(self.release_body, body))
+
+    def release_body(self, body):
+        if self._body is body:
+            self._body = UNLOADED
+
+    # A body whose hash isn't known, as after a restart, counts as changed.
+    def body_changed(self, body):
+        return self._body_hash is None or hash(body) != self._body_hash
+
+    @property
+    def merge_sha(self):
+        return self._merge_sha
+
+    @merge_sha.setter
+    def merge_sha(self, sha):
+        merge_shas.update(self, self._merge_sha, sha)
+        self._merge_sha = sha
+
     def __repr__(self):
         return 'PullReqState:{}/{}#{}(approved_by={}, priority={}, status={})'.format(
             self.owner,
@@ -103,55 +210,50 @@ class PullReqState:
             self.num,
         ]
 
+    def sort_key_changed(self):
+        if self.repo_states is not None:
+            self.repo_states.reposition(self, self.update_sort_key)
+        else:
+            self.update_sort_key()
+
+    def update_sort_key(self):
+        self.cached_sort_key = tuple(self.sort_key())
+
     def __lt__(self, other):
-        return self.sort_key() < other.sort_key()
+        return self.cached_sort_key < other.cached_sort_key
 
     def add_comment(self, text):
-        issue = getattr(self, 'issue', None)
-        if not issue:
-            issue = self.issue = self.get_repo().issue(self.num)
-
-        issue.create_comment(text)
+        utils.github_create_comment(self.get_repo(), self.num, text)
 
     def set_status(self, status):
         self.status = status
 
-        sql = 'UPDATE pull SET status = %s WHERE repo = %s AND num = %s'
-        with self.db.get_connection() as db_conn:
-            db_conn.cursor().execute(sql, [self.status, self.repo_label,
-                                           self.num])
-            db_conn.commit()
+        fields = {'status': self.status}
+        # FIXME: self.try_ should also be saved in the database
+        if not self.try_:
+            fields['merge_sha'] = self.merge_sha
 
-            # FIXME: self.try_ should also be saved in the database
-            if not self.try_:
-                sql = 'UPDATE pull SET merge_sha = %s WHERE repo = %s AND num = %s'
-                db_conn.cursor().execute(sql, [self.merge_sha, self.repo_label,
-                                               self.num])
-                db_conn.commit()
+        with self.db.unit_of_work() as uow:
+            uow.update_pull(self.repo_label, self.num, **fields)
 
     def get_status(self):
         return 'approved' if self.status == '' and self.approved_by and self.mergeable is not False else self.status
 
     def set_mergeable(self, mergeable, *, cause=None, que=True):
-        if mergeable is not None:
-            self.mergeable = mergeable
-
-            sql = 'REPLACE INTO mergeable (repo, num, mergeable) ' \
-                  'VALUES (%s, %s, %s)'
-            with self.db.get_connection() as db_conn:
-                db_conn.cursor().execute(sql, [self.repo_label, self.num,
-                                               self.mergeable])
-                db_conn.commit()
-        else:
-            if que:
-                self.mergeable_que.put([self, cause])
+        with self.db.unit_of_work() as uow:
+            if mergeable is not None:
+                self.mergeable = mergeable
+
+                uow.set_mergeable(self.repo_label, self.num, self.mergeable)
             else:
-                self.mergeable = None
+                if que:
+                    # Queue only once the DELETE below is committed, so that
+                    # a fast mergeability check cannot be overwritten by it.
+                    uow.on_commit(partial(self.mergeable_que.put, self, cause))
+                else:
+                    self.mergeable = None
 
-            with self.db.get_connection() as db_conn:
-                sql = 'DELETE FROM mergeable WHERE repo = %s AND num = %s'
-                db_conn.cursor().execute(sql, [self.repo_label, self.num])
-                db_conn.commit()
+                uow.set_mergeable(self.repo_label, self.num, None)
 
     def init_build_res(self, builders, *, use_db=True):
         self.build_res = {x: {
@@ -160,10 +262,8 @@ class PullReqState:
         } for x in builders}
 
         if use_db:
-            with self.db.get_connection() as db_conn:
-                sql = 'DELETE FROM build_res WHERE repo = %s AND num = %s'
-                db_conn.cursor().execute(sql, [self.repo_label, self.num])
-                db_conn.commit()
+            with self.db.unit_of_work() as uow:
+                uow.reset_build_res(self.repo_label, self.num)
 
     def set_build_res(self, builder, res, url):
         if builder not in self.build_res:
@@ -174,14 +274,9 @@ class PullReqState:
             'url': url,
         }
 
-        with self.db.get_connection() as db_conn:
-            db_conn.cursor().execute('REPLACE INTO build_res ' \
-                                     '(repo, num, builder, res, url, ' \
-                                     'merge_sha) VALUES ' \
-                                     '(%s, %s, %s, %s, %s, %s)',
-                                     [self.repo_label, self.num, builder, res,
-                                      url, self.merge_sha])
-            db_conn.commit()
+        with self.db.unit_of_work() as uow:
+            uow.set_build_res(self.repo_label, self.num, builder, res, url,
+                              self.merge_sha)
 
     def build_res_summary(self):
         return ', '.join('{}: {}'.format(builder, data['res'])
@@ -197,40 +292,40 @@ class PullReqState:
         return repo
 
     def save(self, logger=None):
-        with self.db.get_connection() as db_conn:
-            if logger:
-                sql = 'SELECT repo, num, status, merge_sha, title, body, head_sha, head_ref, base_ref, assignee, approved_by, priority, try_, rollup FROM pull WHERE num = %s' #XXX
-                cursor = db_conn.cursor()
-                cursor.execute(sql, [self.num]) #XXX
-                for (repo, num, status, merge_sha, title, body, head_sha, head_ref, base_ref, assignee, approved_by, priority, try_, rollup) in cursor.fetchall(): #XXX
-                    logger.debug('PullReqState save changes: ' + #XXX
-                                 'num: {} to {}; '.format(num, self.num) + #XXX
-                                 'status: {} to {}; '.format(status, self.status) + #XXX
-                                 'merge_sha: {} to {}; '.format(merge_sha, self.merge_sha) + #XXX
-                                 'title: {} to {}; '.format(title, self.title) + #XXX
-                                 'head_sha: {} to {}; '.format(head_sha, self.head_sha) + #XXX
-                                 'head_ref: {} to {}; '.format(head_ref, self.head_ref) + #XXX
-                                 'base_ref: {} to {}; '.format(base_ref, self.base_ref) + #XXX
-                                 'priority: {} to {}; '.format(priority, self.priority)) #XXX
-            db_conn.cursor().execute('REPLACE INTO pull ' \
-                                     '(repo, num, status, merge_sha, title, ' \
-                                     'body, head_sha, head_ref, base_ref, ' \
-                                     'assignee, approved_by, priority, ' \
-                                     'try_, rollup) VALUES (%s, %s, %s, %s, ' \
-                                     '%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)',
-                                     [self.repo_label, self.num, self.status,
-                                      self.merge_sha, self.title, self.body,
-                                      self.head_sha, self.head_ref,
-                                      self.base_ref, self.assignee,
-                                      self.approved_by, self.priority,
-                                      self.try_, self.rollup])
-            db_conn.commit()
+        if logger:
+            row = self.db.get_pull(self.repo_label, self.num)
+            if row:
+                logger.debug('PullReqState save changes: ' +
+                             'num: {}; '.format(self.num) +
+                             'status: {} to {}; '.format(row['status'], self.status) +
+                             'merge_sha: {} to {}; '.format(row['merge_sha'], self.merge_sha) +
+                             'title: {} to {}; '.format(row['title'], self.title) +
+                             'head_sha: {} to {}; '.format(row['head_sha'], self.head_sha) +
+                             'head_ref: {} to {}; '.format(row['head_ref'], self.head_ref) +
+                             'base_ref: {} to {}; '.format(row['base_ref'], self.base_ref) +
+                             'priority: {} to {}; '.format(row['priority'], self.priority))
+
+        with self.db.unit_of_work() as uow:
+            uow.save_pull(self.repo_label, self.num, {
+                'status': self.status,
+                'merge_sha': self.merge_sha,
+                'title': self.title,
+                'head_sha': self.head_sha,
+                'head_ref': self.head_ref,
+                'base_ref': self.base_ref,
+                'assignee': self.assignee,
+                'approved_by': self.approved_by,
+                'priority': self.priority,
+                'try_': self.try_,
+                'rollup': self.rollup,
+            })
 
     def refresh(self):
         issue = self.get_repo().issue(self.num)
 
         self.title = issue.title
-        self.body = issue.body
+        if self.body_changed(issue.body):
+            self.body = issue.body
 
 def sha_cmp(short, full):
     return len(short) >= 4 and short == full[:len(short)]
@@ -263,6 +358,11 @@ def parse_commands(body, username, repo_cfg, state, my_username, *,
                 state.approved_by = approver
 
                 state.save()
+
+                # Approved pull requests are about to be built, and need to
+                # be known to be mergeable.
+                with state.db.unit_of_work() as uow:
+                    uow.on_commit(partial(state.mergeable_que.refresh, [state]))
             elif realtime and username != my_username:
                 if cur_sha:
                     msg = '`{}` is not a valid commit SHA.'.format(cur_sha)
@@ -287,6 +387,9 @@ def parse_commands(body, username, repo_cfg, state, my_username, *,
 
         elif word in ['try', 'try-'] and realtime:
             state.try_ = word == 'try'
+            # Only kept in memory: try builds loaded from the database are
+            # scheduled as if asked for by the same anonymous requester.
+            state.try_by = username if state.try_ else ''
 
             state.merge_sha = ''
             state.init_build_res([])
@@ -334,45 +437,116 @@ def parse_commands(body, username, repo_cfg, state, my_username, *,
 
     return state_changed
 
-def create_merge(state, repo_cfg, trigger_author_cfg, branch, gh):
-    def report_error(desc):
-        state.set_status('error')
-        utils.github_create_status(state.get_repo(), state.head_sha, 'error',
-                                   '', desc[:140], context='merge-test')
-        state.add_comment(':x: {}'.format(desc))
-
-    base_sha = state.get_repo().ref('heads/' + state.base_ref).object.sha
-    utils.github_set_ref(
-        state.get_repo(),
-        'heads/' + branch,
-        base_sha,
-        force=True,
-    )
-
-    state.refresh()
-
-    merge_msg = 'Auto merge of #{} - {}, r={}\n\n{}'.format(
+def merge_message(state):
+    return 'Auto merge of #{} - {}, r={}\n\n{}'.format(
         state.num,
         state.head_ref,
         '<try>' if state.try_ else state.approved_by,
         state.title)
-    try: merge_commit = state.get_repo().merge(branch, state.head_sha, merge_msg)
-    except github3.models.GitHubError as e:
-        if e.code != 409: raise
-        report_error('Merge conflict')
+
+def build_count(repo_cfg):
+    try:
+        return len(repo_cfg['testrunners']['builders'])
+    except KeyError:
+        return 0
+
+def report_merge_error(state, desc):
+    state.set_status('error')
+    utils.github_create_status(state.get_repo(), state.head_sha, 'error',
+                               '', desc[:140], context='merge-test')
+    state.add_comment(':x: {}'.format(desc))
+
+# The branch a build is started on and the builders that report on it.
+def build_target(repo_cfg, base_ref, try_):
+    if 'buildbot' in repo_cfg:
+        branch = 'try' if try_ else 'auto'
+        branch = repo_cfg.get('branch', {}).get(branch, branch)
+        builders = repo_cfg['buildbot']['try_builders' if try_ else 'builders']
+    elif 'travis' in repo_cfg:
+        branch = repo_cfg.get('branch', {}).get('auto', 'auto')
+        builders = ['travis']
+    elif 'status' in repo_cfg:
+        branch = repo_cfg.get('branch', {}).get('auto', 'auto')
+        builders = ['status']
+    elif 'testrunners' in repo_cfg:
+        branch = 'merge_bot_{}'.format(base_ref)
+        builders = repo_cfg['testrunners'].get('builders', [])
+    else:
+        raise RuntimeError('Invalid configuration')
+
+    return branch, builders
+
+# Pushes a commit on top of sha to a branch of its own in the mirror, together
+# with branch itself, and opens the build trigger pull request for it. Returns
+# False if nothing could be pushed.
+def create_git_trigger(state, repo_cfg, trigger_author_cfg, branch, sha,
+                       message):
+    mirror = git.mirrors.get(repo_cfg)
+    trigger_author = {'name': trigger_author_cfg.get('name', 'homu'),
+                      'email': trigger_author_cfg.get('email', 'homu@invalid')}
+    pr_branch_name = '{}_build_trigger_{}'.format(branch, sha)
+
+    with mirror.lock:
+        try:
+            trigger_sha = mirror.add_file(sha, 'zero', b'0', message,
+                                          trigger_author)
+            mirror.push({branch: sha, pr_branch_name: trigger_sha})
+        except git.GitError as e:
+            report_merge_error(state, str(e))
+            return False
+
+    try:
+        state.get_repo().create_pull(title=message, base=branch,
+                                     head=pr_branch_name)
+    except github3.models.GitHubError as e0:
+        for e1 in e0.errors:
+            report_merge_error(state, e1['message'])
+        report_merge_error(state, 'Failed to create pull.')
+    else:
+        Database().add_build_trigger(pr_branch_name, trigger_sha, sha,
+                                     build_count(repo_cfg))
+
+    return True
+
+# Merges the pull request in the repository's mirror instead of with the
+# GitHub API. The merge and its build trigger commit are pushed together, so
+# the trigger pull request can be opened right away.
+def create_git_merge(state, repo_cfg, trigger_author_cfg, branch):
+    mirror = git.mirrors.get(repo_cfg)
+    merge_msg = merge_message(state)
+
+    with mirror.lock:
+        try:
+            mirror.init()
+            base_sha = mirror.branch_sha(state.base_ref)
+            mirror.ensure_pull(state.num, state.head_sha)
+
+            merge_sha = mirror.merge(base_sha, state.head_sha, merge_msg,
+                                     git.mirrors.author)
+        except git.GitError as e:
+            report_merge_error(state, str(e))
+            return None
+
+    if not merge_sha:
+        report_merge_error(state, 'Merge conflict')
         return None
 
-    # Solano's CI Mode can be set either to PR or ON. In ON mode, it
-    # builds on every branch update, which means it gets triggered on
-    # the above call to github_set_ref. We must therefore issue a PR on
-    # the merge node, in order to only trigger Solano to build on the
-    # intended node.
+    if not create_git_trigger(state, repo_cfg, trigger_author_cfg, branch,
+                              merge_sha, 'Build trigger for {}'.format(merge_msg)):
+        return None
+
+    return git.Commit(merge_sha)
+
+# Solano's CI Mode can be set either to PR or ON. In ON mode, it builds on
+# every branch update, which means it gets triggered when the merge is made.
+# We must therefore issue a PR on the merge node, in order to only trigger
+# Solano to build on the intended node.
+def create_trigger(state, repo_cfg, trigger_author_cfg, branch, sha, message):
     db = Database()
-    message = 'Build trigger for {}'.format(merge_msg)
-    pr_branch_name = '{}_build_trigger_{}'.format(branch, merge_commit.sha)
+    pr_branch_name = '{}_build_trigger_{}'.format(branch, sha)
     pr_branch = utils.github_set_ref(repo=state.get_repo(),
                                      ref='heads/{}'.format(pr_branch_name),
-                                     sha=merge_commit.sha,
+                                     sha=sha,
                                      force=True)
     if pr_branch:
         author = {'name': trigger_author_cfg.get('name', 'homu'),
@@ -393,66 +567,81 @@ def create_merge(state, repo_cfg, trigger_author_cfg, branch, gh):
                                                   head=pr_branch_name)
             except github3.models.GitHubError as e0:
                 for e1 in e0.errors:
-                    report_error(e1['message'])
+                    report_merge_error(state, e1['message'])
                 pr = None
             if pr:
-                with db.get_connection() as db_conn:
-                    try:
-                        build_count = len(repo_cfg['testrunners']['builders'])
-                    except KeyError:
-                        build_count = 0
-                    sql = 'REPLACE INTO build_triggers ' \
-                          '(branch, trigger_sha, target_sha, build_count) ' \
-                          'VALUES (%s, %s, %s, %s)'
-                    db_conn.cursor().execute(sql, [pr_branch_name,
-                                                   commit.sha,
-                                                   merge_commit.sha,
-                                                   build_count])
-                    db_conn.commit()
+                db.add_build_trigger(pr_branch_name, commit.sha, sha,
+                                     build_count(repo_cfg))
             else:
-                report_error('Failed to create pull.')
+                report_merge_error(state, 'Failed to create pull.')
         else:
-            report_error('Failed to create commit.')
+            report_merge_error(state, 'Failed to create commit.')
     else:
-        report_error('Failed to create PR branch.')
+        report_merge_error(state, 'Failed to create PR branch.')
 
-    return merge_commit
+def create_merge(state, repo_cfg, trigger_author_cfg, branch, gh):
+    if git.mirrors.enabled:
+        return create_git_merge(state, repo_cfg, trigger_author_cfg, branch)
 
-def start_build(state, repo_cfgs, trigger_author_cfg, buildbot_slots, logger, gh):
-    if buildbot_slots[0]:
-        return True
+    base_sha = state.get_repo().ref('heads/' + state.base_ref).object.sha
+    utils.github_set_ref(
+        state.get_repo(),
+        'heads/' + branch,
+        base_sha,
+        force=True,
+    )
 
-    assert state.head_sha == state.get_repo().pull_request(state.num).head.sha
+    state.refresh()
 
-    repo_cfg = repo_cfgs[state.repo_label]
+    merge_msg = merge_message(state)
+    try: merge_commit = state.get_repo().merge(branch, state.head_sha, merge_msg)
+    except github3.models.GitHubError as e:
+        if e.code != 409: raise
+        report_merge_error(state, 'Merge conflict')
+        return None
 
-    if 'buildbot' in repo_cfg:
-        branch = 'try' if state.try_ else 'auto'
-        branch = repo_cfg.get('branch', {}).get(branch, branch)
-        builders = repo_cfg['buildbot']['try_builders' if state.try_ else 'builders']
-    elif 'travis' in repo_cfg:
-        branch = repo_cfg.get('branch', {}).get('auto', 'auto')
-        builders = ['travis']
-    elif 'status' in repo_cfg:
-        branch = repo_cfg.get('branch', {}).get('auto', 'auto')
-        builders = ['status']
-    elif 'testrunners' in repo_cfg:
-        branch = 'merge_bot_{}'.format(state.base_ref)
-        builders = repo_cfg['testrunners'].get('builders', [])
+    create_trigger(state, repo_cfg, trigger_author_cfg, branch,
+                   merge_commit.sha, 'Build trigger for {}'.format(merge_msg))
+
+    return merge_commit
+
+def set_build_status(state, repo_cfg, builders, desc):
+    github_create_status = partial(utils.github_create_status,
+                                   repo=state.get_repo(),
+                                   sha=state.head_sha,
+                                   state='pending',
+                                   description=desc)
+    if 'testrunners' in repo_cfg:
+        for builder in builders:
+            github_create_status(context='merge-test/{}'.format(builder))
     else:
-        raise RuntimeError('Invalid configuration')
+        github_create_status(context='homu')
 
-    merge_commit = create_merge(state, repo_cfg, trigger_author_cfg, branch, gh)
-    if not merge_commit:
-        return False
+def start_build(state, repo_cfgs, trigger_author_cfg, slots, logger, gh):
+    repo_cfg = repo_cfgs[state.repo_label]
+    branch, builders = build_target(repo_cfg, state.base_ref, state.try_)
 
-    state.init_build_res(builders)
-    state.merge_sha = merge_commit.sha
+    slot = slots.reserve(state.repo_label,
+                         build_pools(repo_cfg, builders, state.try_),
+                         state.priority)
+    if not slot:
+        return True
 
-    state.save()
+    try:
+        assert state.head_sha == state.get_repo().pull_request(state.num).head.sha
 
-    if 'buildbot' in repo_cfg:
-        buildbot_slots[0] = state.merge_sha
+        merge_commit = create_merge(state, repo_cfg, trigger_author_cfg, branch, gh)
+        if not merge_commit:
+            return False
+
+        state.init_build_res(builders)
+        state.merge_sha = merge_commit.sha
+
+        state.save()
+
+        slots.bind(slot, state.merge_sha)
+    finally:
+        slots.cancel(slot)
 
     pr_url = state.get_repo().pull_request(state.num).html_url
     msg = 'Starting build of {}/{}#{} on {}: {} {}'.format(state.owner,
@@ -465,21 +654,329 @@ def start_build(state, repo_cfgs, trigger_author_cfg, buildbot_slots, logger, gh
 
     state.set_status('pending')
     desc = '{} commit {:.7} with merge {:.7}...'.format('Trying' if state.try_ else 'Testing', state.head_sha, state.merge_sha)
-    github_create_status = partial(utils.github_create_status,
-                                   repo=state.get_repo(),
-                                   sha=state.head_sha,
-                                   state='pending',
-                                   description=desc)
-    if 'testrunners' in repo_cfg:
-        for builder in builders:
-            github_create_status(context='merge-test/{}'.format(builder))
-    else:
-        github_create_status(context='homu')
+    set_build_status(state, repo_cfg, builders, desc)
 
     state.add_comment(':hourglass: ' + desc)
 
     return True
 
+# Merges the pull requests on top of each other, starting from base_sha or the
+# base branch, on a branch of their own so that no build is started for them
+# yet. Pull requests that conflict are left out. Returns the ones that were
+# merged, with their merge_sha set.
+def create_batch_merges(states, repo_cfg, branch, base_sha=None):
+    merged = []
+
+    if git.mirrors.enabled:
+        mirror = git.mirrors.get(repo_cfg)
+        with mirror.lock:
+            state = states[0]
+            try:
+                mirror.init()
+                sha = base_sha or mirror.branch_sha(state.base_ref)
+                for state in states:
+                    mirror.ensure_pull(state.num, state.head_sha)
+                    merge_sha = mirror.merge(sha, state.head_sha,
+                                             merge_message(state),
+                                             git.mirrors.author)
+                    if merge_sha:
+                        state.merge_sha = sha = merge_sha
+                        merged.append(state)
+                    else:
+                        report_merge_error(state, 'Merge conflict')
+            except git.GitError as e:
+                report_merge_error(state, str(e))
+
+        return merged
+
+    repo = states[0].get_repo()
+    batch_branch = '{}_batch'.format(branch)
+    if not base_sha:
+        base_sha = repo.ref('heads/' + states[0].base_ref).object.sha
+    utils.github_set_ref(repo, 'heads/' + batch_branch, base_sha, force=True)
+
+    for state in states:
+        try: merge_commit = repo.merge(batch_branch, state.head_sha,
+                                       merge_message(state))
+        except github3.models.GitHubError as e:
+            if e.code != 409: raise
+            report_merge_error(state, 'Merge conflict')
+        else:
+            state.merge_sha = merge_commit.sha
+            merged.append(state)
+
+    return merged
+
+# Starts the build of the merge of the pull request on branch.
+def trigger_build(state, repo_cfg, trigger_author_cfg, branch, message):
+    if git.mirrors.enabled:
+        return create_git_trigger(state, repo_cfg, trigger_author_cfg, branch,
+                                  state.merge_sha, message)
+
+    utils.github_set_ref(state.get_repo(), 'heads/' + branch, state.merge_sha,
+                         force=True)
+    create_trigger(state, repo_cfg, trigger_author_cfg, branch,
+                   state.merge_sha, message)
+    return True
+
+def start_batch(states, repo_cfgs, trigger_author_cfg, slots, logger):
+    repo_cfg = repo_cfgs[states[0].repo_label]
+    branch, builders = build_target(repo_cfg, states[0].base_ref, False)
+
+    slot = slots.reserve(states[0].repo_label,
+                         build_pools(repo_cfg, builders),
+                         max(x.priority for x in states))
+    if not slot:
+        return True
+
+    try:
+        merged = create_batch_merges(states, repo_cfg, branch)
+        if not merged:
+            return False
+
+        for state in merged:
+            state.save()
+            state.set_status('pending')
+
+        batch = Batch(merged[0].repo_label, merged[0].base_ref, merged)
+        batches.add(batch)
+        logger.info('Starting {}'.format(batch))
+
+        return build_batch(batch, repo_cfgs, trigger_author_cfg, slots,
+                           logger, slot)
+    finally:
+        slots.cancel(slot)
+
+# Builds the next prefix of the batch, or finishes it once there is nothing
+# left to build. The build takes slot, or a slot of its own.
+def build_batch(batch, repo_cfgs, trigger_author_cfg, slots, logger,
+                slot=None):
+    repo_cfg = repo_cfgs[batch.repo_label]
+
+    if batch.done():
+        finish_batch(batch, repo_cfg, logger)
+        return False
+
+    branch, builders = build_target(repo_cfg, batch.base_ref, False)
+
+    if not slot:
+        slot = slots.reserve(batch.repo_label,
+                             build_pools(repo_cfg, builders),
+                             max(x.priority for x in batch.states))
+        if not slot:
+            return True
+
+    try:
+        state = batch.advance()
+        state.init_build_res(builders)
+        batch.save()
+
+        nums = ', '.join('#{}'.format(x.num) for x in batch.under_test())
+        if not trigger_build(state, repo_cfg, trigger_author_cfg, branch,
+                             'Build trigger for merges of {}'.format(nums)):
+            return False
+
+        slots.bind(slot, state.merge_sha)
+    finally:
+        slots.cancel(slot)
+
+    logger.info('Starting build of {}/{} {} on {}: {}'.format(
+        state.owner, state.name, nums, branch, state.merge_sha))
+
+    for member in batch.under_test():
+        desc = 'Testing commit {:.7} with merge {:.7} of {}...'.format(
+            member.head_sha, state.merge_sha, nums)
+        set_build_status(member, repo_cfg, builders, desc)
+        member.add_comment(':hourglass: ' + desc)
+
+    return True
+
+# Marks the pull request as the one that broke the build of a batch or
+# pipeline.
+def blame(state, repo_cfg, logger):
+    state.set_status('failure')
+    failed = sorted((builder, x['url'])
+                    for builder, x in state.build_res.items()
+                    if x['res'] is False)
+    for builder, url in failed:
+        context = 'merge-test/{}'.format(builder) \
+            if 'testrunners' in repo_cfg else 'homu'
+        utils.github_create_status(state.get_repo(), state.head_sha,
+                                   'failure', url, 'Test failed',
+                                   context=context)
+    state.add_comment(':x: Test failed - {}'.format(
+        ', '.join('[{}]({})'.format(*x) for x in failed)))
+    logger.info('Merge declined (Test failed) {}/{}#{}'.format(
+        state.owner, state.name, state.num))
+
+def finish_batch(batch, repo_cfg, logger):
+    batches.remove(batch)
+
+    culprit = batch.culprit()
+    if culprit:
+        blame(culprit, repo_cfg, logger)
+
+    for state in batch.rest():
+        if state.status == 'pending':
+            release(state)
+
+# Gives up on a batch whose pull requests changed while it was built.
+def cancel_batch(batch, logger):
+    logger.info('Cancelling {}'.format(batch))
+    batches.remove(batch)
+
+    for state in batch.states[batch.landed:]:
+        if state.status == 'pending' and \
+                state.merge_sha in batch.merge_shas:
+            release(state)
+
+# Takes a pull request that was closed out of the batch or pipeline it was
+# merged into. A batch is cancelled, and the pull requests still in it go back
+# to the queue. A pipeline keeps the ones ahead of it, and those that were
+# merged on top of it go back to the queue.
+def leave_train(state, logger):
+    train = batches.of(state)
+    if isinstance(train, Batch):
+        cancel_batch(train, logger)
+    elif isinstance(train, Pipeline):
+        logger.info('Removing #{} from {}'.format(state.num, train))
+        for rest in train.drop(state):
+            if rest.status == 'pending':
+                release(rest)
+
+        if train.states:
+            train.save()
+        else:
+            batches.remove(train)
+
+# Merges approved pull requests on top of the last one in the pipeline and
+# starts building each of them on a branch of its own. Returns whether a build
+# was started.
+def extend_pipeline(pipeline, states, repo_cfgs, trigger_author_cfg,
+                    slots, logger):
+    repo_cfg = repo_cfgs[pipeline.repo_label]
+    branch, builders = build_target(repo_cfg, pipeline.base_ref, False)
+
+    # Only as many pull requests are merged as there are slots to build them.
+    reserved = []
+    for state in states:
+        slot = slots.reserve(pipeline.repo_label,
+                             build_pools(repo_cfg, builders), state.priority)
+        if not slot:
+            break
+        reserved.append(slot)
+    if not reserved:
+        return True
+
+    try:
+        tail = pipeline.tail()
+        merged = create_batch_merges(states[:len(reserved)], repo_cfg, branch,
+                                     tail.merge_sha if tail else None)
+        if not merged:
+            return False
+
+        for state in merged:
+            state.init_build_res(builders)
+            state.save()
+            state.set_status('pending')
+            pipeline.append(state)
+        batches.add(pipeline)
+
+        started = False
+        for state, slot in zip(merged, reserved):
+            state_branch = '{}_{}'.format(branch, state.num)
+            if not trigger_build(state, repo_cfg, trigger_author_cfg,
+                                 state_branch,
+                                 'Build trigger for {}'.format(merge_message(state))):
+                break
+            started = True
+
+            slots.bind(slot, state.merge_sha)
+
+            ahead = pipeline.states[:pipeline.states.index(state)]
+            logger.info('Starting build of {}/{}#{} on {}: {}{}'.format(
+                state.owner, state.name, state.num, state_branch,
+                state.merge_sha,
+                ' after {}'.format(', '.join('#{}'.format(x.num)
+                                             for x in ahead))
+                if ahead else ''))
+
+            desc = 'Testing commit {:.7} with merge {:.7}{}...'.format(
+                state.head_sha, state.merge_sha,
+                ' on top of {}'.format(', '.join('#{}'.format(x.num)
+                                                 for x in ahead))
+                if ahead else '')
+            set_build_status(state, repo_cfg, builders, desc)
+            state.add_comment(':hourglass: ' + desc)
+    finally:
+        for slot in reserved:
+            slots.cancel(slot)
+
+    return started
+
+# Keeps up to `depth` pull requests of the lane building in its pipeline.
+# Returns whether a build was started.
+def process_pipeline(repo_label, lane_states, trains, repo_cfgs,
+                     trigger_author_cfg, logger, slots):
+    repo_cfg = repo_cfgs[repo_label]
+    depth = default_depth = repo_cfg['pipeline'].get('depth', 3)
+
+    pipeline = None
+    for train in trains:
+        if train.valid():
+            pipeline = train
+            continue
+
+        logger.info('Cancelling {}'.format(train))
+        batches.remove(train)
+        for state in train.states:
+            if state.status == 'pending' and \
+                    state.merge_sha in train.merge_shas:
+                release(state)
+
+    if pipeline:
+        depth = lane_limit(repo_cfg, pipeline.base_ref, depth)
+        if pipeline.blocked() or len(pipeline.states) >= depth:
+            return False
+
+    candidates = []
+    for state in lane_states:
+        if state.status == 'pending' and not state.try_:
+            if pipeline and state in pipeline.states:
+                continue
+            return False
+
+        if state.status == 'success' and state.try_ and state.approved_by:
+            state.try_ = False
+
+            state.save()
+
+        elif state.status != '' or not state.approved_by or state.try_:
+            continue
+
+        base_ref = pipeline.base_ref if pipeline else \
+            candidates[0].base_ref if candidates else state.base_ref
+        if state.base_ref != base_ref:
+            continue
+
+        if not pipeline and not candidates:
+            depth = lane_limit(repo_cfg, base_ref, default_depth)
+            if not depth:
+                continue
+
+        candidates.append(state)
+        if len(candidates) + (len(pipeline.states) if pipeline else 0) >= depth:
+            break
+
+    if not candidates:
+        return False
+
+    if not pipeline:
+        pipeline = Pipeline(repo_label, candidates[0].base_ref)
+
+    return extend_pipeline(pipeline, candidates, repo_cfgs,
+                           trigger_author_cfg, slots, logger)
+
 def start_rebuild(state, repo_cfgs):
     repo_cfg = repo_cfgs[state.repo_label]
 
@@ -550,60 +1047,250 @@ def start_build_or_rebuild(state, repo_cfgs, trigger_author_cfg, gh, *args):
 
     return start_build(state, repo_cfgs, trigger_author_cfg, gh, *args)
 
+# The branch the pull requests into base_ref are built on. Pull requests built
+# on the same branch share a lane of the queue, in which they are built one
+# after the other, or together in a batch or pipeline. Lanes do not wait for
+# each other, so with testrunners every base branch has its own.
+def lane_of(repo_cfg, base_ref):
+    return build_target(repo_cfg, base_ref, False)[0]
+
+# Splits the repository's pull requests, in queue order, and its batches and
+# pipelines by lane.
+def queue_lanes(repo_label, repo_cfg, repo_states):
+    lanes = OrderedDict()
+    for state in repo_states:
+        lanes.setdefault(lane_of(repo_cfg, state.base_ref),
+                         ([], []))[0].append(state)
+    for train in batches.of_repo(repo_label):
+        lanes.setdefault(lane_of(repo_cfg, train.base_ref),
+                         ([], []))[1].append(train)
+    return lanes
+
+# The number of pull requests into base_ref that may be tested at once, in
+# place of default. 0 holds the queue of the branch.
+def lane_limit(repo_cfg, base_ref, default):
+    return repo_cfg.get('lanes', {}).get(base_ref, default)
+
+# Starts the build of the first approved pull request of the lane, unless one
+# is being built already. Returns whether a build was started.
+def process_lane(lane_states, repo_cfgs, trigger_author_cfg, logger,
+                 slots, gh):
+    for state in lane_states:
+        if state.status == 'pending' and not state.try_:
+            return False
+
+        elif state.status == '' and state.approved_by:
+            if not lane_limit(repo_cfgs[state.repo_label], state.base_ref, 1):
+                continue
+
+            if start_build_or_rebuild(state, repo_cfgs, trigger_author_cfg,
+                                      slots, logger, gh):
+                return True
+
+        elif state.status == 'success' and state.try_ and state.approved_by:
+            if not lane_limit(repo_cfgs[state.repo_label], state.base_ref, 1):
+                continue
+
+            state.try_ = False
+
+            state.save()
+
+            if start_build(state, repo_cfgs, trigger_author_cfg, slots, logger, gh):
+                return True
+
+    return False
+
 def process_queue(states, repos, repo_cfgs, trigger_author_cfg, logger,
-                  buildbot_slots, gh):
-    for repo_label, repo in repos.items():
-        repo_states = sorted(states[repo_label].values())
+                  slots, gh, mergeable_que):
+    slots.begin_pass()
+
+    # Every repository starts what builds it can in each pass, taking turns
+    # for the slots of their CI.
+    queues = {x: states[x].ordered() for x in repos}
+    priorities = {x: max((y.priority for y in queues[x]
+                          if y.status == '' and (y.approved_by or y.try_)),
+                         default=0)
+                  for x in repos}
+
+    for repo_label in slots.order(priorities):
+        repo_cfg = repo_cfgs[repo_label]
+        repo_states = queues[repo_label]
+
+        mergeable_que.refresh_head(repo_states)
+
+        for lane_states, trains in queue_lanes(repo_label, repo_cfg,
+                                               repo_states).values():
+            if 'pipeline' in repo_cfg:
+                process_pipeline(repo_label, lane_states, trains, repo_cfgs,
+                                 trigger_author_cfg, logger, slots)
+            elif 'batch' in repo_cfg:
+                process_batches(repo_label, lane_states, trains, repo_cfgs,
+                                trigger_author_cfg, logger, slots)
+            else:
+                process_lane(lane_states, repo_cfgs, trigger_author_cfg,
+                             logger, slots, gh)
+
+        # Try builds come after the lanes, which get the free slots first.
+        process_try_lane(repo_label, repo_states, repo_cfgs,
+                         trigger_author_cfg, logger, slots, gh)
+
+# Starts the try builds that were asked for, up to the repository's limit on
+# try builds running at once. Requesters take turns: the next build is that of
+# the requester with the fewest try builds running, and among those, the one
+# whose request comes first in the queue. Returns whether a build was started.
+#
+# Only try builds with a branch of their own, like buildbot's, run side by
+# side. Those built on the branch of a lane of the queue, with travis, status
+# and testrunners, wait until nothing else is being built there.
+def process_try_lane(repo_label, repo_states, repo_cfgs, trigger_author_cfg,
+                     logger, slots, gh):
+    repo_cfg = repo_cfgs[repo_label]
+    limit = repo_cfg.get('try_lane', {}).get('limit', 4)
+
+    busy = {build_target(repo_cfg, x.base_ref, x.try_)[0]
+            for x in repo_states if x.status == 'pending'}
+
+    running = Counter(x.try_by for x in repo_states
+                      if x.try_ and x.status == 'pending')
+    free = limit - sum(running.values())
+
+    requests = OrderedDict()
+    for state in repo_states:
+        if state.try_ and state.status == '':
+            requests.setdefault(state.try_by, deque()).append(state)
+    turns = list(requests)
+
+    started = False
+    while free > 0 and requests:
+        requester = min(requests,
+                        key=lambda x: (running[x], turns.index(x)))
+        state = requests[requester].popleft()
+        if not requests[requester]:
+            del requests[requester]
+
+        branch = build_target(repo_cfg, state.base_ref, True)[0]
+        shared = branch == lane_of(repo_cfg, state.base_ref)
+        if shared and branch in busy:
+            continue
 
-        for state in repo_states:
-            if state.status == 'pending' and not state.try_:
-                break
+        if not start_build(state, repo_cfgs, trigger_author_cfg, slots,
+                           logger, gh):
+            continue
+        # Builds that found no free slot wait for the next pass.
+        if state.status != 'pending':
+            break
+
+        busy.add(branch)
+        started = True
+        running[requester] += 1
+        free -= 1
+
+    return started
+
+# Moves the lane's batch on to its next build, or starts a new batch of the
+# approved pull requests at the head of the lane. Returns whether a build was
+# started.
+def process_batches(repo_label, lane_states, trains, repo_cfgs,
+                    trigger_author_cfg, logger, slots):
+    repo_cfg = repo_cfgs[repo_label]
+
+    for batch in trains:
+        if not batch.valid():
+            cancel_batch(batch, logger)
+        elif batch.testing:
+            return False
+        elif build_batch(batch, repo_cfgs, trigger_author_cfg,
+                         slots, logger):
+            return True
+
+    candidates = []
+    size = 0
+    for state in lane_states:
+        if state.status == 'pending' and not state.try_:
+            return False
 
-            elif state.status == '' and state.approved_by:
-                if start_build_or_rebuild(state, repo_cfgs, trigger_author_cfg,
-                                          buildbot_slots, logger, gh):
-                    return
+        if state.status == 'success' and state.try_ and state.approved_by:
+            state.try_ = False
 
-            elif state.status == 'success' and state.try_ and state.approved_by:
-                state.try_ = False
+            state.save()
 
-                state.save()
+        elif state.status != '' or not state.approved_by or state.try_:
+            continue
+
+        if candidates and state.base_ref != candidates[0].base_ref:
+            continue
+
+        if not candidates:
+            size = lane_limit(repo_cfg, state.base_ref,
+                              repo_cfg['batch'].get('size', 8))
+            size = min(size, batches.size(repo_label, state.base_ref, size))
+            if not size:
+                continue
+
+        candidates.append(state)
+        if len(candidates) >= size:
+            break
+
+    if not candidates:
+        return False
 
-                if start_build(state, repo_cfgs, trigger_author_cfg, buildbot_slots, logger, gh):
-                    return
+    return start_batch(candidates, repo_cfgs, trigger_author_cfg,
+                       slots, logger)
 
-        for state in repo_states:
-            if state.status == '' and state.try_:
-                if start_build(state, repo_cfgs, trigger_author_cfg, buildbot_slots, logger, gh):
-                    return
+# Whether the pull request merges into its base branch, checked in the
+# repository's mirror. The result for a base and head is only computed once.
+def git_mergeable(state, repo_cfg, cause):
+    mirror = git.mirrors.get(repo_cfg)
 
-def fetch_mergeability(mergeable_que, logger):
+    with mirror.lock:
+        mirror.init()
+        base_sha = mirror.base_sha(state.base_ref,
+                                   cause['sha'] if cause else None)
+        mirror.ensure_pull(state.num, state.head_sha)
+
+    return mirror.mergeable(base_sha, state.head_sha)
+
+# One of the workers checking the mergeability of queued pull requests. While
+# GitHub is still computing it, the check is rescheduled rather than waited
+# for.
+@api.prioritized(api.LOW)
+def fetch_mergeability(mergeable_que, repo_cfgs, logger):
     re_pull_num = re.compile('(?i)merge (?:of|pull request) #([0-9]+)')
 
     while True:
+        state, cause, attempt = mergeable_que.get()
+
         try:
-            state, cause = mergeable_que.get()
+            # Closed, or replaced by a synchronization.
+            if state.repo_states is None:
+                continue
 
-            pr = state.get_repo().pull_request(state.num)
-            if pr is None:
-                time.sleep(5)
+            if git.mirrors.enabled:
+                try:
+                    mergeable = git_mergeable(
+                        state, repo_cfgs[state.repo_label], cause)
+                except git.GitError as e:
+                    if not mergeable_que.retry(state, cause, attempt):
+                        logger.error('Failed to check mergeability of {}: {}'
+                                     .format(state.num, e))
+                    continue
+            else:
                 pr = state.get_repo().pull_request(state.num)
-            if pr is None:
-                state.add_comment(':x: Failed to get PR.')
-                logger.error('Failed to get PR for {}'.format(state.num))
-                return
+                if pr is None:
+                    if not mergeable_que.retry(state, cause, attempt):
+                        state.add_comment(':x: Failed to get PR.')
+                        logger.error('Failed to get PR for {}'.format(state.num))
+                    continue
 
-            mergeable = pr.mergeable
-            if mergeable is None:
-                time.sleep(5)
                 mergeable = pr.mergeable
-            if mergeable is None:
-                # XXX Temporarily eliminating the github comment because it is
-                # XXX sending daily emails on merged PRs. See
-                # XXX https://github.com/coupa/coupa_development/pull/24884
-                # state.add_comment(':x: Failed to get mergeable state.')
-                logger.error('Failed to get mergeable state for {}'.format(state.num))
-                return
+                if mergeable is None:
+                    if not mergeable_que.retry(state, cause, attempt):
+                        # XXX Temporarily eliminating the github comment because it is
+                        # XXX sending daily emails on merged PRs. See
+                        # XXX https://github.com/coupa/coupa_development/pull/24884
+                        # state.add_comment(':x: Failed to get mergeable state.')
+                        logger.error('Failed to get mergeable state for {}'.format(state.num))
+                    continue
 
             if state.mergeable is True and mergeable is False:
                 if cause:
@@ -626,81 +1313,263 @@ def fetch_mergeability(mergeable_que, logger):
             traceback.print_exc()
 
         finally:
-            mergeable_que.task_done()
+            mergeable_que.done(state)
 
+# Pull requests that have not been updated since the last synchronization are
+# left alone, and of the others only the comments made since are parsed. With
+# full, every pull request is read again from scratch. With a sync.SyncJob,
+# pull requests are synchronized in parallel on its pool.
+@api.prioritized(api.LOW)
 def synchronize(repo_label, repo_cfg, logger, gh, states, repos, mergeable_que,
-                my_username, repo_labels):
-    logger.info('Synchronizing {}...'.format(repo_label))
+                my_username, repo_labels, *, full=False, job=None):
+    logger.info('Synchronizing {}{}...'.format(repo_label,
+                                                ' from scratch' if full else ''))
     db = Database()
 
     repo = gh.repository(repo_cfg['owner'], repo_cfg['name'])
 
-    states[repo_label] = {}
+    if full or repo_label not in states:
+        for state in states.get(repo_label, {}).values():
+            merge_shas.discard(state)
+
+        states[repo_label] = RepoStates()
+
+    cursors = db.get_sync_cursors(repo_label)
+    repo_states = states[repo_label]
     repos[repo_label] = repo
 
-    for pull in repo.iter_pulls(state='open'):
-        # Ignore PRs older than about two months.
-        update_delta = datetime.now(timezone.utc) - pull.updated_at
-        if 5e6 < update_delta.total_seconds():
-            logger.debug('Ignoring PR for merge {} because it has not ' \
-                         'been updated since {}.'.format(pull.merge_commit_sha,
-                                                         pull.updated_at))
-            continue
+    lock = Lock()
+    seen = set()
+    skipped = 0
 
-        with db.get_connection() as db_conn:
-            cursor = db_conn.cursor()
-            sql = 'SELECT status FROM pull WHERE repo = %s AND num = %s'
-            cursor.execute(sql, [repo_label, pull.number])
-            row = cursor.fetchone()
-            if row:
-                status = row[0]
-            else:
-                status = ''
-                for info in utils.github_iter_statuses(repo, pull.head.sha):
-                    # XXX We could attempt to rebuild state here, but with
-                    # multiple testrunners.
-                    if info.context == 'homu':
-                        status = info.state
-                        break
-
-        state = PullReqState(pull.number, pull.head.sha, status, repo_label,
-                             mergeable_que, gh, repo_cfg['owner'],
-                             repo_cfg['name'], repos)
-        state.title = pull.title
-        state.body = pull.body
-        state.head_ref = pull.head.repo[0] + ':' + pull.head.ref
-        state.base_ref = pull.base.ref
-        state.set_mergeable(None)
-        state.assignee = pull.assignee.login if pull.assignee else ''
-
-        for comment in pull.iter_comments():
-            if comment.original_commit_id == pull.head.sha:
+    def parse_comments(pull, state, since=None, issue_comment_id=0,
+                       review_comment_id=0):
+        for comment in pull.iter_review_comments(since):
+            if comment.id <= review_comment_id:
+                continue
+            review_comment_id = comment.id
+
+            if comment.commit_id == pull.head_sha:
                 parse_commands(
                     comment.body,
-                    comment.user.login,
+                    comment.login,
                     repo_cfg,
                     state,
                     my_username,
-                    sha=comment.original_commit_id,
+                    sha=comment.commit_id,
                 )
 
-        for comment in pull.iter_issue_comments():
+        for comment in pull.iter_issue_comments(since):
+            if comment.id <= issue_comment_id:
+                continue
+            issue_comment_id = comment.id
+
             parse_commands(
                 comment.body,
-                comment.user.login,
+                comment.login,
                 repo_cfg,
                 state,
                 my_username,
             )
 
-        state.save(logger)
+        return issue_comment_id, review_comment_id
+
+    @api.prioritized(api.LOW)
+    def sync_pull(pull):
+        nonlocal skipped
+
+        # Ignore PRs older than about two months.
+        update_delta = datetime.now(timezone.utc) - pull.updated_at
+        if 5e6 < update_delta.total_seconds():
+            logger.debug('Ignoring PR {} because it has not been updated ' \
+                         'since {}.'.format(pull.number, pull.updated_at))
+            return
+
+        with lock:
+            seen.add(pull.number)
+        updated_at = pull.updated_at.timestamp()
+
+        state = repo_states.get(pull.number)
+        cursor = cursors.get(pull.number)
+        if state and cursor and state.head_sha == pull.head_sha == cursor[1]:
+            if cursor[0] == updated_at:
+                with lock:
+                    skipped += 1
+                return
+
+            since = datetime.fromtimestamp(cursor[0], timezone.utc)
+            with db.unit_of_work():
+                state.title = pull.title
+                if state.body_changed(pull.body):
+                    state.body = pull.body
+                state.head_ref = pull.head_ref
+                if state.base_ref != pull.base_ref:
+                    state.base_ref = pull.base_ref
+                    state.set_mergeable(None)
+                state.assignee = pull.assignee
+
+                comment_ids = parse_comments(pull, state, since, *cursor[2:])
+
+                state.save(logger)
+
+        else:
+            status = db.get_pull_status(repo_label, pull.number)
+            if status is None:
+                # XXX We could attempt to rebuild state here, but with
+                # multiple testrunners.
+                status = sync.homu_status(repo, pull)
+
+            # One transaction per pull request instead of one per write.
+            with db.unit_of_work():
+                state = PullReqState(pull.number, pull.head_sha, status, repo_label,
+                                     mergeable_que, gh, repo_cfg['owner'],
+                                     repo_cfg['name'], repos)
+                state.title = pull.title
+                state.body = pull.body
+                state.head_ref = pull.head_ref
+                state.base_ref = pull.base_ref
+                state.set_mergeable(None)
+                state.assignee = pull.assignee
+
+                comment_ids = parse_comments(pull, state)
 
-        states[repo_label][pull.number] = state
+                state.save(logger)
 
-    logger.info('Done synchronizing {}!'.format(repo_label))
+            old_state = repo_states.get(pull.number)
+            if old_state:
+                merge_shas.discard(old_state)
+            repo_states[pull.number] = state
+
+        db.set_sync_cursor(repo_label, pull.number, updated_at, pull.head_sha,
+                           *comment_ids)
+
+    start = time.monotonic()
+    engine = repo_cfg.get('sync', 'rest')
+
+    try:
+        pulls = list(sync.iter_pulls(gh, repo, engine))
+    except sync.SyncError as e:
+        logger.warning('{} synchronization of {} failed, falling back to '
+                       'REST: {}'.format(engine, repo_label, e))
+        engine = 'rest'
+        pulls = list(sync.rest_pulls(repo))
+
+    if job:
+        job.map(sync_pull, pulls)
+    else:
+        for pull in pulls:
+            sync_pull(pull)
+
+    # Pull requests that have been closed or gone stale since.
+    gone = [x for x in repo_states if x not in seen]
+    for num in gone:
+        merge_shas.discard(repo_states.pop(num))
+    gone.extend(x for x in cursors if x not in seen and x not in gone)
+    if gone:
+        db.delete_sync_cursors(repo_label, gone)
+
+    logger.info('Done synchronizing {}! ({} pull requests, {} unchanged, '
+                'with {} in {:.1f}s)'.format(repo_label, len(repo_states),
+                                             skipped, engine,
+                                             time.monotonic() - start))
 
     logger.debug('Github rate limit status: {}'.format(gh.rate_limit()))
 
+def load_states(db, repo_cfgs, repos, mergeable_que, gh, logger):
+    states = {repo_label: RepoStates() for repo_label in repo_cfgs}
+
+    start = time.monotonic()
+    with db.unit_of_work():
+        for row in db.iter_pulls():
+            repo_label = row['repo']
+            try: repo_cfg = repo_cfgs[repo_label]
+            except KeyError: continue
+
+            num = row['num']
+            state = PullReqState(num, row['head_sha'], row['status'],
+                                 repo_label, mergeable_que, gh,
+                                 repo_cfg['owner'], repo_cfg['name'], repos)
+            state.title = row['title']
+            state.head_ref = row['head_ref']
+            state.base_ref = row['base_ref']
+            state.assignee = row['assignee']
+
+            state.approved_by = row['approved_by']
+            state.priority = int(row['priority'])
+            state.try_ = bool(row['try_'])
+            state.rollup = bool(row['rollup'])
+
+            if row['merge_sha']:
+                if 'buildbot' in repo_cfg:
+                    builders = repo_cfg['buildbot']['builders']
+                elif 'travis' in repo_cfg:
+                    builders = ['travis']
+                elif 'status' in repo_cfg:
+                    builders = ['status']
+                elif 'testrunners' in repo_cfg:
+                    builders = repo_cfg['testrunners'].get('builders', [])
+                else:
+                    raise RuntimeError('Invalid configuration')
+
+                state.init_build_res(builders, use_db=False)
+                state.merge_sha = row['merge_sha']
+
+            elif state.status == 'pending':
+                # FIXME: There might be a better solution
+                state.status = ''
+
+                state.save()
+
+            states[repo_label][num] = state
+    logger.info('Loaded {} pull requests in {:.2f}s'.format(
+        sum(len(x) for x in states.values()), time.monotonic() - start))
+
+    start = time.monotonic()
+    stale_build_res = []
+    for repo_label, num, builder, res, url, merge_sha in db.iter_build_res():
+        try:
+            state = states[repo_label][num]
+            if state.merge_sha != merge_sha: raise KeyError
+        except KeyError:
+            # Deleted by Database.delete_orphans.
+            continue
+
+        if builder not in state.build_res:
+            stale_build_res.append((repo_label, num, builder))
+            continue
+
+        state.build_res[builder] = {
+            'res': bool(res) if res is not None else None,
+            'url': url,
+        }
+    logger.info('Loaded build results in {:.2f}s'.format(
+        time.monotonic() - start))
+
+    batches.load(db, states)
+
+    # The last known mergeability is kept until the check queued below
+    # replaces it.
+    start = time.monotonic()
+    for repo_label, num, mergeable in db.iter_mergeable():
+        try: state = states[repo_label][num]
+        except KeyError: continue
+
+        state.mergeable = bool(mergeable) if mergeable is not None else None
+    for repo_states in states.values():
+        for state in repo_states.values():
+            mergeable_que.put(state)
+    logger.info('Loaded mergeability in {:.2f}s'.format(
+        time.monotonic() - start))
+
+    start = time.monotonic()
+    build_res_count, mergeable_count = db.delete_orphans(repo_cfgs,
+                                                         stale_build_res)
+    logger.info('Deleted {} stale build results and {} stale mergeability '
+                'rows in {:.2f}s'.format(build_res_count, mergeable_count,
+                                         time.monotonic() - start))
+
+    return states
+
 def arguments():
     parser = argparse.ArgumentParser(description =
                                      'A bot that integrates with GitHub and '
@@ -726,143 +1595,68 @@ def main():
 
     trigger_author_cfg = cfg.get('trigger_author', {})
 
+    db = Database(cfg.get('db', {}))
+
     gh = github3.login(token=cfg['github']['access_token'])
+    api.mount(gh, cfg)
+    git.mirrors.configure(cfg)
 
-    rate_limit = gh.rate_limit()
-    logger.debug('Github rate limit status: {}'.format(rate_limit))
-    if not rate_limit['rate']['remaining']:
-        reset_time = datetime.fromtimestamp(rate_limit['rate']['reset'])
-        logger_msg = 'Github rate limit exhausted! Sleeping until {}'
-        logger.info(logger_msg.format(reset_time.isoformat()))
-        reset_delta = reset_time - datetime.now()
-        time.sleep(reset_delta.total_seconds())
+    # Requests made while the rate limit is exhausted wait for it to reset.
+    logger.debug('Github rate limit status: {}'.format(gh.rate_limit()))
 
     states = {}
     repos = {}
     repo_cfgs = {}
-    buildbot_slots = ['']
+    slots_cfg = cfg.get('slots', {})
+    slots = SlotScheduler(capacity=slots_cfg.get('capacity', {}),
+                          timeout=slots_cfg.get('timeout', 3600))
     my_username = gh.user().login
     repo_labels = {}
-    mergeable_que = Queue()
+    mergeable_cfg = cfg.get('mergeability', {})
+    mergeable_que = MergeabilityQueue(lazy=mergeable_cfg.get('lazy', False),
+                                      eager=mergeable_cfg.get('eager', 10))
 
-    db = Database()
-    with db.get_connection() as db_conn:
-        schema_path = os.path.join(os.path.dirname(__file__), 'schema.sql')
-        schema = open(schema_path).read()
-        # execute with multi=True requires enumeration.
-        list(db_conn.cursor().execute(multi=True, operation=schema))
-
-        for repo_label, repo_cfg in cfg['repo'].items():
-            repo_cfgs[repo_label] = repo_cfg
-            repo_labels[repo_cfg['owner'], repo_cfg['name']] = repo_label
-
-            repo_states = {}
-            repos[repo_label] = None
-
-            cursor = db_conn.cursor()
-            cursor.execute('SELECT num, head_sha, status, title, body, ' \
-                           'head_ref, base_ref, assignee, approved_by, ' \
-                           'priority, try_, rollup, merge_sha FROM pull ' \
-                           'WHERE repo = %s', [repo_label])
-            for (num, head_sha, status, title, body, head_ref, base_ref,
-                    assignee, approved_by, priority, try_, rollup,
-                    merge_sha) in cursor.fetchall():
-                state = PullReqState(num, head_sha, status, repo_label,
-                                     mergeable_que, gh, repo_cfg['owner'],
-                                     repo_cfg['name'], repos)
-                state.title = title
-                state.body = body
-                state.head_ref = head_ref
-                state.base_ref = base_ref
-                state.set_mergeable(None)
-                state.assignee = assignee
-
-                state.approved_by = approved_by
-                state.priority = int(priority)
-                state.try_ = bool(try_)
-                state.rollup = bool(rollup)
-
-                if merge_sha:
-                    if 'buildbot' in repo_cfg:
-                        builders = repo_cfg['buildbot']['builders']
-                    elif 'travis' in repo_cfg:
-                        builders = ['travis']
-                    elif 'status' in repo_cfg:
-                        builders = ['status']
-                    elif 'testrunners' in repo_cfg:
-                        builders = repo_cfg['testrunners'].get('builders', [])
-                    else:
-                        raise RuntimeError('Invalid configuration')
-
-                    state.init_build_res(builders, use_db=False)
-                    state.merge_sha = merge_sha
-
-                elif state.status == 'pending':
-                    # FIXME: There might be a better solution
-                    state.status = ''
-
-                    state.save()
+    db.init_schema()
 
-                repo_states[num] = state
+    for repo_label, repo_cfg in cfg['repo'].items():
+        repo_cfgs[repo_label] = repo_cfg
+        repo_labels[repo_cfg['owner'], repo_cfg['name']] = repo_label
+        repos[repo_label] = None
 
-            states[repo_label] = repo_states
+    states.update(load_states(db, repo_cfgs, repos, mergeable_que, gh, logger))
 
-        cursor = db_conn.cursor()
-        cursor.execute('SELECT repo, num, builder, res, url, merge_sha FROM build_res')
-        for repo_label, num, builder, res, url, merge_sha in cursor.fetchall():
-            try:
-                state = states[repo_label][num]
-                if builder not in state.build_res: raise KeyError
-                if state.merge_sha != merge_sha: raise KeyError
-            except KeyError:
-                cursor = db_conn.cursor()
-                cursor.execute('DELETE FROM build_res WHERE repo = %s AND ' \
-                               'num = %s AND builder = %s',
-                               [repo_label, num, builder])
-                db_conn.commit()
-                continue
-
-            state.build_res[builder] = {
-                'res': bool(res) if res is not None else None,
-                'url': url,
-            }
-
-        cursor = db_conn.cursor()
-        cursor.execute('SELECT repo, num, mergeable FROM mergeable')
-        for repo_label, num, mergeable in cursor.fetchall():
-            try: state = states[repo_label][num]
-            except KeyError:
-                cursor = db_conn.cursor()
-                cursor.execute('DELETE FROM mergeable WHERE repo = %s AND ' \
-                               'num = %s', [repo_label, num])
-                db_conn.commit()
-                continue
+    def run_sync(repo_label, **kwargs):
+        synchronize(repo_label, repo_cfgs[repo_label], logger, gh, states,
+                    repos, mergeable_que, my_username, repo_labels, **kwargs)
 
-            state.mergeable = bool(mergeable) if mergeable is not None else None
+    sync_cfg = cfg.get('sync', {})
+    sync_executor = sync.SyncExecutor(run_sync,
+                                      workers=sync_cfg.get('workers', 4),
+                                      repos=sync_cfg.get('repos', 2),
+                                      logger=logger.getChild('sync'))
 
-        queue_handler_lock = Lock()
-        def queue_handler():
-            with queue_handler_lock:
-                return process_queue(states, repos, repo_cfgs,
-                                     trigger_author_cfg, logger,
-                                     buildbot_slots, gh)
+    queue_handler_lock = Lock()
+    def queue_handler():
+        with queue_handler_lock, db.unit_of_work(), api.priority(api.HIGH):
+            return process_queue(states, repos, repo_cfgs,
+                                 trigger_author_cfg, logger,
+                                 slots, gh, mergeable_que)
 
-        from . import server
-        Thread(target=server.start, args=[cfg, states, queue_handler, repo_cfgs,
-                                          repos, logger, buildbot_slots,
-                                          my_username, repo_labels,
-                                          mergeable_que, gh]).start()
+    from . import server
+    Thread(target=server.start, args=[cfg, states, queue_handler, repo_cfgs,
+                                      repos, logger, slots,
+                                      my_username, repo_labels,
+                                      mergeable_que, gh, sync_executor]).start()
 
-        Thread(target=fetch_mergeability, args=[mergeable_que, logger]).start()
+    for _ in range(mergeable_cfg.get('workers', 4)):
+        Thread(target=fetch_mergeability,
+               args=[mergeable_que, repo_cfgs, logger]).start()
 
 
-        for repo_label, repo_cfg in cfg['repo'].items():
-            t = Thread(target=synchronize,
-                       args=[repo_label, repo_cfg, logger, gh, states, repos,
-                             mergeable_que, my_username, repo_labels])
-            t.start()
+    for repo_label in cfg['repo']:
+        sync_executor.submit(repo_label)
 
-        queue_handler()
+    queue_handler()
 
 if __name__ == '__main__':
     signal.signal(signal.SIGTERM, lambda x, y: Database().close_all())
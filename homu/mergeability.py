@@ -0,0 +1,140 @@
+import heapq
+import threading
+import time
+
+
+# Pull requests waiting to have their mergeability checked, keyed by
+# repository and number. A pull request is only queued once: queueing it again
+# replaces the state and cause of the pending check, and brings it forward if
+# it was scheduled later. Checks whose result GitHub has not computed yet are
+# rescheduled with a backoff instead of holding a worker.
+#
+# In lazy mode, queued pull requests are only parked, and checked once they
+# are refreshed: when they come within the first `eager` approved pull
+# requests of their repository's queue, or when someone looks at them.
+class MergeabilityQueue:
+    RETRY_DELAYS = [2, 5, 10, 30, 60, 120]
+
+    def __init__(self, *, lazy=False, eager=10):
+        self.lazy = lazy
+        self.eager = eager
+
+        self.cond = threading.Condition()
+        self.heap = []
+        self.seq = 0
+        self.pending = {}
+        self.parked = {}
+        self.in_flight = set()
+
+        self.queued = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.checked = 0
+
+    def put(self, state, cause=None, *, delay=0, attempt=0, eager=False):
+        key = state.repo_label, state.num
+        due = time.monotonic() + delay
+
+        with self.cond:
+            if self.lazy and not eager and key not in self.pending:
+                if key in self.parked:
+                    self.coalesced += 1
+                else:
+                    self.queued += 1
+                self.parked[key] = [state, cause]
+                return
+
+            parked = self.parked.pop(key, None)
+
+            entry = self.pending.get(key)
+            if entry:
+                self.coalesced += 1
+                entry[0] = state
+                entry[1] = cause
+                if due >= entry[2]:
+                    return
+                entry[2] = due
+                entry[3] = attempt
+            else:
+                if not parked and not attempt:
+                    self.queued += 1
+                self.pending[key] = [state, cause, due, attempt]
+
+            self.push(key, due)
+
+    def push(self, key, due):
+        self.seq += 1
+        heapq.heappush(self.heap, (due, self.seq, key))
+        self.cond.notify()
+
+    def retry(self, state, cause, attempt):
+        if attempt >= len(self.RETRY_DELAYS):
+            return False
+
+        with self.cond:
+            self.retried += 1
+        self.put(state, cause, delay=self.RETRY_DELAYS[attempt],
+                 attempt=attempt + 1, eager=True)
+        return True
+
+    # Checks the parked pull requests among states.
+    def refresh(self, states):
+        for state in states:
+            with self.cond:
+                entry = self.parked.get((state.repo_label, state.num))
+            if entry:
+                self.put(state, entry[1], eager=True)
+
+    # Checks the first pull requests of a repository's queue that are going to
+    # be built, given all its states in queue order.
+    def refresh_head(self, states):
+        if self.lazy:
+            self.refresh([x for x in states
+                          if (x.approved_by or x.rollup) and
+                          x.status != 'success'][:self.eager])
+
+    # Waits for the next check that is due. Returns the state, cause and the
+    # number of times the check has been retried.
+    def get(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.heap and self.heap[0][0] <= now:
+                    due, _, key = heapq.heappop(self.heap)
+                    entry = self.pending.get(key)
+                    # Entries that were brought forward, or whose pull request
+                    # is being checked, are pushed again when it is done.
+                    if not entry or entry[2] != due or key in self.in_flight:
+                        continue
+
+                    del self.pending[key]
+                    self.in_flight.add(key)
+                    return entry[0], entry[1], entry[3]
+
+                self.cond.wait(self.heap[0][0] - now if self.heap else None)
+
+    def done(self, state):
+        key = state.repo_label, state.num
+
+        with self.cond:
+            self.in_flight.discard(key)
+            self.checked += 1
+            entry = self.pending.get(key)
+            if entry:
+                self.push(key, entry[2])
+
+    def __len__(self):
+        with self.cond:
+            return len(self.pending)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'pending': len(self.pending),
+                'parked': len(self.parked),
+                'in_flight': len(self.in_flight),
+                'queued': self.queued,
+                'coalesced': self.coalesced,
+                'retried': self.retried,
+                'checked': self.checked,
+            }
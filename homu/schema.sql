@@ -42,3 +42,47 @@ CREATE TABLE IF NOT EXISTS build_triggers (
     target_sha VARCHAR(255) NOT NULL,
     build_count TINYINT UNSIGNED NOT NULL,
     PRIMARY KEY (trigger_sha));
+
+CREATE TABLE IF NOT EXISTS webhook_events (
+    id INT NOT NULL AUTO_INCREMENT,
+    source VARCHAR(255) NOT NULL,
+    partition_key VARCHAR(255) NOT NULL,
+    headers TEXT NOT NULL,
+    payload LONGTEXT NOT NULL,
+    received_at DOUBLE NOT NULL,
+    PRIMARY KEY (id));
+
+CREATE TABLE IF NOT EXISTS webhook_deliveries (
+    delivery_id VARCHAR(255) NOT NULL,
+    received_at DOUBLE NOT NULL,
+    PRIMARY KEY (delivery_id));
+
+CREATE TABLE IF NOT EXISTS sync_cursors (
+    id INT NOT NULL AUTO_INCREMENT,
+    repo VARCHAR(255) NOT NULL,
+    num INTEGER NOT NULL,
+    updated_at DOUBLE NOT NULL,
+    head_sha VARCHAR(40) NOT NULL,
+    issue_comment_id BIGINT NOT NULL,
+    review_comment_id BIGINT NOT NULL,
+    PRIMARY KEY (id),
+    UNIQUE unique_index (repo, num));
+
+CREATE TABLE IF NOT EXISTS batches (
+    id INT NOT NULL AUTO_INCREMENT,
+    repo VARCHAR(255) NOT NULL,
+    base_ref VARCHAR(255) NOT NULL,
+    nums TEXT NOT NULL,
+    landed INTEGER NOT NULL,
+    failing INTEGER,
+    testing INTEGER,
+    PRIMARY KEY (id),
+    UNIQUE unique_index (repo, base_ref));
+
+CREATE TABLE IF NOT EXISTS pipelines (
+    id INT NOT NULL AUTO_INCREMENT,
+    repo VARCHAR(255) NOT NULL,
+    base_ref VARCHAR(255) NOT NULL,
+    nums TEXT NOT NULL,
+    PRIMARY KEY (id),
+    UNIQUE unique_index (repo, base_ref));
@@ -0,0 +1,80 @@
+CREATE TABLE IF NOT EXISTS pull (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    repo VARCHAR(255) NOT NULL,
+    num INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    merge_sha TEXT,
+    title TEXT,
+    body TEXT,
+    head_sha TEXT,
+    head_ref TEXT,
+    base_ref TEXT,
+    assignee TEXT,
+    approved_by TEXT,
+    priority INTEGER,
+    try_ INTEGER,
+    rollup INTEGER,
+    UNIQUE (repo, num));
+
+CREATE TABLE IF NOT EXISTS build_res (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    repo VARCHAR(255) NOT NULL,
+    num INTEGER NOT NULL,
+    builder VARCHAR(255) NOT NULL,
+    res INTEGER,
+    url TEXT NOT NULL,
+    merge_sha TEXT NOT NULL,
+    UNIQUE (repo, num, builder));
+
+CREATE TABLE IF NOT EXISTS mergeable (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    repo VARCHAR(255) NOT NULL,
+    num INTEGER NOT NULL,
+    mergeable INTEGER NOT NULL,
+    UNIQUE (repo, num));
+
+CREATE TABLE IF NOT EXISTS build_triggers (
+    branch TEXT NOT NULL,
+    trigger_sha VARCHAR(255) NOT NULL,
+    target_sha VARCHAR(255) NOT NULL,
+    build_count INTEGER NOT NULL,
+    PRIMARY KEY (trigger_sha));
+
+CREATE TABLE IF NOT EXISTS webhook_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    source VARCHAR(255) NOT NULL,
+    partition_key VARCHAR(255) NOT NULL,
+    headers TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    received_at REAL NOT NULL);
+
+CREATE TABLE IF NOT EXISTS webhook_deliveries (
+    delivery_id VARCHAR(255) NOT NULL PRIMARY KEY,
+    received_at REAL NOT NULL);
+
+CREATE TABLE IF NOT EXISTS sync_cursors (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    repo VARCHAR(255) NOT NULL,
+    num INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    head_sha VARCHAR(40) NOT NULL,
+    issue_comment_id INTEGER NOT NULL,
+    review_comment_id INTEGER NOT NULL,
+    UNIQUE (repo, num));
+
+CREATE TABLE IF NOT EXISTS batches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    repo VARCHAR(255) NOT NULL,
+    base_ref VARCHAR(255) NOT NULL,
+    nums TEXT NOT NULL,
+    landed INTEGER NOT NULL,
+    failing INTEGER,
+    testing INTEGER,
+    UNIQUE (repo, base_ref));
+
+CREATE TABLE IF NOT EXISTS pipelines (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    repo VARCHAR(255) NOT NULL,
+    base_ref VARCHAR(255) NOT NULL,
+    nums TEXT NOT NULL,
+    UNIQUE (repo, base_ref));
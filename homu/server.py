@@ -1,9 +1,15 @@
 import hmac
 import json
 import urllib.parse
+from .batches import Batch, Pipeline, batches, build_result, release
 from .database import Database
-from .main import PullReqState, parse_commands, synchronize
+from .main import PullReqState, parse_commands, blame, lane_limit
+from .main import leave_train, queue_lanes
 from .main import INTERRUPTED_BY_HOMU_RE
+from .indexes import merge_shas, RepoStates
+from .events import DeliveryCache, EventQueue
+from . import api
+from . import git
 from . import utils
 from .utils import lazy_debug
 import github3
@@ -11,9 +17,12 @@ import jinja2
 import requests
 import pkg_resources
 from bottle import get, post, run, request, redirect, abort, response
+from bottle import HTTPError, HTTPResponse
+import functools
+from functools import partial
 import hashlib
+import heapq
 import os
-from threading import Thread
 
 import bottle; bottle.BaseRequest.MEMFILE_MAX = 1024 * 1024 * 10
 
@@ -21,12 +30,55 @@ class G: pass
 g = G()
 
 def find_state(sha):
-    for repo_label, repo_states in g.states.items():
-        for state in repo_states.values():
-            if state.merge_sha == sha:
-                return state, repo_label
+    try: state = merge_shas.find(sha)
+    except KeyError: raise ValueError('Invalid SHA')
+
+    # The index may still point at a state that a resync has replaced.
+    if g.states.get(state.repo_label, {}).get(state.num) is not state:
+        raise ValueError('Invalid SHA')
+
+    return state, state.repo_label
+
+# Commits the writes of a route once it returns. Bottle raises redirects, and
+# those are let out of the unit of work before being raised again so that
+# they commit too; errors discard the writes.
+def unit_of_work(callback):
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        with Database().unit_of_work():
+            try:
+                return callback(*args, **kwargs)
+            except HTTPError:
+                raise
+            except HTTPResponse as e:
+                res = e
+        raise res
+    return wrapper
+
+# Frees the slot the build of sha took, now that its CI has reported on it,
+# once authentic says that the report is authentic for the repository that
+# reserved the slot. This doesn't need the build to be found, since builds
+# that are no longer wanted, whose merge_sha has been cleared, hold their slot
+# all the same.
+def release_slot(sha, authentic):
+    repo_label = g.slots.holder(sha)
+    if repo_label is None or not authentic(repo_label):
+        return
+
+    if g.slots.release(sha):
+        g.queue_handler()
+
+# Handles a webhook unless a delivery with the same key has been handled
+# already. A delivery that fails is forgotten so that it can be sent again.
+def deduplicate(key, handle):
+    if not g.deliveries.add(key):
+        return 'Duplicate delivery'
 
-    raise ValueError('Invalid SHA')
+    try:
+        return handle()
+    except:
+        g.deliveries.discard(key)
+        raise
 
 def get_repo(repo_label, repo_cfg):
     repo = g.repos[repo_label]
@@ -39,7 +91,29 @@ def get_repo(repo_label, repo_cfg):
 
 @get('/')
 def index():
-    return g.tpls['index'].render(repos=sorted(g.repos))
+    return g.tpls['index'].render(repos=sorted(g.repos),
+                                  syncs=g.sync.status())
+
+@get('/stats')
+def stats():
+    response.content_type = 'application/json'
+
+    stats = {
+        'database': Database().stats(),
+        'deliveries': g.deliveries.stats(),
+        'mergeability': g.mergeable_que.stats(),
+    }
+    if g.events:
+        stats['events'] = g.events.stats()
+    if git.mirrors.enabled:
+        stats['git'] = git.mirrors.stats()
+    stats['batches'] = batches.stats()
+    stats['slots'] = g.slots.stats()
+    adapter = api.get_adapter(g.gh)
+    if adapter:
+        stats['github'] = adapter.stats()
+
+    return json.dumps(stats, indent=4, sort_keys=True)
 
 @get('/queue/<repo_label:path>')
 def queue(repo_label):
@@ -52,11 +126,10 @@ def queue(repo_label):
     else:
         labels = repo_label.split('+')
 
-    states = []
-    for label in labels:
-        states += g.states[label].values()
+    pull_states = list(heapq.merge(*[g.states[label].ordered()
+                                     for label in labels]))
 
-    pull_states = sorted(states)
+    g.mergeable_que.refresh(pull_states)
 
     rows = []
     for state in pull_states:
@@ -73,9 +146,14 @@ def queue(repo_label):
             'assignee': state.assignee,
         })
 
+    lanes = []
+    for label in labels:
+        lanes.extend(lane_rows(label))
+
     return g.tpls['queue'].render(
         repo_label = repo_label,
         states = rows,
+        lanes = lanes,
         oauth_client_id = g.cfg['github']['app_client_id'],
         total = len(pull_states),
         approved = len([x for x in pull_states if x.approved_by]),
@@ -83,6 +161,50 @@ def queue(repo_label):
         failed = len([x for x in pull_states if x.status == 'failure' or x.status == 'error']),
     )
 
+# What each lane of the repository's queue is building, and how many approved
+# pull requests wait behind it.
+def lane_rows(repo_label):
+    repo_cfg = g.repo_cfgs[repo_label]
+    if 'pipeline' in repo_cfg:
+        mode, limit = 'pipeline', repo_cfg['pipeline'].get('depth', 3)
+    elif 'batch' in repo_cfg:
+        mode, limit = 'batch', repo_cfg['batch'].get('size', 8)
+    else:
+        mode, limit = 'single', 1
+
+    rows = []
+    for branch, (lane_states, trains) in queue_lanes(
+            repo_label, repo_cfg, g.states[repo_label].ordered()).items():
+        base_refs = sorted({x.base_ref for x in lane_states} |
+                           {x.base_ref for x in trains})
+
+        train = ''
+        for x in trains:
+            if isinstance(x, Batch):
+                train = 'batch of {}, {} landed{}'.format(
+                    len(x.states), x.landed,
+                    ', bisecting' if x.failing is not None else '')
+            elif isinstance(x, Pipeline):
+                train = 'pipeline of {}{}'.format(
+                    len(x.states), ', blocked' if x.blocked() else '')
+
+        rows.append({
+            'repo_label': repo_label,
+            'branch': branch,
+            'base_refs': ', '.join(base_refs),
+            'mode': mode,
+            'limits': ', '.join('{}: {}'.format(
+                x, lane_limit(repo_cfg, x, limit)) for x in base_refs),
+            'building': [x.num for x in lane_states
+                         if x.status == 'pending' and not x.try_],
+            'train': train,
+            'waiting': len([x for x in lane_states
+                            if x.approved_by and not x.try_ and
+                            x.status == '']),
+        })
+
+    return rows
+
 @get('/callback')
 def callback():
     logger = g.logger.getChild('callback')
@@ -109,13 +231,13 @@ def callback():
     user_gh = github3.login(token=token)
 
     if state['cmd'] == 'rollup':
-        return rollup(user_gh, state, repo_label, repo_cfg, repo)
+        return rollup(user_gh, state, repo_label, repo_cfg, repo, token)
     elif state['cmd'] == 'synch':
         return synch(user_gh, state, repo_label, repo_cfg, repo)
     else:
         abort(400, 'Invalid command')
 
-def rollup(user_gh, state, repo_label, repo_cfg, repo):
+def rollup(user_gh, state, repo_label, repo_cfg, repo, token):
     user_repo = user_gh.repository(user_gh.user().login, repo.name)
     base_repo = user_gh.repository(repo.owner.login, repo.name)
 
@@ -133,6 +255,45 @@ def rollup(user_gh, state, repo_label, repo_cfg, repo):
 
     base_ref = rollup_states[0].base_ref
 
+    if git.mirrors.enabled:
+        try:
+            successes, failures = git_rollup(rollup_states, base_ref,
+                                             repo_cfg, user_repo, token)
+        except git.GitError as e:
+            return str(e)
+    else:
+        successes, failures = api_rollup(rollup_states, base_ref, repo_cfg,
+                                         repo, user_repo)
+
+    title = 'Rollup of {} pull requests'.format(len(successes))
+    body = '- Successful merges: {}\n- Failed merges: {}'.format(
+        ', '.join('#{}'.format(x) for x in successes),
+        ', '.join('#{}'.format(x) for x in failures),
+    )
+
+    # XXX Why do we create_pull if there were failures?
+    try:
+        pull = base_repo.create_pull(
+            title,
+            base_ref,
+            user_repo.owner.login + ':' + repo_cfg.get('branch', {}).get('rollup', 'rollup'), #XXX This is incompatible with testrunners config.
+            body,
+        )
+    except github3.models.GitHubError as e:
+        return e.response.text
+    else:
+        redirect(pull.html_url)
+
+def rollup_message(state):
+    return 'Rollup merge of #{} - {}, r={}\n\n{}\n\n{}'.format(
+        state.num,
+        state.head_ref,
+        state.approved_by,
+        state.title,
+        state.body,
+    )
+
+def api_rollup(rollup_states, base_ref, repo_cfg, repo, user_repo):
     base_sha = repo.ref('heads/' + base_ref).object.sha
     utils.github_set_ref(
         user_repo,
@@ -149,13 +310,7 @@ def rollup(user_gh, state, repo_label, repo_cfg, repo):
             failures.append(state.num)
             continue
 
-        merge_msg = 'Rollup merge of #{} - {}, r={}\n\n{}\n\n{}'.format(
-            state.num,
-            state.head_ref,
-            state.approved_by,
-            state.title,
-            state.body,
-        )
+        merge_msg = rollup_message(state)
 
         try: user_repo.merge(repo_cfg.get('branch', {}).get('rollup', 'rollup'), state.head_sha, merge_msg) #XXX This is incompatible with testrunners config.
         except github3.models.GitHubError as e:
@@ -165,41 +320,77 @@ def rollup(user_gh, state, repo_label, repo_cfg, repo):
         else:
             successes.append(state.num)
 
-    title = 'Rollup of {} pull requests'.format(len(successes))
-    body = '- Successful merges: {}\n- Failed merges: {}'.format(
-        ', '.join('#{}'.format(x) for x in successes),
-        ', '.join('#{}'.format(x) for x in failures),
-    )
+    return successes, failures
 
-    # XXX Why do we create_pull if there were failures?
-    try:
-        pull = base_repo.create_pull(
-            title,
-            state.base_ref,
-            user_repo.owner.login + ':' + repo_cfg.get('branch', {}).get('rollup', 'rollup'), #XXX This is incompatible with testrunners config.
-            body,
-        )
-    except github3.models.GitHubError as e:
-        return e.response.text
+# Merges the rollup in the repository's mirror, and pushes it to the fork of
+# the user asking for it at once.
+def git_rollup(rollup_states, base_ref, repo_cfg, user_repo, token):
+    mirror = git.mirrors.get(repo_cfg)
+    successes = []
+    failures = []
+
+    with mirror.lock:
+        mirror.init()
+        sha = mirror.branch_sha(base_ref)
+
+        for state in rollup_states:
+            if base_ref != state.base_ref:
+                failures.append(state.num)
+                continue
+
+            mirror.ensure_pull(state.num, state.head_sha)
+            merge_sha = mirror.merge(sha, state.head_sha,
+                                     rollup_message(state),
+                                     git.mirrors.author)
+            if merge_sha:
+                sha = merge_sha
+                successes.append(state.num)
+            else:
+                failures.append(state.num)
+
+        mirror.push({repo_cfg.get('branch', {}).get('rollup', 'rollup'): sha}, #XXX This is incompatible with testrunners config.
+                    git.mirrors.url_for(user_repo.owner.login, user_repo.name),
+                    token)
+
+    return successes, failures
+
+def github_repo_label(info):
+    owner_info = info['repository']['owner']
+    owner = owner_info.get('login') or owner_info['name']
+    return g.repo_labels[owner, info['repository']['name']]
+
+# Events about one pull request are processed in order, see EventQueue.
+def github_event_key(repo_label, event_type, info):
+    if event_type == 'pull_request':
+        num = info['number']
+    elif event_type == 'issue_comment':
+        num = info['issue']['number']
+    elif event_type == 'pull_request_review_comment':
+        num = info['pull_request']['number']
     else:
-        redirect(pull.html_url)
+        return repo_label
+
+    return '{}#{}'.format(repo_label, num)
 
 @post('/github')
+@unit_of_work
 def github():
     logger = g.logger.getChild('github')
-    db = Database()
 
     response.content_type = 'text/plain'
 
+    # GitHub sends a webhook again when it is not answered in time.
+    delivery = request.headers.get('X-GitHub-Delivery')
+    if delivery and g.deliveries.seen(delivery):
+        return 'Duplicate delivery'
+
     payload = request.body.read()
     info = request.json
 
     lazy_debug(logger, lambda: 'info: {}'.format(utils.remove_url_keys_from_json(info)))
 
-    owner_info = info['repository']['owner']
-    owner = owner_info.get('login') or owner_info['name']
     try:
-        repo_label = g.repo_labels[owner, info['repository']['name']]
+        repo_label = github_repo_label(info)
     except KeyError:
         abort(500, 'Unknown repository')
     repo_cfg = g.repo_cfgs[repo_label]
@@ -214,6 +405,24 @@ def github():
 
     event_type = request.headers['X-Github-Event']
 
+    def handle():
+        if g.events:
+            g.events.put('github',
+                         github_event_key(repo_label, event_type, info),
+                         {'event_type': event_type},
+                         payload.decode('utf-8'))
+            response.status = 202
+            return 'Accepted'
+
+        return github_event(event_type, info, repo_label, repo_cfg, logger)
+
+    if not delivery:
+        return handle()
+    return deduplicate(delivery, handle)
+
+def github_event(event_type, info, repo_label, repo_cfg, logger):
+    db = Database()
+
     # pull_request_review_comment is triggered when a comment is created
     # on a portion of the unified diff of a pull request.
     if event_type == 'pull_request_review_comment':
@@ -290,17 +499,15 @@ def github():
 
         elif action == 'closed':
             try:
-                del g.states[repo_label][pull_num]
+                state = g.states[repo_label].pop(pull_num)
             except KeyError:
                 logger.error('Unknown PR.')
                 abort(500)
+            merge_shas.discard(state)
+            leave_train(state, logger)
 
-            with db.get_connection() as db_conn:
-                sql = 'DELETE FROM {} WHERE repo = %s AND num = %s'
-                for tbl in ['pull', 'build_res', 'mergeable']:
-                    db_conn.cursor().execute(sql.format(tbl), [repo_label,
-                                                               pull_num])
-                    db_conn.commit()
+            with db.unit_of_work() as uow:
+                uow.delete_pull(repo_label, pull_num)
 
             g.queue_handler()
 
@@ -320,17 +527,25 @@ def github():
     elif event_type == 'push':
         ref = info['ref'][len('refs/heads/'):]
 
-        for state in list(g.states[repo_label].values()):
-            if state.base_ref == ref:
-                state.set_mergeable(None, cause={
-                    'sha': info['head_commit']['id'],
-                    'title': info['head_commit']['message'].splitlines()[0],
-                })
+        if git.mirrors.enabled:
+            git.mirrors.get(repo_cfg).fetch_async()
 
-            if state.head_sha == info['before']:
-                state.head_advanced(info['after'])
+        repo_states = g.states[repo_label]
 
-                state.save()
+        for state in repo_states.find('base_ref', ref):
+            state.set_mergeable(None, cause={
+                'sha': info['head_commit']['id'],
+                'title': info['head_commit']['message'].splitlines()[0],
+            })
+
+        with Database().unit_of_work() as uow:
+            uow.on_commit(lambda: g.mergeable_que.refresh_head(
+                repo_states.ordered()))
+
+        for state in repo_states.find('head_sha', info['before']):
+            state.head_advanced(info['after'])
+
+            state.save()
 
     elif event_type == 'issue_comment':
         body = info['comment']['body']
@@ -341,7 +556,8 @@ def github():
 
         if 'pull_request' in info['issue'] and state:
             state.title = info['issue']['title']
-            state.body = info['issue']['body']
+            if state.body_changed(info['issue']['body']):
+                state.body = info['issue']['body']
 
             if parse_commands(
                 body,
@@ -357,6 +573,10 @@ def github():
                 g.queue_handler()
 
     elif event_type == 'status':
+        if 'status' in repo_cfg and \
+                info['context'] == repo_cfg['status']['context']:
+            release_slot(info['sha'], lambda x: x == repo_label)
+
         try: state, repo_label = find_state(info['sha'])
         except ValueError:
             return 'OK'
@@ -378,12 +598,71 @@ def github():
 
     return 'OK'
 
+# Fast-forwards the base branch of the pull request to its merge commit.
+def fast_forward(state, logger):
+    # TODO: Use lockit here.
+    try:
+        utils.github_set_ref(
+            state.get_repo(),
+            'heads/{}'.format(state.base_ref),
+            state.merge_sha,
+            auto_create=False)
+    except github3.models.GitHubError as e:
+        state.set_status('error')
+        desc = 'Test was successful, but fast-forwarding ' \
+                '{} to {} failed with `{}`'.format(state.base_ref,
+                                                   state.merge_sha,
+                                                   e)
+        utils.github_create_status(state.get_repo(),
+                                   state.head_sha, 'error', '',
+                                   desc, context='fast-forward')
+        state.add_comment(':heavy_exclamation_mark: ' + desc)
+        logger.error(desc)
+        return False
+
+    return True
+
+def report_merged(state, logger):
+    repo = state.get_repo()
+
+    # Delete the feature branch until we use lockit.
+    prefix = '{}:'.format(repo.owner.login)
+    pr_branch_name = state.head_ref.replace(prefix, 'heads/', 1)
+    pr_branch = repo.ref(pr_branch_name)
+    try:
+        pr_branch.delete()
+    except AttributeError as e:
+        msg = ':x: Failed to delete PR branch `{}`'
+        state.add_comment(msg.format(pr_branch_name))
+
+    merge_url = repo.commit(state.merge_sha).html_url
+    msg = 'Successfully merged {} {}'.format(state.base_ref,
+                                             merge_url)
+    logger.info(msg)
+
 def report_build_res(succ, url, builder, repo_label, state, logger,
                      context='homu'):
     lazy_debug(logger,
                lambda: 'build result {}: builder = {}, succ = {}, current build_res = {}'
                             .format(state, builder, succ, state.build_res_summary()))
 
+    batch = batches.of(state)
+    if isinstance(batch, Pipeline):
+        state.set_build_res(builder, succ, url)
+        report_pipeline_res(batch, succ, url, state, logger, context)
+        g.queue_handler()
+        return
+
+    if batch:
+        if batch.tested() is not state:
+            lazy_debug(logger, lambda: '{} is not being built'.format(state))
+            return
+
+        state.set_build_res(builder, succ, url)
+        report_batch_res(batch, succ, url, builder, state, logger, context)
+        g.queue_handler()
+        return
+
     state.set_build_res(builder, succ, url)
 
     if succ:
@@ -401,41 +680,8 @@ def report_build_res(succ, url, builder, repo_label, state, logger,
             state.add_comment(':white_check_mark: {} - {}'.format(desc, urls))
 
             if state.approved_by and not state.try_:
-                # TODO: Use lockit here.
-                repo = state.get_repo()
-                try:
-                    utils.github_set_ref(
-                        repo,
-                        'heads/{}'.format(state.base_ref),
-                        state.merge_sha,
-                        auto_create=False)
-                except github3.models.GitHubError as e:
-                    state.set_status('error')
-                    desc = 'Test was successful, but fast-forwarding ' \
-                            '{} to {} failed with `{}`'.format(state.base_ref,
-                                                               state.merge_sha,
-                                                               e)
-                    utils.github_create_status(state.get_repo(),
-                                               state.head_sha, 'error', '',
-                                               desc, context='fast-forward')
-                    state.add_comment(':heavy_exclamation_mark: ' + desc)
-                    logger.error(desc)
-
-                else:
-                    # Delete the feature branch until we use lockit.
-                    prefix = '{}:'.format(repo.owner.login)
-                    pr_branch_name = state.head_ref.replace(prefix, 'heads/', 1)
-                    pr_branch = repo.ref(pr_branch_name)
-                    try:
-                        pr_branch.delete()
-                    except AttributeError as e:
-                        msg = ':x: Failed to delete PR branch `{}`'
-                        state.add_comment(msg.format(pr_branch_name))
-
-                    merge_url = repo.commit(state.merge_sha).html_url
-                    msg = 'Successfully merged {} {}'.format(state.base_ref,
-                                                             merge_url)
-                    logger.info(msg)
+                if fast_forward(state, logger):
+                    report_merged(state, logger)
     else:
         if state.status == 'pending':
             state.set_status('failure')
@@ -449,122 +695,287 @@ def report_build_res(succ, url, builder, repo_label, state, logger,
 
     g.queue_handler()
 
+# Lands the pull requests of the batch that the build of state passed, or
+# records the failure for the next build of the batch to bisect.
+def report_batch_res(batch, succ, url, builder, state, logger, context):
+    repo_cfg = g.repo_cfgs[batch.repo_label]
+    members = batch.under_test()
+    max_size = lane_limit(repo_cfg, batch.base_ref,
+                          repo_cfg['batch'].get('size', 8))
+
+    if succ:
+        all_tests_passed = all(x['res'] for x in state.build_res.values())
+
+        if all_tests_passed or 'testrunners' in repo_cfg:
+            for member in members:
+                utils.github_create_status(member.get_repo(),
+                                           member.head_sha, 'success', url,
+                                           'Test successful', context=context)
+
+        if not all_tests_passed:
+            return
+
+        if not fast_forward(state, logger):
+            return
+
+        batch.passed()
+        batch.save()
+        if batch.landed == len(batch.states):
+            batches.resize(batch.repo_label, batch.base_ref, max_size, True)
+
+        urls = ', '.join('[{}]({})'.format(builder, x['url'])
+                         for builder, x in sorted(state.build_res.items()))
+        nums = ', '.join('#{}'.format(x.num) for x in members)
+        for member in members:
+            member.set_status('success')
+            member.add_comment(':white_check_mark: Test successful with {} '
+                               '- {}'.format(nums, urls))
+            report_merged(member, logger)
+
+    elif state.status == 'pending':
+        if batch.failing is None:
+            batches.resize(batch.repo_label, batch.base_ref, max_size,
+                           False)
+
+        batch.failed()
+        batch.save()
+        logger.info('Build of {} failed, bisecting {}'.format(
+            ', '.join('#{}'.format(x.num) for x in members), batch))
+
+# Lands the pull requests at the head of the pipeline whose builds passed, and
+# blames the first one whose build failed once none are ahead of it. The ones
+# behind a failed build go back to the queue.
+def report_pipeline_res(pipeline, succ, url, state, logger, context):
+    repo_cfg = g.repo_cfgs[pipeline.repo_label]
+    result = build_result(state)
+
+    if result or succ and 'testrunners' in repo_cfg:
+        utils.github_create_status(state.get_repo(), state.head_sha,
+                                   'success', url, 'Test successful',
+                                   context=context)
+
+    if result is False and state.status == 'pending':
+        for rest in pipeline.cut(state):
+            if rest.status == 'pending':
+                release(rest)
+
+    while True:
+        head = pipeline.pop_finished()
+        if not head:
+            break
+
+        if not build_result(head):
+            blame(head, repo_cfg, logger)
+            continue
+
+        if not fast_forward(head, logger):
+            for rest in pipeline.cut():
+                if rest.status == 'pending':
+                    release(rest)
+            break
+
+        head.set_status('success')
+        urls = ', '.join('[{}]({})'.format(builder, x['url'])
+                         for builder, x in sorted(head.build_res.items()))
+        head.add_comment(':white_check_mark: Test successful - {}'.format(urls))
+        report_merged(head, logger)
+
+    if pipeline.states:
+        pipeline.save()
+    else:
+        batches.remove(pipeline)
+
 @post('/buildbot')
+@unit_of_work
 def buildbot():
-    logger = g.logger.getChild('buildbot')
-
     response.content_type = 'text/plain'
 
-    lazy_debug(logger, lambda: 'info: {}'.format(info))
+    # Each build is checked against the secret of its own repository once it
+    # has been looked up, but a notification that has none of the secrets
+    # isn't even queued.
+    payload = request.body.read().decode('utf-8')
+    forms = {k: v[0] for k, v in urllib.parse.parse_qs(payload).items()}
+    if not buildbot_secret_known(forms.get('secret')):
+        abort(400, 'Invalid secret')
+
+    if g.events:
+        g.events.put('buildbot', 'buildbot', {}, payload)
+        response.status = 202
+        return 'Accepted'
+
+    return buildbot_event(payload, g.logger.getChild('buildbot'))
+
+def buildbot_authentic(repo_label, secret):
+    buildbot_cfg = g.repo_cfgs.get(repo_label, {}).get('buildbot')
+    return buildbot_cfg is not None and secret == buildbot_cfg['secret']
+
+def buildbot_secret_known(secret):
+    return any(buildbot_authentic(x, secret) for x in g.repo_cfgs)
+
+def buildbot_event(payload, logger):
+    forms = {k: v[0] for k, v in urllib.parse.parse_qs(payload).items()}
+
+    handlers = {
+        'buildFinished': buildbot_finished,
+        'buildStarted': buildbot_started,
+    }
+    for row in json.loads(forms['packets']):
+        handler = handlers.get(row['event'])
+        if not handler:
+            continue
 
-    for row in json.loads(request.forms.packets):
-        if row['event'] == 'buildFinished':
-            info = row['payload']['build']
-            props = dict(x[:2] for x in info['properties'])
+        info = row['payload']['build']
+        props = dict(x[:2] for x in info['properties'])
+        if not props['revision']:
+            continue
 
-            if 'retry' in info['text']: continue
+        # Buildbot sends a packet again when it is not answered in time. The
+        # build number tells a rebuild of the same revision from a resend.
+        key = 'buildbot:{}:{}:{}:{}:{}'.format(info['builderName'],
+                                               props['revision'],
+                                               props.get('buildnumber'),
+                                               row['event'],
+                                               info.get('results'))
+        deduplicate(key, partial(handler, info, props, forms, logger))
 
-            if not props['revision']: continue
+    return 'OK'
 
-            try: state, repo_label = find_state(props['revision'])
-            except ValueError:
-                lazy_debug(logger,
-                           lambda: 'Invalid commit ID from Buildbot: {}'.format(props['revision']))
-                continue
+# Reports the result of a builder's build of a merge.
+def buildbot_finished(info, props, forms, logger):
+    if 'retry' in info['text']: return
 
-            lazy_debug(logger, lambda: 'state: {}, {}'.format(state, state.build_res_summary()))
+    release_slot(props['revision'],
+                 lambda x: buildbot_authentic(x, forms.get('secret')))
 
-            if info['builderName'] not in state.build_res:
-                lazy_debug(logger,
-                           lambda: 'Invalid builder from Buildbot: {}'.format(info['builderName']))
-                continue
+    try: state, repo_label = find_state(props['revision'])
+    except ValueError:
+        lazy_debug(logger,
+                   lambda: 'Invalid commit ID from Buildbot: {}'.format(props['revision']))
+        return
 
-            repo_cfg = g.repo_cfgs[repo_label]
+    lazy_debug(logger, lambda: 'state: {}, {}'.format(state, state.build_res_summary()))
 
-            if request.forms.secret != repo_cfg['buildbot']['secret']:
-                abort(400, 'Invalid secret')
+    if info['builderName'] not in state.build_res:
+        lazy_debug(logger,
+                   lambda: 'Invalid builder from Buildbot: {}'.format(info['builderName']))
+        return
+
+    repo_cfg = g.repo_cfgs[repo_label]
 
-            build_succ = 'successful' in info['text'] or info['results'] == 0
+    if forms.get('secret') != repo_cfg['buildbot']['secret']:
+        abort(400, 'Invalid secret')
 
-            url = '{}/builders/{}/builds/{}'.format(
+    build_succ = 'successful' in info['text'] or info['results'] == 0
+
+    url = '{}/builders/{}/builds/{}'.format(
+        repo_cfg['buildbot']['url'],
+        info['builderName'],
+        props['buildnumber'],
+    )
+
+    if 'interrupted' in info['text']:
+        step_name = ''
+        for step in reversed(info['steps']):
+            if 'interrupted' in step.get('text', []):
+                step_name = step['name']
+                break
+
+        if step_name:
+            res = requests.get('{}/builders/{}/builds/{}/steps/{}/logs/interrupt'.format(
                 repo_cfg['buildbot']['url'],
                 info['builderName'],
                 props['buildnumber'],
-            )
+                step_name,
+            ))
 
-            if 'interrupted' in info['text']:
-                step_name = ''
-                for step in reversed(info['steps']):
-                    if 'interrupted' in step.get('text', []):
-                        step_name = step['name']
-                        break
+            mat = INTERRUPTED_BY_HOMU_RE.search(res.text)
+            if mat:
+                interrupt_token = mat.group(1)
+                if getattr(state, 'interrupt_token', '') != interrupt_token:
+                    state.interrupt_token = interrupt_token
 
-                if step_name:
-                    res = requests.get('{}/builders/{}/builds/{}/steps/{}/logs/interrupt'.format(
-                        repo_cfg['buildbot']['url'],
-                        info['builderName'],
-                        props['buildnumber'],
-                        step_name,
-                    ))
+                    if state.status == 'pending':
+                        state.set_status('')
 
-                    mat = INTERRUPTED_BY_HOMU_RE.search(res.text)
-                    if mat:
-                        interrupt_token = mat.group(1)
-                        if getattr(state, 'interrupt_token', '') != interrupt_token:
-                            state.interrupt_token = interrupt_token
+                        desc = ':warning: The build was interrupted ' \
+                            'to prioritize another pull request.'
+                        state.add_comment(desc)
+                        utils.github_create_status(state.get_repo(), state.head_sha, 'error', url, desc, context='homu')
 
-                            if state.status == 'pending':
-                                state.set_status('')
+                        g.queue_handler()
 
-                                desc = ':warning: The build was interrupted ' \
-                                    'to prioritize another pull request.'
-                                state.add_comment(desc)
-                                utils.github_create_status(state.get_repo(), state.head_sha, 'error', url, desc, context='homu')
+                return
 
-                                g.queue_handler()
+        else:
+            logger.error('Corrupt payload from Buildbot')
 
-                        continue
+    report_build_res(build_succ, url, info['builderName'], repo_label, state, logger)
 
-                else:
-                    logger.error('Corrupt payload from Buildbot')
+# Records the build of a merge a builder started, which frees its slot.
+def buildbot_started(info, props, forms, logger):
+    try: state, repo_label = find_state(props['revision'])
+    except ValueError: pass
+    else:
+        if info['builderName'] in state.build_res:
+            repo_cfg = g.repo_cfgs[repo_label]
 
-            report_build_res(build_succ, url, info['builderName'], repo_label, state, logger)
+            if forms.get('secret') != repo_cfg['buildbot']['secret']:
+                abort(400, 'Invalid secret')
 
-        elif row['event'] == 'buildStarted':
-            info = row['payload']['build']
-            props = dict(x[:2] for x in info['properties'])
+            url = '{}/builders/{}/builds/{}'.format(
+                repo_cfg['buildbot']['url'],
+                info['builderName'],
+                props['buildnumber'],
+            )
 
-            if not props['revision']: continue
+            state.set_build_res(info['builderName'], None, url)
 
-            try: state, repo_label = find_state(props['revision'])
-            except ValueError: pass
-            else:
-                if info['builderName'] in state.build_res:
-                    repo_cfg = g.repo_cfgs[repo_label]
+    release_slot(props['revision'],
+                 lambda x: buildbot_authentic(x, forms.get('secret')))
 
-                    if request.forms.secret != repo_cfg['buildbot']['secret']:
-                        abort(400, 'Invalid secret')
+@post('/travis')
+@unit_of_work
+def travis():
+    response.content_type = 'text/plain'
 
-                    url = '{}/builders/{}/builds/{}'.format(
-                        repo_cfg['buildbot']['url'],
-                        info['builderName'],
-                        props['buildnumber'],
-                    )
+    # The token is checked against the repository the notification is about
+    # here, and against the repository of the build once it has been looked
+    # up.
+    payload = request.body.read().decode('utf-8')
+    headers = {'Authorization': request.headers.get('Authorization', '')}
+    info = json.loads(request.forms.payload)
+    try:
+        repo_label = g.repo_labels[info['repository']['owner_name'],
+                                   info['repository']['name']]
+    except KeyError:
+        abort(500, 'Unknown repository')
+    if not travis_authentic(repo_label, headers['Authorization']):
+        abort(400, 'Authorization failed')
 
-                    state.set_build_res(info['builderName'], None, url)
+    if g.events:
+        g.events.put('travis', info['commit'], headers, payload)
+        response.status = 202
+        return 'Accepted'
 
-            if g.buildbot_slots[0] == props['revision']:
-                g.buildbot_slots[0] = ''
+    return travis_event(headers, payload, g.logger.getChild('travis'))
 
-                g.queue_handler()
+# Whether the Authorization header of a Travis notification was made with the
+# token of the repository.
+def travis_authentic(repo_label, auth_header):
+    repo_cfg = g.repo_cfgs.get(repo_label, {})
+    if 'travis' not in repo_cfg:
+        return False
 
-    return 'OK'
+    code = hashlib.sha256('{}/{}{}'.format(
+        repo_cfg['owner'], repo_cfg['name'], repo_cfg['travis']['token'],
+    ).encode('utf-8')).hexdigest()
+    return auth_header == code
 
-@post('/travis')
-def travis():
-    logger = g.logger.getChild('travis')
-
-    info = json.loads(request.forms.payload)
+def travis_event(headers, payload, logger):
+    forms = {k: v[0] for k, v in urllib.parse.parse_qs(payload).items()}
+    info = json.loads(forms['payload'])
+    release_slot(info['commit'],
+                 lambda x: travis_authentic(x, headers['Authorization']))
 
     lazy_debug(logger, lambda: 'info: {}'.format(utils.remove_url_keys_from_json(info)))
 
@@ -579,24 +990,27 @@ def travis():
         lazy_debug(logger, lambda: 'travis is not a monitored target for %s', state)
         return 'OK'
 
-    token = g.repo_cfgs[repo_label]['travis']['token']
-    auth_header = request.headers['Authorization']
-    code = hashlib.sha256(('{}/{}{}'.format(state.owner, state.name, token)).encode('utf-8')).hexdigest()
-    if auth_header != code:
+    auth_header = headers['Authorization']
+    if not travis_authentic(repo_label, auth_header):
         # this isn't necessarily an error, e.g. maybe someone is
         # fabricating travis notifications to try to trick Homu, but,
         # I imagine that this will most often occur because a repo is
         # misconfigured.
-        logger.warn('authorization failed for {}, maybe the repo has the wrong travis token? ' \
-                    'header = {}, computed = {}'
-                    .format(state, auth_header, code))
+        logger.warning('authorization failed for {}, maybe the repo has the wrong travis token? ' \
+                       'header = {}'
+                       .format(state, auth_header))
         abort(400, 'Authorization failed')
 
     succ = info['result'] == 0
 
-    report_build_res(succ, info['build_url'], 'travis', repo_label, state, logger)
+    def handle():
+        report_build_res(succ, info['build_url'], 'travis', repo_label, state, logger)
+        return 'OK'
 
-    return 'OK'
+    # A restarted build keeps its ID, but finishes at another time.
+    return deduplicate('travis:{}:{}:{}'.format(info['commit'], succ,
+                                                info.get('finished_at')),
+                       handle)
 
 @post('/teamcity')
 def testing_teamcity():
@@ -633,10 +1047,10 @@ def testing_teamcity():
 
 @post('/jenkins')
 @post('/solano')
+@unit_of_work
 def testrunner_callback():
     builder = request.path.lstrip('/')
     logger = g.logger.getChild(builder)
-    trigger_ready_for_delete = False
 
     debug = lambda msg: lazy_debug(logger, lambda: msg)
 
@@ -644,43 +1058,81 @@ def testrunner_callback():
         logger.error(log_msg)
         abort()
 
-    db = Database()
-
     postdata = {k:v for k,v in request.POST.allitems()}
     debug('postdata: {}'.format(postdata))
 
     try:
-        commit = hmac_commit = request.POST['commit']
+        commit = postdata['commit']
     except KeyError:
         error('POST to /{} specified no commit.'.format(builder))
-    with db.get_connection() as db_conn:
-        cursor = db_conn.cursor()
-        sql = 'SELECT branch, target_sha, build_count ' \
-              'FROM build_triggers WHERE trigger_sha = %s'
-        cursor.execute(sql, [commit])
-        row = cursor.fetchone()
-        if row:
-            trigger_branch, target_sha, build_count = row
-            debug('Using target {} from trigger {}.'.format(target_sha,
-                                                            commit))
-            cursor = db_conn.cursor()
-            build_count -= 1
-            if 0 < build_count:
-                sql = 'UPDATE build_triggers SET build_count = %s ' \
-                      'WHERE trigger_sha = %s'
-                cursor.execute(sql, [build_count, commit])
-            else:
-                trigger_ready_for_delete = True
-                # XXX Temporarily keep expired build_triggers for debugging.
-                sql = 'UPDATE build_triggers SET build_count = %s ' \
-                      'WHERE trigger_sha = %s'
-                cursor.execute(sql, [build_count, commit])
-                # sql = 'DELETE FROM build_triggers WHERE trigger_sha = %s'
-                # cursor.execute(sql, [commit])
-                # XXX
-            db_conn.commit()
-            hmac_commit = commit
-            commit = target_sha
+    try:
+        success = postdata['success']
+    except KeyError:
+        error('POST to /{} provided no success value.'.format(builder))
+    if 'key' not in g.cfg.get(builder, {}):
+        error('Configuration is missing {}.key.'.format(builder))
+    if 'hmac' not in postdata:
+        error('POST to /{} provided no hmac.'.format(builder))
+    if not testrunner_hmac_valid(builder, postdata):
+        error('On POST to /{}, status failed HMAC.'.format(builder))
+
+    def handle():
+        if g.events:
+            g.events.put(builder, commit, {}, json.dumps(postdata))
+            response.status = 202
+            return 'Accepted'
+
+        return testrunner_event(builder, postdata, logger)
+
+    # Jobs that report on the same commit, or run again, have their own URL.
+    return deduplicate('{}:{}:{}:{}'.format(builder, commit, success,
+                                            postdata.get('url', '')),
+                       handle)
+
+# Whether the HMAC of a testrunner's report was made with the key of its
+# builder.
+def testrunner_hmac_valid(builder, postdata):
+    key = g.cfg.get(builder, {}).get('key')
+    if key is None or 'hmac' not in postdata:
+        return False
+
+    msg = '{}:{}'.format(postdata.get('commit'), postdata.get('success'))
+    authentic_hmac = hmac.HMAC(key.encode('utf-8'), msg.encode('utf-8'),
+                               hashlib.sha256).hexdigest()
+    return hmac.compare_digest(postdata['hmac'], authentic_hmac)
+
+# The key of a builder is shared by every repository, so its reports are only
+# authentic for the repositories that build with it.
+def testrunner_authentic(repo_label, builder, postdata):
+    repo_cfg = g.repo_cfgs.get(repo_label, {})
+    builders = repo_cfg.get('testrunners', {}).get('builders', [])
+    return builder in builders and testrunner_hmac_valid(builder, postdata)
+
+def testrunner_event(builder, postdata, logger):
+    trigger_ready_for_delete = False
+
+    debug = lambda msg: lazy_debug(logger, lambda: msg)
+
+    def error(log_msg):
+        logger.error(log_msg)
+        abort()
+
+    db = Database()
+
+    commit = postdata['commit']
+    row = db.get_build_trigger(commit)
+    if row:
+        trigger_branch, target_sha, build_count = row
+        debug('Using target {} from trigger {}.'.format(target_sha, commit))
+        build_count -= 1
+        if 0 >= build_count:
+            trigger_ready_for_delete = True
+        # XXX Temporarily keep expired build_triggers for debugging instead of
+        # deleting them.
+        db.set_build_trigger_count(commit, build_count)
+        commit = target_sha
+    release_slot(commit,
+                 lambda x: testrunner_authentic(x, builder, postdata))
     try:
         state, repo_label = find_state(commit)
     except ValueError:
@@ -688,27 +1140,14 @@ def testrunner_callback():
     if builder not in state.build_res:
         error('{} is not a monitored target for {}'.format(builder, state))
     try:
-        success = bool(int(request.POST['success']))
-    except KeyError:
-        error('POST to /{} provided no success value.'.format(builder))
-    try:
-        key = g.cfg[builder]['key'].encode('utf-8')
-    except KeyError:
-        error('Configuration is missing {}.key.'.format(builder))
-
-    msg = '{}:{}'.format(hmac_commit, request.POST['success']).encode('utf-8')
-    authentic_hmac = hmac.HMAC(key, msg, hashlib.sha256).hexdigest()
-    try:
-        provided_hmac = request.POST['hmac']
-    except KeyError:
-        error('POST to /{} provided no hmac.'.format(builder))
-    if not hmac.compare_digest(provided_hmac, authentic_hmac):
-        error('On POST to /{}, status failed HMAC.'.format(builder))
+        success = bool(int(postdata['success']))
+    except ValueError:
+        error('POST to /{} provided an invalid success value.'.format(builder))
 
     debug('state: {}, {}'.format(state, state.build_res_summary()))
 
     report_build_res(succ=success,
-                     url=request.POST.get('url'),
+                     url=postdata.get('url'),
                      builder=builder,
                      repo_label=repo_label,
                      state=state,
@@ -718,13 +1157,27 @@ def testrunner_callback():
     if trigger_ready_for_delete:
         state.get_repo().ref('heads/{}'.format(trigger_branch)).delete()
 
+    return 'OK'
+
+def handle_event(source, headers, payload):
+    if source == 'github':
+        info = json.loads(payload)
+        repo_label = github_repo_label(info)
+        github_event(headers['event_type'], info, repo_label,
+                     g.repo_cfgs[repo_label], g.logger.getChild('github'))
+    elif source == 'buildbot':
+        buildbot_event(payload, g.logger.getChild('buildbot'))
+    elif source == 'travis':
+        travis_event(headers, payload, g.logger.getChild('travis'))
+    else:
+        testrunner_event(source, json.loads(payload),
+                         g.logger.getChild(source))
+
 def synch(user_gh, state, repo_label, repo_cfg, repo):
     if not repo.is_collaborator(user_gh.user().login):
         abort(400, 'You are not a collaborator')
 
-    Thread(target=synchronize, args=[repo_label, repo_cfg, g.logger, g.gh,
-                                     g.states, g.repos, g.mergeable_que,
-                                     g.my_username, g.repo_labels]).start()
+    g.sync.submit(repo_label, full=state.get('full', False))
 
     return 'Synchronizing {}...'.format(repo_label)
 
@@ -739,14 +1192,12 @@ def admin():
         repo_label = request.json['repo_label']
         repo_cfg = request.json['repo_cfg']
 
-        g.states[repo_label] = {}
+        g.states[repo_label] = RepoStates()
         g.repos[repo_label] = None
         g.repo_cfgs[repo_label] = repo_cfg
         g.repo_labels[repo_cfg['owner'], repo_cfg['name']] = repo_label
 
-        Thread(target=synchronize, args=[repo_label, repo_cfg, g.logger, g.gh,
-                                         g.states, g.repos, g.mergeable_que,
-                                         g.my_username, g.repo_labels]).start()
+        g.sync.submit(repo_label)
 
         return 'OK'
 
@@ -754,13 +1205,10 @@ def admin():
         repo_label = request.json['repo_label']
         repo_cfg = g.repo_cfgs[repo_label]
 
-        for tbl in ['pull', 'build_res', 'mergeable']:
-            sql = 'DELETE FROM {} WHERE repo = %s'.format(tbl)
-            with db.get_connection() as db_conn:
-                db_conn.cursor().execute(sql, [repo_label])
-                db_conn.commit()
+        db.delete_repo(repo_label)
 
-        del g.states[repo_label]
+        for state in g.states.pop(repo_label).values():
+            merge_shas.discard(state)
         del g.repos[repo_label]
         del g.repo_cfgs[repo_label]
         del g.repo_labels[repo_cfg['owner'], repo_cfg['name']]
@@ -780,8 +1228,8 @@ def admin():
 
     return 'Unrecognized command'
 
-def start(cfg, states, queue_handler, repo_cfgs, repos, logger, buildbot_slots,
-          my_username, repo_labels, mergeable_que, gh):
+def start(cfg, states, queue_handler, repo_cfgs, repos, logger, slots,
+          my_username, repo_labels, mergeable_que, gh, sync_executor):
     env = jinja2.Environment(
         loader = jinja2.FileSystemLoader(pkg_resources.resource_filename(__name__, 'html')),
         autoescape = True,
@@ -796,12 +1244,27 @@ def start(cfg, states, queue_handler, repo_cfgs, repos, logger, buildbot_slots,
     g.repo_cfgs = repo_cfgs
     g.repos = repos
     g.logger = logger.getChild('server')
-    g.buildbot_slots = buildbot_slots
+    g.slots = slots
     g.tpls = tpls
     g.my_username = my_username
     g.repo_labels = repo_labels
     g.mergeable_que = mergeable_que
     g.gh = gh
+    g.sync = sync_executor
+
+    g.deliveries = DeliveryCache(
+        size=cfg['web'].get('delivery_cache_size', 10000),
+        ttl=cfg['web'].get('delivery_ttl', 3600),
+        persist=cfg['web'].get('persist_deliveries', False),
+    )
+
+    # With webhook_workers set, webhooks are acknowledged as soon as they are
+    # verified and stored, and processed in the background.
+    workers = cfg['web'].get('webhook_workers', 0)
+    g.events = EventQueue(handle_event, workers, g.logger.getChild('events')) \
+        if workers else None
+    if g.events:
+        g.events.replay()
 
     # Heroku provides us with a specified port.
     # We may want to use the configuration file for a port in production.
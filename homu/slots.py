@@ -0,0 +1,189 @@
+import math
+import threading
+import time
+
+
+# A slot taken by a build, in every pool the build runs in. It is bound to the
+# build's merge commit once the build has been triggered.
+class Reservation:
+    def __init__(self, repo_label, pools, deadline):
+        self.repo_label = repo_label
+        self.pools = pools
+        self.deadline = deadline
+        self.sha = ''
+
+    def __repr__(self):
+        return 'Reservation:{}:{}({})'.format(
+            self.repo_label, self.sha or '-', ', '.join(self.pools))
+
+
+# The CI capacity builds are started within. Every build takes a slot in each
+# pool it runs in, its CI backend and each of its builders, from the moment it
+# is triggered until the CI reports that it started or sends its first result.
+# Reservations that are never released expire after `timeout` seconds.
+#
+# Pools without a capacity are unlimited, except buildbot's, which builds one
+# merge at a time. Try builds take their slots in pools of their own, so that
+# they never hold the ones the queue needs. A repository that holds its share
+# of a full pool cannot take the slots that free up while another one waits
+# with a pull request of the same or a higher priority. Repositories wait from
+# the queue pass they were turned away in until the end of the next one.
+class SlotScheduler:
+    DEFAULT_CAPACITY = {'buildbot': 1, 'buildbot/try': 1}
+
+    def __init__(self, capacity=None, timeout=3600):
+        self.capacity = dict(self.DEFAULT_CAPACITY, **(capacity or {}))
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.reservations = []
+        # Priorities of the repositories waiting for each pool, in this pass
+        # and the one before it.
+        self.waiting = {}
+        self.waited = {}
+        self.granted = {}
+
+        self.acquired = 0
+        self.refused = 0
+        self.released = 0
+        self.expired = 0
+
+    def expire(self, now):
+        live = [x for x in self.reservations if x.deadline > now]
+        self.expired += len(self.reservations) - len(live)
+        self.reservations = live
+
+    def held(self, pool, repo_label=None):
+        return len([x for x in self.reservations
+                    if pool in x.pools and
+                    (repo_label is None or x.repo_label == repo_label)])
+
+    # Called at the start of every pass over the queue.
+    def begin_pass(self):
+        with self.lock:
+            self.waited = self.waiting
+            self.waiting = {}
+
+    # Whether repo_label may take a slot of the pool now, given the slots it
+    # holds and the repositories waiting for it.
+    def admits(self, pool, repo_label, priority):
+        capacity = self.capacity.get(pool)
+        if capacity is None:
+            return True
+        if self.held(pool) >= capacity:
+            return False
+
+        rivals = {x for waiting in [self.waited, self.waiting]
+                  for x, prio in waiting.get(pool, {}).items()
+                  if x != repo_label and prio >= priority}
+        if not rivals:
+            return True
+        share = math.ceil(capacity / (len(rivals) + 1))
+        return self.held(pool, repo_label) < share
+
+    # Takes a slot in each of the pools for a build of repo_label, or returns
+    # None if one of them has none to spare.
+    def reserve(self, repo_label, pools, priority=0):
+        now = time.monotonic()
+        with self.lock:
+            self.expire(now)
+
+            refused = [x for x in pools
+                       if not self.admits(x, repo_label, priority)]
+            if refused:
+                self.refused += 1
+                for pool in refused:
+                    waiting = self.waiting.setdefault(pool, {})
+                    waiting[repo_label] = max(waiting.get(repo_label, priority),
+                                              priority)
+                return None
+
+            reservation = Reservation(repo_label, list(pools),
+                                      now + self.timeout)
+            self.reservations.append(reservation)
+            self.granted[repo_label] = now
+            self.acquired += 1
+            for pool in pools:
+                self.waiting.get(pool, {}).pop(repo_label, None)
+                self.waited.get(pool, {}).pop(repo_label, None)
+            return reservation
+
+    # Ties the reservation to the build of sha, which releases it.
+    def bind(self, reservation, sha):
+        with self.lock:
+            reservation.sha = sha
+
+    # Frees a reservation that was not bound to a build after all.
+    def cancel(self, reservation):
+        with self.lock:
+            if not reservation.sha and reservation in self.reservations:
+                self.reservations.remove(reservation)
+
+    # The repository whose build of sha holds slots, if any, so that a report
+    # on it can be authenticated before the slots are released.
+    def holder(self, sha):
+        with self.lock:
+            for reservation in self.reservations:
+                if reservation.sha == sha:
+                    return reservation.repo_label
+            return None
+
+    # Frees the slots of the build of sha. Returns whether it held any.
+    def release(self, sha):
+        with self.lock:
+            held = [x for x in self.reservations if x.sha == sha]
+            for reservation in held:
+                self.reservations.remove(reservation)
+            self.released += len(held)
+            return bool(held)
+
+    # Repositories in the order they should be offered slots: the one whose
+    # next build has the highest priority first, then the ones holding the
+    # fewest slots, then the one served longest ago.
+    def order(self, priorities):
+        with self.lock:
+            self.expire(time.monotonic())
+            held = {}
+            for reservation in self.reservations:
+                held[reservation.repo_label] = \
+                    held.get(reservation.repo_label, 0) + 1
+
+            return sorted(priorities, key=lambda x: (
+                -priorities[x], held.get(x, 0), self.granted.get(x, 0)))
+
+    def stats(self):
+        with self.lock:
+            self.expire(time.monotonic())
+            pools = set(self.capacity)
+            for reservation in self.reservations:
+                pools.update(reservation.pools)
+
+            return {
+                'pools': {x: {
+                    'capacity': self.capacity.get(x),
+                    'held': self.held(x),
+                    'waiting': sorted(set(self.waiting.get(x, {})) |
+                                      set(self.waited.get(x, {}))),
+                } for x in sorted(pools)},
+                'reservations': [repr(x) for x in self.reservations],
+                'acquired': self.acquired,
+                'refused': self.refused,
+                'released': self.released,
+                'expired': self.expired,
+            }
+
+
+# The pools a build of the repository on builders runs in: the CI backend, or
+# the pool the repository names instead, and one per builder. Try builds run
+# in the try pool of the backend instead, "backend/try", and its builders'.
+def build_pools(repo_cfg, builders, try_=False):
+    for backend in ['buildbot', 'travis', 'status', 'testrunners']:
+        if backend in repo_cfg:
+            break
+    else:
+        raise RuntimeError('Invalid configuration')
+
+    pool = repo_cfg.get('slots', {}).get('pool', backend)
+    if try_:
+        pool += '/try'
+    return [pool] + ['{}/{}'.format(pool, x) for x in builders]
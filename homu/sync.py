@@ -0,0 +1,347 @@
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+import threading
+import time
+import traceback
+
+import github3
+
+from . import utils
+
+# A comment as synchronize sees it. commit_id is the commit a review comment
+# was made on, and empty for issue comments.
+Comment = namedtuple('Comment', ['id', 'body', 'login', 'commit_id'])
+
+
+# A pull request as synchronize sees it, whichever API it was read from.
+# homu_status is None when it has not been read yet, see homu_status().
+# iter_review_comments and iter_issue_comments take the time of the last
+# synchronization, and may leave out comments that have not changed since.
+class PullRecord:
+    __slots__ = ['number', 'head_sha', 'title', 'body', 'head_ref',
+                 'base_ref', 'assignee', 'updated_at', 'homu_status',
+                 'iter_review_comments', 'iter_issue_comments']
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+
+class SyncError(Exception):
+    pass
+
+
+def homu_status(repo, record):
+    if record.homu_status is None:
+        record.homu_status = ''
+        for info in utils.github_iter_statuses(repo, record.head_sha):
+            if info.context == 'homu':
+                record.homu_status = info.state
+                break
+    return record.homu_status
+
+
+def rest_review_comments(repo, num, since=None):
+    for x in utils.github_iter_comments(repo, num, 'pulls', since):
+        yield Comment(x.id, x.body, x.user.login, x.original_commit_id)
+
+
+def rest_issue_comments(repo, num, since=None):
+    for x in utils.github_iter_comments(repo, num, 'issues', since):
+        yield Comment(x.id, x.body, x.user.login, '')
+
+
+# Pull requests read with the REST API. Comments are only requested when they
+# are iterated, so skipped pull requests cost nothing more.
+def rest_pulls(repo):
+    for pull in repo.iter_pulls(state='open'):
+        yield PullRecord(
+            number=pull.number,
+            head_sha=pull.head.sha,
+            title=pull.title,
+            body=pull.body,
+            head_ref=pull.head.repo[0] + ':' + pull.head.ref,
+            base_ref=pull.base.ref,
+            assignee=pull.assignee.login if pull.assignee else '',
+            updated_at=pull.updated_at,
+            iter_review_comments=partial(rest_review_comments, repo,
+                                         pull.number),
+            iter_issue_comments=partial(rest_issue_comments, repo,
+                                        pull.number),
+        )
+
+
+PULLS_QUERY = '''
+query($owner: String!, $name: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: OPEN, first: 50, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        title
+        body
+        updatedAt
+        headRefOid
+        headRefName
+        headRepositoryOwner { login }
+        baseRefName
+        assignees(first: 1) { nodes { login } }
+        commits(last: 1) {
+          nodes { commit { status { context(name: "homu") { state } } } }
+        }
+        comments(first: 100) {
+          pageInfo { hasNextPage endCursor }
+          nodes { databaseId body author { login } }
+        }
+        reviews(first: 20) {
+          pageInfo { hasNextPage }
+          nodes {
+            comments(first: 50) {
+              pageInfo { hasNextPage }
+              nodes {
+                databaseId body createdAt author { login }
+                originalCommit { oid }
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+'''
+
+COMMENTS_QUERY = '''
+query($owner: String!, $name: String!, $number: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      comments(first: 100, after: $cursor) {
+        pageInfo { hasNextPage endCursor }
+        nodes { databaseId body author { login } }
+      }
+    }
+  }
+}
+'''
+
+
+def graphql(gh, query, variables):
+    try:
+        res = gh._json(gh._post(gh._build_url('graphql'),
+                                data={'query': query, 'variables': variables}),
+                       200)
+    except github3.models.GitHubError as e:
+        raise SyncError('GraphQL request failed: {}'.format(e))
+
+    if not res or res.get('errors'):
+        raise SyncError('GraphQL request failed: {}'.format(
+            res.get('errors') if res else 'no response'))
+
+    return res['data']
+
+
+def login(node):
+    # Deleted accounts are shown as ghost, like the REST API does.
+    return node['author']['login'] if node['author'] else 'ghost'
+
+
+def parse_time(value):
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ') \
+        .replace(tzinfo=timezone.utc)
+
+
+# Pull requests read with the GraphQL API, fifty with their comments and homu
+# status per request. The few pull requests with more comments than fit in the
+# first page have the rest requested separately.
+def graphql_pulls(gh, repo):
+    variables = {'owner': repo.owner.login, 'name': repo.name, 'cursor': None}
+
+    while True:
+        data = graphql(gh, PULLS_QUERY, variables)
+        if not data['repository']:
+            raise SyncError('Repository {}/{} not found'
+                            .format(variables['owner'], variables['name']))
+        pulls = data['repository']['pullRequests']
+
+        for node in pulls['nodes']:
+            yield graphql_record(gh, repo, node)
+
+        if not pulls['pageInfo']['hasNextPage']:
+            break
+        variables['cursor'] = pulls['pageInfo']['endCursor']
+
+
+# GraphQL commit status states as the REST API names them. EXPECTED, a
+# status that a branch protection rule waits for but that has not been set,
+# has no REST counterpart and is left out like a missing status.
+STATUS_STATES = {
+    'ERROR': 'error',
+    'FAILURE': 'failure',
+    'PENDING': 'pending',
+    'SUCCESS': 'success',
+}
+
+
+def graphql_record(gh, repo, node):
+    status = ''
+    commits = node['commits']['nodes']
+    if commits and commits[0]['commit']['status']:
+        context = commits[0]['commit']['status']['context']
+        if context:
+            status = STATUS_STATES.get(context['state'], '')
+
+    assignees = node['assignees']['nodes']
+    owner = node['headRepositoryOwner']
+
+    issue_comments = [Comment(x['databaseId'], x['body'], login(x), '')
+                      for x in node['comments']['nodes']]
+    page_info = node['comments']['pageInfo']
+    while page_info['hasNextPage']:
+        comments = graphql(gh, COMMENTS_QUERY, {
+            'owner': repo.owner.login,
+            'name': repo.name,
+            'number': node['number'],
+            'cursor': page_info['endCursor'],
+        })['repository']['pullRequest']['comments']
+        issue_comments.extend(Comment(x['databaseId'], x['body'], login(x), '')
+                              for x in comments['nodes'])
+        page_info = comments['pageInfo']
+
+    reviews = node['reviews']
+    if reviews['pageInfo']['hasNextPage'] or \
+            any(x['comments']['pageInfo']['hasNextPage']
+                for x in reviews['nodes']):
+        iter_review_comments = partial(rest_review_comments, repo,
+                                       node['number'])
+    else:
+        nodes = sorted((x for review in reviews['nodes']
+                        for x in review['comments']['nodes']),
+                       key=lambda x: x['createdAt'])
+        review_comments = [
+            Comment(x['databaseId'], x['body'], login(x),
+                    x['originalCommit']['oid'] if x['originalCommit'] else '')
+            for x in nodes
+        ]
+        iter_review_comments = lambda since=None: review_comments
+
+    return PullRecord(
+        number=node['number'],
+        head_sha=node['headRefOid'],
+        title=node['title'],
+        body=node['body'],
+        head_ref=(owner['login'] if owner else '') + ':' + node['headRefName'],
+        base_ref=node['baseRefName'],
+        assignee=assignees[0]['login'] if assignees else '',
+        updated_at=parse_time(node['updatedAt']),
+        homu_status=status,
+        iter_review_comments=iter_review_comments,
+        iter_issue_comments=lambda since=None: issue_comments,
+    )
+
+
+def iter_pulls(gh, repo, engine):
+    if engine == 'graphql':
+        return graphql_pulls(gh, repo)
+    return rest_pulls(repo)
+
+
+# A synchronization of one repository, running or waiting to run. map runs the
+# per pull request work on the executor's shared pool and counts it as done.
+class SyncJob:
+    def __init__(self, repo_label, full, pool):
+        self.repo_label = repo_label
+        self.full = full
+        self.pool = pool
+
+        self.lock = threading.Lock()
+        self.started_at = None
+        self.total = None
+        self.done = 0
+
+    def map(self, func, items):
+        items = list(items)
+        with self.lock:
+            self.total = len(items)
+
+        def run(item):
+            try:
+                return func(item)
+            finally:
+                with self.lock:
+                    self.done += 1
+
+        return list(self.pool.map(run, items))
+
+    def status(self):
+        with self.lock:
+            eta = None
+            if self.started_at and self.total and self.done:
+                elapsed = time.time() - self.started_at
+                eta = elapsed / self.done * (self.total - self.done)
+
+            return {
+                'repo_label': self.repo_label,
+                'full': self.full,
+                'running': self.started_at is not None,
+                'done': self.done,
+                'total': self.total,
+                'eta': eta,
+            }
+
+
+# Runs synchronizations with at most `repos` repositories at once, sharing
+# `workers` threads for their pull requests. A repository that is already
+# waiting is not queued again, and one that is running is queued once more to
+# pick up what changed while it ran.
+class SyncExecutor:
+    def __init__(self, run, *, workers=4, repos=2, logger):
+        self.run = run
+        self.logger = logger
+        self.pool = ThreadPoolExecutor(workers)
+
+        self.cond = threading.Condition()
+        self.waiting = OrderedDict()
+        self.running = {}
+
+        for _ in range(repos):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def submit(self, repo_label, *, full=False):
+        with self.cond:
+            job = self.waiting.get(repo_label)
+            if job:
+                job.full = job.full or full
+                return False
+
+            self.waiting[repo_label] = SyncJob(repo_label, full, self.pool)
+            self.cond.notify()
+            return True
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not any(x not in self.running for x in self.waiting):
+                    self.cond.wait()
+
+                repo_label = next(x for x in self.waiting
+                                  if x not in self.running)
+                job = self.waiting.pop(repo_label)
+                job.started_at = time.time()
+                self.running[repo_label] = job
+
+            try:
+                self.run(repo_label, full=job.full, job=job)
+            except Exception:
+                self.logger.error('Failed to synchronize {}:\n{}'.format(
+                    repo_label, traceback.format_exc()))
+            finally:
+                with self.cond:
+                    del self.running[repo_label]
+                    self.cond.notify_all()
+
+    def status(self):
+        with self.cond:
+            jobs = list(self.running.values()) + list(self.waiting.values())
+        return [x.status() for x in jobs]
@@ -33,6 +33,20 @@ def github_create_status(repo, sha, state, target_url='', description='', *,
     js = repo._json(repo._post(url, data=data), 201)
     return Status(js) if js else None
 
+def github_create_comment(repo, num, body):
+    url = repo._build_url('issues', str(num), 'comments', base_url=repo._api)
+    js = repo._json(repo._post(url, data={'body': body}), 201)
+    return github3.issues.comment.IssueComment(js, repo) if js else None
+
+# Review comments with kind 'pulls', issue comments with kind 'issues'. With
+# since, only comments created or updated since then are returned.
+def github_iter_comments(repo, num, kind, since=None):
+    url = repo._build_url(kind, str(num), 'comments', base_url=repo._api)
+    params = {'since': since.strftime('%Y-%m-%dT%H:%M:%SZ')} if since else None
+    cls = github3.pulls.ReviewComment if kind == 'pulls' \
+        else github3.issues.comment.IssueComment
+    return repo._iter(-1, url, cls, params=params)
+
 def remove_url_keys_from_json(json):
     if isinstance(json, dict):
         return {key: remove_url_keys_from_json(value)
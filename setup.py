@@ -19,6 +19,7 @@ setup(
     package_data={
         'homu': [
             'html/*.html',
+            '*.sql',
         ],
     },
     entry_points={
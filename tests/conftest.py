@@ -0,0 +1,52 @@
+import pytest
+
+from homu.database import Database
+from homu.indexes import RepoStates, merge_shas
+from homu.main import PullReqState
+from homu.mergeability import MergeabilityQueue
+
+
+# Database is a singleton, so every test shares one SQLite database, created
+# before anything else asks for it.
+@pytest.fixture(scope='session', autouse=True)
+def db(tmp_path_factory):
+    db = Database({'engine': 'sqlite',
+                   'path': str(tmp_path_factory.mktemp('db') / 'homu.db')})
+    db.init_schema()
+    return db
+
+
+@pytest.fixture
+def mergeable_que():
+    return MergeabilityQueue()
+
+
+# Makes pull request states of one repository, added to repo_states unless
+# told otherwise. Their merge commits are taken out of the global index again
+# once the test is done.
+@pytest.fixture
+def make_state(request, mergeable_que):
+    repo_label = 'test-{}'.format(request.node.name)
+    repo_states = RepoStates()
+    made = []
+
+    def make_state(num, head_sha=None, *, base_ref='master', status='',
+                   add=True, **fields):
+        state = PullReqState(num, head_sha or '{:040x}'.format(num), status,
+                             repo_label, mergeable_que, None, 'owner', 'name',
+                             {repo_label: None})
+        state.title = 'Pull request {}'.format(num)
+        state.base_ref = base_ref
+        for name, value in fields.items():
+            setattr(state, name, value)
+        if add:
+            repo_states[num] = state
+        made.append(state)
+        return state
+
+    make_state.repo_label = repo_label
+    make_state.repo_states = repo_states
+    yield make_state
+
+    for state in made:
+        merge_shas.discard(state)
@@ -0,0 +1,347 @@
+import json
+import threading
+import time
+
+import pytest
+import requests
+import requests.adapters
+import requests.structures
+
+from homu import api
+from homu.api import (API_URL, HIGH, LOW, NORMAL, AppCredential, Credential,
+                      CredentialPool, GitHubAdapter, RateLimiter,
+                      ResponseCache)
+
+
+# Answers requests with the responses it is given instead of going to GitHub,
+# and records what it was sent.
+class Transport(requests.adapters.HTTPAdapter):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.responses = []
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request.copy())
+        status_code, headers, content = self.responses.pop(0)
+
+        resp = requests.Response()
+        resp.status_code = status_code
+        resp.headers = requests.structures.CaseInsensitiveDict(headers)
+        resp._content = content
+        resp._content_consumed = True
+        resp.url = request.url
+        resp.request = request
+        resp.connection = self
+        return resp
+
+
+class FakeGitHubAdapter(GitHubAdapter, Transport):
+    pass
+
+
+def make_session(tokens=['token'], *, cache=None, reserves=None,
+                 repo_credentials={}):
+    credentials = [Credential(str(i), token, RateLimiter(reserves=reserves))
+                   for i, token in enumerate(tokens)]
+    adapter = FakeGitHubAdapter(
+        CredentialPool(credentials, repo_credentials), cache=cache)
+    session = requests.Session()
+    session.mount(API_URL, adapter)
+    return session, adapter
+
+
+def test_not_modified_responses_come_from_the_cache():
+    session, adapter = make_session(cache=ResponseCache(ttls=[]))
+    url = API_URL + 'repos/owner/name/pulls/1'
+    adapter.responses = [(200, {'ETag': '"v1"'}, b'{"number": 1}'),
+                         (304, {'ETag': '"v1"'}, b'')]
+
+    assert session.get(url).json() == {'number': 1}
+    resp = session.get(url)
+    assert resp.status_code == 200
+    assert resp.json() == {'number': 1}
+
+    assert 'If-None-Match' not in adapter.sent[0].headers
+    assert adapter.sent[1].headers['If-None-Match'] == '"v1"'
+    stats = adapter.cache.stats()
+    assert (stats['misses'], stats['revalidated']) == (1, 1)
+
+
+def test_responses_are_cached_by_url_and_accept():
+    session, adapter = make_session(cache=ResponseCache(ttls=[]))
+    url = API_URL + 'repos/owner/name/pulls/1'
+    adapter.responses = [
+        (200, {'ETag': '"json"'}, b'{}'),
+        (200, {'ETag': '"diff"'}, b'diff'),
+        (200, {'ETag': '"other"'}, b'{}'),
+        (304, {}, b''),
+    ]
+
+    session.get(url)
+    diff = session.get(url, headers={'Accept': 'application/vnd.github.diff'})
+    assert diff.content == b'diff'
+    session.get(url + '?page=2')
+    assert session.get(url, headers={
+        'Accept': 'application/vnd.github.diff'}).content == b'diff'
+
+    assert [x.headers.get('If-None-Match') for x in adapter.sent] == \
+        [None, None, None, '"diff"']
+
+
+def test_fresh_responses_skip_github_and_writes_drop_them():
+    session, adapter = make_session(
+        cache=ResponseCache(ttls=[(r'/repos/[^/]+/[^/]+$', 300)]))
+    url = API_URL + 'repos/owner/name'
+    adapter.responses = [(200, {'ETag': '"v1"'}, b'{"v": 1}'),
+                         (200, {}, b''),
+                         (200, {'ETag': '"v2"'}, b'{"v": 2}')]
+
+    session.get(url)
+    assert session.get(url).json() == {'v': 1}
+    assert len(adapter.sent) == 1
+
+    session.patch(url, json={'description': ''})
+    assert session.get(url).json() == {'v': 2}
+    assert 'If-None-Match' not in adapter.sent[2].headers
+
+
+def test_cache_is_bounded_by_size_and_bytes():
+    class Resp:
+        status_code = 200
+        encoding = 'utf-8'
+
+        def __init__(self, content):
+            self.headers = {'ETag': '"x"'}
+            self.content = content
+
+    cache = ResponseCache(size=2, max_bytes=10)
+    for key in ['a', 'b', 'c']:
+        cache.put(key, api.CacheEntry(Resp(b'1234'), 0))
+    assert list(cache.entries) == ['b', 'c']
+
+    cache.get('b')
+    cache.put('d', api.CacheEntry(Resp(b'12345678'), 0))
+    assert list(cache.entries) == ['d']
+    assert cache.stats()['bytes'] == 8
+    assert cache.stats()['evictions'] == 3
+
+
+def wait_for(cond, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.001)
+
+
+def rate_limit(remaining, reset=None, resource='core'):
+    return {
+        'X-RateLimit-Limit': '5000',
+        'X-RateLimit-Remaining': str(remaining),
+        'X-RateLimit-Reset': str(int(reset or time.time() + 3600)),
+        'X-RateLimit-Resource': resource,
+    }
+
+
+# Leaves the limiter with `remaining` requests in the current window.
+def limited(remaining, **kwargs):
+    limiter = RateLimiter(**kwargs)
+    limiter.acquire(HIGH)
+    limiter.release(rate_limit(remaining))
+    return limiter
+
+
+def test_requests_are_prioritized_by_what_they_do():
+    def priority(method, path):
+        return api.request_priority(
+            requests.Request(method, API_URL + path).prepare())
+
+    assert priority('POST', 'repos/owner/name/statuses/' + 'a' * 40) == HIGH
+    assert priority('PATCH', 'repos/owner/name/git/refs/heads/auto') == HIGH
+    assert priority('POST', 'repos/owner/name/issues/1/comments') == NORMAL
+    assert priority('GET', 'repos/owner/name/git/refs/heads/auto') == NORMAL
+
+    with api.priority(LOW):
+        assert priority('POST', 'repos/owner/name/merges') == LOW
+
+    @api.prioritized(HIGH)
+    def merge_priority():
+        return priority('GET', 'repos/owner/name')
+    assert merge_priority() == HIGH
+    assert priority('GET', 'repos/owner/name') == NORMAL
+
+
+def test_lower_priorities_keep_a_reserve():
+    limiter = limited(150)
+    assert [limiter.allowed(x) for x in [HIGH, NORMAL, LOW]] == \
+        [True, True, False]
+
+    # Requests in flight count against what is left.
+    limiter.acquire(NORMAL)
+    limiter.acquire(NORMAL)
+    assert limiter.headroom() == 148
+    for _ in range(48):
+        limiter.acquire(NORMAL)
+    assert not limiter.allowed(NORMAL)
+    assert limiter.allowed(HIGH)
+
+
+def test_deferred_requests_go_once_the_limit_resets():
+    limiter = limited(150)
+
+    thread = threading.Thread(target=limiter.acquire, args=[LOW])
+    thread.start()
+    wait_for(lambda: limiter.stats()['priorities']['low']['waiting'] == 1)
+
+    limiter.acquire(HIGH)
+    limiter.release(rate_limit(5000))
+    thread.join(5)
+    stats = limiter.stats()['priorities']['low']
+    assert (stats['requests'], stats['deferred'], stats['waiting']) == \
+        (1, 1, 0)
+
+
+def test_waiting_requests_hold_back_lower_priorities():
+    limiter = limited(0, reserves=[0, 0, 0])
+
+    thread = threading.Thread(target=limiter.acquire, args=[HIGH])
+    thread.start()
+    wait_for(lambda: limiter.stats()['priorities']['high']['waiting'] == 1)
+
+    with limiter.cond:
+        limiter.remaining = 10
+        assert limiter.allowed(HIGH)
+        assert not limiter.allowed(NORMAL)
+
+    limiter.acquire(HIGH)
+    limiter.release(rate_limit(10))
+    thread.join(5)
+    assert limiter.allowed(NORMAL)
+
+
+def test_a_new_window_lets_requests_through():
+    limiter = RateLimiter()
+    limiter.acquire(HIGH)
+    limiter.release(rate_limit(0, reset=time.time() - 1))
+    assert limiter.allowed(LOW)
+    assert limiter.remaining is None
+
+
+def test_other_rate_limits_are_not_tracked():
+    limiter = limited(1000)
+    limiter.acquire(LOW)
+    limiter.release(rate_limit(0, resource='search'))
+    assert limiter.stats()['remaining'] == 1000
+
+    # Without reserves, the rate limit is tracked but never waited for.
+    limiter = limited(0, reserves=None)
+    assert limiter.allowed(LOW)
+    assert limiter.stats()['remaining'] == 0
+
+
+def test_writes_stick_to_the_repository_credential():
+    session, adapter = make_session(['primary', 'other'], repo_credentials={
+        ('owner', 'name'): 1,
+    })
+    primary, other = adapter.credentials.credentials
+    adapter.responses = [(201, {}, b'{}')] * 3
+
+    session.post(API_URL + 'repos/Owner/Name/issues/1/comments', json={})
+    session.post(API_URL + 'repos/owner/other/issues/1/comments', json={})
+    session.post(API_URL + 'user/repos', json={})
+    assert [x.headers['Authorization'] for x in adapter.sent] == \
+        ['token other', 'token primary', 'token primary']
+
+
+def test_reads_go_to_the_credential_with_the_most_left():
+    session, adapter = make_session(['a', 'b', 'c'])
+    url = API_URL + 'repos/owner/name'
+    adapter.responses = [(200, rate_limit(remaining), b'{}')
+                         for remaining in [4000, 3000, 2000]]
+
+    # Unknown limits count as unlimited, so each one is tried once first.
+    for _ in range(3):
+        session.get(url)
+    assert len({x.headers['Authorization'] for x in adapter.sent}) == 3
+
+    pool = adapter.credentials
+    assert pool.for_read().name == '0'
+    assert pool.for_read(pool.credentials[:1]).name == '1'
+    assert pool.stats()['2']['remaining'] == 2000
+
+
+def test_rate_limited_reads_fail_over():
+    session, adapter = make_session(['a', 'b', 'c'])
+    url = API_URL + 'repos/owner/name'
+    adapter.responses = [
+        (403, rate_limit(0), b'{}'),
+        (429, {'Retry-After': '60'}, b'{}'),
+        (200, rate_limit(100), b'{"ok": true}'),
+    ]
+
+    assert session.get(url).json() == {'ok': True}
+    assert [x.headers['Authorization'] for x in adapter.sent] == \
+        ['token a', 'token b', 'token c']
+
+    # Once every credential has been tried, the last response is returned.
+    adapter.sent = []
+    adapter.responses = [(403, rate_limit(0), b'{}')] * 3
+    assert session.get(url).status_code == 403
+    assert len(adapter.sent) == 3
+
+
+def test_rate_limited_writes_are_not_retried():
+    session, adapter = make_session(['a', 'b'])
+    adapter.responses = [(403, rate_limit(0), b'{}')]
+
+    resp = session.post(API_URL + 'repos/owner/name/merges', json={})
+    assert resp.status_code == 403
+    assert len(adapter.sent) == 1
+
+
+# Answers the request for an installation token.
+class TokenSession:
+    def __init__(self):
+        self.posted = []
+
+    def post(self, url, headers):
+        self.posted.append((url, headers))
+
+        resp = requests.Response()
+        resp.status_code = 201
+        resp._content = json.dumps({
+            'token': 'installation-{}'.format(len(self.posted)),
+            'expires_at': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                        time.gmtime(time.time() + 3600)),
+        }).encode('utf-8')
+        return resp
+
+
+def test_app_installation_tokens_are_minted_and_renewed():
+    jwt = pytest.importorskip('jwt')
+    rsa = pytest.importorskip('cryptography.hazmat.primitives.asymmetric.rsa')
+    from cryptography.hazmat.primitives import serialization
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM,
+                            serialization.PrivateFormat.PKCS8,
+                            serialization.NoEncryption())
+
+    session = TokenSession()
+    credential = AppCredential('app', 42, pem, 7, RateLimiter(),
+                               session=session)
+    assert credential.authorization == 'token installation-1'
+    assert credential.authorization == 'token installation-1'
+
+    url, headers = session.posted[0]
+    assert url == API_URL + 'app/installations/7/access_tokens'
+    scheme, token = headers['Authorization'].split()
+    assert scheme == 'Bearer'
+    claims = jwt.decode(token, key.public_key(), algorithms=['RS256'])
+    assert claims['iss'] == '42'
+    assert claims['exp'] - claims['iat'] <= 600
+
+    # Renewed a few minutes before it expires.
+    credential.expires = time.time() + AppCredential.RENEW_BEFORE - 1
+    assert credential.authorization == 'token installation-2'
+    assert abs(credential.expires - time.time() - 3600) < 5
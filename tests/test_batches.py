@@ -0,0 +1,212 @@
+from homu.batches import Batch, Batches, Pipeline, build_result, release
+from homu.main import lane_limit, queue_lanes
+
+
+def make_batch(make_state, count, base_ref='master'):
+    states = []
+    for num in range(1, count + 1):
+        state = make_state(num, base_ref=base_ref, approved_by='reviewer',
+                           status='pending')
+        state.merge_sha = '{:040x}'.format(1000 + num)
+        states.append(state)
+    return Batch(make_state.repo_label, base_ref, states)
+
+
+# Runs the bisection of batch, whose build fails from the pull request culprit
+# on, and returns the lengths of the prefixes that were built.
+def bisect(batch, culprit):
+    built = []
+    while not batch.done():
+        tested = batch.advance()
+        built.append(batch.testing)
+        if tested.num < culprit:
+            batch.passed()
+        else:
+            batch.failed()
+    return built
+
+
+def test_batch_that_passes_lands_whole(make_state):
+    batch = make_batch(make_state, 4)
+
+    assert batch.advance().num == 4
+    assert batch.under_test() == batch.states
+    assert batch.passed() == batch.states
+    assert batch.done()
+    assert batch.culprit() is None
+
+
+def test_bisection_finds_the_culprit(make_state):
+    for culprit in range(1, 9):
+        batch = make_batch(make_state, 8)
+
+        built = bisect(batch, culprit)
+
+        assert built[0] == 8
+        assert len(built) <= 4
+        assert batch.culprit().num == culprit
+        assert batch.landed == culprit - 1
+        assert [x.num for x in batch.rest()] == list(range(culprit + 1, 9))
+
+
+def test_bisection_lands_prefixes_that_pass(make_state):
+    batch = make_batch(make_state, 8)
+
+    batch.advance()
+    batch.failed()
+    assert batch.advance().num == 4
+    assert [x.num for x in batch.passed()] == [1, 2, 3, 4]
+    assert batch.advance().num == 6
+    batch.failed()
+    assert batch.advance().num == 5
+    assert [x.num for x in batch.passed()] == [5]
+    assert batch.culprit().num == 6
+
+
+def test_batch_is_invalid_once_a_pull_request_changes(make_state):
+    batch = make_batch(make_state, 3)
+    assert batch.valid()
+
+    batch.states[1].head_advanced('f' * 40, use_db=False)
+    assert not batch.valid()
+
+
+def test_batch_is_invalid_once_a_pull_request_is_closed(make_state):
+    batch = make_batch(make_state, 3)
+
+    make_state.repo_states.pop(3)
+    assert not batch.valid()
+
+
+def test_build_result(make_state):
+    state = make_state(1)
+    state.init_build_res(['linux', 'mac'], use_db=False)
+    assert build_result(state) is None
+
+    state.build_res['linux']['res'] = True
+    assert build_result(state) is None
+    state.build_res['mac']['res'] = True
+    assert build_result(state) is True
+    state.build_res['linux']['res'] = False
+    assert build_result(state) is False
+
+
+def test_pipeline_drop_returns_the_pull_requests_behind(db, make_state):
+    pipeline = Pipeline(make_state.repo_label, 'master',
+                        make_batch(make_state, 4).states)
+
+    rest = pipeline.drop(pipeline.states[1])
+    assert [x.num for x in rest] == [3, 4]
+    assert [x.num for x in pipeline.states] == [1]
+    assert pipeline.merge_shas == [pipeline.states[0].merge_sha]
+    assert pipeline.valid()
+
+    with db.unit_of_work():
+        for state in rest:
+            release(state)
+    assert all(x.status == '' and x.merge_sha == '' for x in rest)
+
+
+def test_pipeline_lands_in_order(make_state):
+    pipeline = Pipeline(make_state.repo_label, 'master',
+                        make_batch(make_state, 3).states)
+    for state in pipeline.states:
+        state.init_build_res(['linux'], use_db=False)
+
+    pipeline.states[1].build_res['linux']['res'] = True
+    assert pipeline.pop_finished() is None
+
+    pipeline.states[0].build_res['linux']['res'] = True
+    assert pipeline.pop_finished().num == 1
+    assert pipeline.pop_finished().num == 2
+    assert pipeline.pop_finished() is None
+
+    assert not pipeline.blocked()
+    pipeline.states[0].build_res['linux']['res'] = False
+    assert pipeline.blocked()
+    assert pipeline.pop_finished().num == 3
+
+
+def test_pipeline_cut(make_state):
+    pipeline = Pipeline(make_state.repo_label, 'master',
+                        make_batch(make_state, 4).states)
+
+    assert [x.num for x in pipeline.cut(pipeline.states[1])] == [3, 4]
+    assert [x.num for x in pipeline.cut()] == [1, 2]
+    assert pipeline.tail() is None
+
+
+def test_sizes_are_kept_per_base_ref():
+    batches = Batches()
+
+    assert batches.size('repo', 'master', 8) == 8
+    batches.resize('repo', 'master', 8, False)
+    batches.resize('repo', 'master', 8, False)
+    assert batches.size('repo', 'master', 8) == 2
+    assert batches.size('repo', 'beta', 8) == 8
+
+    batches.resize('repo', 'master', 8, True)
+    assert batches.size('repo', 'master', 8) == 3
+    for _ in range(10):
+        batches.resize('repo', 'master', 8, False)
+    assert batches.size('repo', 'master', 8) == 1
+
+
+def test_lanes_follow_the_build_branch(make_state):
+    for num, base_ref in [(1, 'master'), (2, 'beta'), (3, 'master')]:
+        make_state(num, base_ref=base_ref)
+    states = make_state.repo_states.ordered()
+
+    def lanes(repo_cfg):
+        return {lane: [x.num for x in lane_states] for lane, (lane_states, _)
+                in queue_lanes(make_state.repo_label, repo_cfg,
+                               states).items()}
+
+    # Testrunners build every base branch on a branch of its own.
+    assert lanes({'testrunners': {'builders': ['jenkins']}}) == \
+        {'merge_bot_master': [1, 3], 'merge_bot_beta': [2]}
+    assert lanes({'buildbot': {'builders': ['linux']}}) == {'auto': [1, 2, 3]}
+
+    repo_cfg = {'lanes': {'beta': 0}}
+    assert lane_limit(repo_cfg, 'beta', 8) == 0
+    assert lane_limit(repo_cfg, 'master', 8) == 8
+
+
+def test_load_restores_batches_and_pipelines(db, make_state):
+    batch = make_batch(make_state, 3)
+    batch.advance()
+    batch.failed()
+    batch.advance()
+    pipeline = Pipeline(make_state.repo_label, 'beta',
+                        [make_state(10, base_ref='beta', status='pending')])
+
+    saved = Batches()
+    saved.add(batch)
+    saved.add(pipeline)
+
+    loaded = Batches()
+    loaded.load(db, {make_state.repo_label: make_state.repo_states})
+    restored = loaded.get(make_state.repo_label, 'master')
+    assert restored.states == batch.states
+    assert (restored.landed, restored.failing, restored.testing) == (0, 3, 1)
+    assert loaded.get(make_state.repo_label, 'beta').states == \
+        pipeline.states
+
+    saved.remove(batch)
+    saved.remove(pipeline)
+    assert Batches().get(make_state.repo_label, 'master') is None
+
+
+def test_load_releases_batches_whose_pull_requests_are_gone(db, make_state):
+    batch = make_batch(make_state, 3)
+    Batches().add(batch)
+    make_state.repo_states.pop(2)
+
+    loaded = Batches()
+    with db.unit_of_work():
+        loaded.load(db, {make_state.repo_label: make_state.repo_states})
+
+    assert loaded.get(make_state.repo_label, 'master') is None
+    assert [x.status for x in batch.states] == ['', 'pending', '']
+    assert list(x for x in db.iter_batches()
+                if x[0] == make_state.repo_label) == []
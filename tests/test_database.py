@@ -0,0 +1,321 @@
+import threading
+import time
+
+import pytest
+
+from bottle import HTTPResponse, abort, redirect
+
+from homu import server
+from homu.database import ConnectionPool, PoolError, UnitOfWork
+from homu.main import UNLOADED
+
+
+# A connection that records the statements flushed to it.
+class Recorder:
+    def __init__(self):
+        self.statements = []
+        self.commits = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params=()):
+        self.statements.append((sql.split()[0], sql, list(params)))
+
+    def commit(self):
+        self.commits += 1
+
+
+def rows(db, sql, params=()):
+    with db.get_connection() as db_conn:
+        cursor = db_conn.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def test_writes_to_a_pull_are_coalesced():
+    uow = UnitOfWork()
+    uow.update_pull('repo', 1, status='pending')
+    uow.update_pull('repo', 1, status='success', merge_sha='a' * 40)
+    uow.set_mergeable('repo', 1, True)
+    uow.set_mergeable('repo', 1, False)
+    uow.set_build_res('repo', 1, 'linux', None, '', 'a' * 40)
+    uow.set_build_res('repo', 1, 'linux', True, 'url', 'a' * 40)
+
+    db_conn = Recorder()
+    uow.flush(db_conn)
+
+    assert [x[0] for x in db_conn.statements] == ['UPDATE', 'REPLACE',
+                                                  'REPLACE']
+    assert db_conn.statements[0][2] == ['success', 'a' * 40, 'repo', 1]
+    assert db_conn.statements[1][2] == ['repo', 1, False]
+    assert db_conn.statements[2][2] == ['repo', 1, 'linux', True, 'url',
+                                        'a' * 40]
+    assert db_conn.commits == 1
+
+
+def test_delete_discards_earlier_writes():
+    uow = UnitOfWork()
+    uow.update_pull('repo', 1, status='pending')
+    uow.set_build_res('repo', 1, 'linux', True, 'url', 'a' * 40)
+    uow.delete_pull('repo', 1)
+
+    db_conn = Recorder()
+    uow.flush(db_conn)
+
+    assert [x[0] for x in db_conn.statements] == ['DELETE'] * 4
+
+
+def test_merged_units_keep_the_last_write():
+    first = UnitOfWork()
+    first.update_pull('repo', 1, status='pending', title='title')
+    first.reset_build_res('repo', 1)
+    second = UnitOfWork()
+    second.update_pull('repo', 1, status='success')
+    calls = []
+    second.on_commit(lambda: calls.append('second'))
+
+    first.merge(second)
+    pull = first.pulls['repo', 1]
+    assert pull.fields == {'status': 'success', 'title': 'title'}
+    assert pull.build_res_reset
+
+    first.run_callbacks()
+    assert calls == ['second']
+
+
+class Connection:
+    def __init__(self, num):
+        self.num = num
+        self.ok = True
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def make_pool(size=2, timeout=5):
+    created = []
+
+    def connect():
+        created.append(Connection(len(created)))
+        return created[-1]
+
+    pool = ConnectionPool(connect, lambda cnx: cnx.ok, size=size,
+                          timeout=timeout)
+    return pool, created
+
+
+def test_pool_reuses_connections():
+    pool, created = make_pool()
+
+    cnx = pool.get_connection()
+    pool.put_connection(cnx)
+    assert pool.get_connection() is cnx
+    assert len(created) == 1
+
+
+def test_pool_reconnects_broken_connections():
+    pool, created = make_pool()
+
+    cnx = pool.get_connection()
+    cnx.ok = False
+    pool.put_connection(cnx)
+
+    assert pool.get_connection() is created[1]
+    assert cnx.closed
+    assert pool.stats()['reconnects'] == 1
+    assert pool.stats()['open'] == 1
+
+
+def test_pool_times_out_when_exhausted():
+    pool, created = make_pool(size=1, timeout=0.05)
+
+    pool.get_connection()
+    with pytest.raises(PoolError):
+        pool.get_connection()
+    assert pool.stats()['timeouts'] == 1
+    assert pool.stats()['waiting'] == 0
+
+
+def test_pool_serves_waiters_in_order():
+    pool, created = make_pool(size=1)
+    cnx = pool.get_connection()
+
+    got = []
+    threads = []
+    for i in range(3):
+        def wait(i=i):
+            got.append((i, pool.get_connection()))
+        threads.append(threading.Thread(target=wait))
+        threads[-1].start()
+        while pool.stats()['waiting'] < i + 1:
+            time.sleep(0.001)
+
+    for i in range(3):
+        pool.put_connection(cnx)
+        threads[i].join(5)
+        assert got[-1] == (i, cnx)
+
+    assert len(created) == 1
+    assert pool.stats()['high_water'] == 1
+
+
+def test_pool_frees_slots_that_failed_to_connect():
+    attempts = []
+
+    def connect():
+        attempts.append(None)
+        if len(attempts) == 2:
+            raise OSError('connection refused')
+        return Connection(len(attempts))
+
+    pool = ConnectionPool(connect, lambda cnx: True, size=2, timeout=5)
+    pool.get_connection()
+    with pytest.raises(OSError):
+        pool.get_connection()
+    assert pool.stats()['open'] == 1
+
+    cnx = pool.get_connection()
+    assert cnx.num == 3
+    assert pool.stats()['open'] == 2
+
+
+def test_unit_of_work_commits_once(db, make_state):
+    state = make_state(1)
+    repo_label = make_state.repo_label
+
+    calls = []
+    with db.unit_of_work() as uow:
+        state.save()
+        state.body = 'body'
+        state.set_status('pending')
+        with db.unit_of_work() as inner:
+            assert inner is uow
+        uow.on_commit(lambda: calls.append(db.get_pull_status(repo_label, 1)))
+        assert db.get_pull(repo_label, 1) is None
+
+    # Callbacks run once the writes are visible.
+    assert calls == ['pending']
+    row = db.get_pull(repo_label, 1)
+    assert row['status'] == 'pending'
+    assert row['body'] == 'body'
+
+
+def test_failed_unit_of_work_is_discarded(db, make_state):
+    state = make_state(1)
+
+    calls = []
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work() as uow:
+            state.save()
+            state.body = ''
+            uow.on_commit(lambda: calls.append(None))
+            raise RuntimeError
+
+    assert db.get_pull(make_state.repo_label, 1) is None
+    assert calls == []
+
+    with db.unit_of_work():
+        state.save()
+        state.body = ''
+    assert db.get_pull(make_state.repo_label, 1) is not None
+    db.delete_repo(make_state.repo_label)
+
+
+def test_routes_commit_redirects_only(db, make_state):
+    state = make_state(1)
+
+    @server.unit_of_work
+    def route(status):
+        state.save()
+        state.body = ''
+        state.set_status(status)
+        if status == 'failure':
+            abort(400, 'Failed')
+        redirect('/queue')
+
+    with pytest.raises(HTTPResponse):
+        route('success')
+    assert db.get_pull_status(make_state.repo_label, 1) == 'success'
+
+    with pytest.raises(HTTPResponse):
+        route('failure')
+    assert db.get_pull_status(make_state.repo_label, 1) == 'success'
+    db.delete_repo(make_state.repo_label)
+
+
+def test_body_is_released_once_written(db, make_state):
+    state = make_state(1)
+
+    with db.unit_of_work():
+        state.save()
+        state.body = 'x' * 1000
+        assert state._body == 'x' * 1000
+
+    assert state._body is UNLOADED
+    assert state.body == 'x' * 1000
+    db.delete_repo(make_state.repo_label)
+
+
+def test_body_changed_leaves_the_database_alone(db, make_state, monkeypatch):
+    state = make_state(1)
+    assert state.body_changed('body')
+
+    with db.unit_of_work():
+        state.save()
+        state.body = 'body'
+
+    def get_pull_body(repo, num):
+        raise AssertionError('read the body')
+    monkeypatch.setattr(db, 'get_pull_body', get_pull_body)
+
+    assert not state.body_changed('body')
+    assert state.body_changed('edited')
+    assert state.body_changed(None)
+    db.delete_repo(make_state.repo_label)
+
+def test_delete_pull_leaves_other_repositories(db, make_state):
+    repo_label = make_state.repo_label
+    for num in [1, 2]:
+        state = make_state(num)
+        with db.unit_of_work():
+            state.save()
+            state.body = ''
+            state.set_mergeable(True)
+    db.save_batch(repo_label, 'master', [1, 2], 0, None, 2)
+    db.save_pipeline(repo_label, 'beta', [1])
+
+    with db.unit_of_work() as uow:
+        uow.delete_pull(repo_label, 1)
+
+    assert db.get_pull(repo_label, 1) is None
+    assert db.get_pull(repo_label, 2) is not None
+    assert rows(db, 'SELECT num FROM mergeable WHERE repo = %s',
+                [repo_label]) == [(2,)]
+    # Batches and pipelines are cancelled by the queue, not by the delete.
+    assert len(rows(db, 'SELECT * FROM batches WHERE repo = %s',
+                    [repo_label])) == 1
+    assert len(rows(db, 'SELECT * FROM pipelines WHERE repo = %s',
+                    [repo_label])) == 1
+
+    db.delete_repo(repo_label)
+
+
+# Reading a table returns before the caller looks at the rows, so that the
+# single connection of an in-memory database is free for the caller to use.
+def test_reads_give_back_their_connection(db, make_state, monkeypatch):
+    monkeypatch.setattr(db, 'pool', ConnectionPool(
+        db.engine.connect, db.engine.check, size=1, timeout=1))
+
+    with db.unit_of_work():
+        for num in [1, 2]:
+            state = make_state(num)
+            state.save()
+            state.body = ''
+
+    repo_label = make_state.repo_label
+    nums = [row['num'] for row in db.iter_pulls()
+            if row['repo'] == repo_label and db.get_pull(repo_label, 1)]
+    assert nums == [1, 2]
+    db.delete_repo(repo_label)
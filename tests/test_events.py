@@ -0,0 +1,143 @@
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+from homu import events
+from homu.events import DeliveryCache, EventQueue
+
+logger = logging.getLogger('test')
+
+
+def wait_for(cond, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.001)
+
+
+def stored(db):
+    return [json.loads(x[4]) for x in db.iter_events()]
+
+
+def test_events_are_replayed_after_a_restart(db):
+    blocked = threading.Event()
+    events = EventQueue(lambda *args: blocked.wait(), 1, logger)
+    for n in range(3):
+        events.put('github', 'repo#1', {'n': n}, json.dumps(n))
+
+    # Stored before put returns, whether handled yet or not.
+    assert stored(db) == [0, 1, 2]
+
+    handled = []
+    replayed = EventQueue(
+        lambda source, headers, payload: handled.append(
+            (source, headers['n'], json.loads(payload))),
+        2, logger)
+    replayed.replay()
+    wait_for(lambda: replayed.stats()['processed'] == 3)
+    assert handled == [('github', 0, 0), ('github', 1, 1), ('github', 2, 2)]
+    assert stored(db) == []
+
+    blocked.set()
+    wait_for(lambda: events.stats()['depth'] == 0)
+
+
+def test_events_with_the_same_key_are_handled_in_order(db):
+    handled = []
+
+    def handler(source, headers, payload):
+        key, n = json.loads(payload)
+        # Later events of other keys overtake the slow ones.
+        if key == 'slow':
+            time.sleep(0.002)
+        handled.append((key, n))
+
+    events = EventQueue(handler, 4, logger)
+    for n in range(20):
+        for key in ['slow', 'repo#1', 'repo#2']:
+            events.put('github', key, {}, json.dumps([key, n]))
+
+    wait_for(lambda: events.stats()['processed'] == 60)
+    for key in ['slow', 'repo#1', 'repo#2']:
+        assert [n for x, n in handled if x == key] == list(range(20))
+    assert stored(db) == []
+
+
+def test_failed_events_are_dropped(db):
+    handled = []
+
+    def handler(source, headers, payload):
+        if payload == '1':
+            raise ValueError('bad payload')
+        handled.append(payload)
+
+    events = EventQueue(handler, 1, logger)
+    for n in range(3):
+        events.put('travis', 'sha', {}, str(n))
+
+    wait_for(lambda: events.stats()['processed'] == 3)
+    assert handled == ['0', '2']
+    assert events.stats()['failed'] == 1
+    assert events.stats()['depth'] == 0
+    assert stored(db) == []
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(events, 'time', clock)
+    return clock
+
+
+def test_deliveries_are_forgotten_after_their_ttl(clock):
+    deliveries = DeliveryCache(ttl=60)
+    assert not deliveries.seen('a')
+    assert deliveries.add('a')
+    assert deliveries.seen('a')
+    assert not deliveries.add('a')
+
+    clock.now += 61
+    assert not deliveries.seen('a')
+    assert deliveries.add('a')
+
+
+def test_oldest_deliveries_are_forgotten_past_the_size(clock):
+    deliveries = DeliveryCache(size=2)
+    for key in ['a', 'b', 'c']:
+        clock.now += 1
+        deliveries.add(key)
+
+    assert [deliveries.seen(x) for x in 'abc'] == [False, True, True]
+
+
+def test_failed_deliveries_can_be_sent_again(clock):
+    deliveries = DeliveryCache()
+    assert deliveries.add('a')
+    deliveries.discard('a')
+    assert not deliveries.seen('a')
+    assert deliveries.add('a')
+
+
+def test_deliveries_are_persisted(db, clock):
+    deliveries = DeliveryCache(ttl=60, persist=True)
+    for key in ['a', 'b', 'c']:
+        deliveries.add(key)
+        clock.now += 20
+    deliveries.discard('b')
+
+    # a was added 60 seconds ago and has expired.
+    restarted = DeliveryCache(ttl=60, persist=True)
+    assert [restarted.seen(x) for x in 'abc'] == [False, False, True]
+
+    db.delete_deliveries(clock.now)
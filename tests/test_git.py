@@ -0,0 +1,132 @@
+import os
+import subprocess
+
+import pytest
+
+from homu.git import GitError, Mirror
+
+AUTHOR = {'name': 'homu', 'email': 'homu@invalid'}
+
+ENV = dict(os.environ, GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@invalid',
+           GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@invalid',
+           GIT_CONFIG_GLOBAL=os.devnull, GIT_CONFIG_NOSYSTEM='1')
+
+
+def git(cwd, *args):
+    return subprocess.run(['git'] + list(args), cwd=str(cwd), env=ENV,
+                          check=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE).stdout.decode().strip()
+
+
+# A work tree that commits to a bare repository standing in for GitHub, with
+# master and three pull requests: two that touch different files and one that
+# conflicts with the first.
+@pytest.fixture
+def origin(tmp_path):
+    url = tmp_path / 'origin.git'
+    work = tmp_path / 'work'
+    git(tmp_path, 'init', '--quiet', '--bare', str(url))
+    git(tmp_path, 'init', '--quiet', '-b', 'master', str(work))
+
+    def commit(path, content, message):
+        (work / path).write_text(content)
+        git(work, 'add', path)
+        git(work, 'commit', '--quiet', '-m', message)
+        return git(work, 'rev-parse', 'HEAD')
+
+    shas = {'master': commit('README', 'readme\n', 'Initial commit')}
+    for num, (path, content) in enumerate([('a', 'a\n'), ('b', 'b\n'),
+                                           ('a', 'conflict\n')], 1):
+        git(work, 'checkout', '--quiet', '-b', 'pull-{}'.format(num),
+            shas['master'])
+        shas[num] = commit(path, content, 'Pull request {}'.format(num))
+        git(work, 'push', '--quiet', str(url),
+            'HEAD:refs/pull/{}/head'.format(num))
+    git(work, 'push', '--quiet', str(url),
+        '{}:refs/heads/master'.format(shas['master']))
+
+    return str(url), shas
+
+
+@pytest.fixture
+def mirror(tmp_path, origin):
+    mirror = Mirror(str(tmp_path / 'mirrors' / 'owner' / 'name.git'),
+                    origin[0])
+    with mirror.lock:
+        mirror.init()
+    return mirror
+
+
+def test_init_fetches_branches_and_pull_requests(mirror, origin):
+    url, shas = origin
+
+    assert mirror.base_sha('master') == shas['master']
+    for num in [1, 2, 3]:
+        assert mirror.has_commit(shas[num])
+        mirror.ensure_pull(num, shas[num])
+
+    with pytest.raises(GitError):
+        mirror.ensure_pull(4, 'f' * 40)
+
+
+def test_mergeable_is_cached(mirror, origin):
+    url, shas = origin
+
+    assert mirror.mergeable(shas['master'], shas[1])
+    assert mirror.mergeable(shas['master'], shas[1])
+    assert (mirror.hits, mirror.misses) == (1, 1)
+
+    merge_sha = mirror.merge(shas['master'], shas[1], 'Merge #1', AUTHOR)
+    assert not mirror.mergeable(merge_sha, shas[3])
+    assert mirror.mergeable(merge_sha, shas[2])
+
+
+def test_merge_creates_merge_commits(mirror, origin):
+    url, shas = origin
+
+    merge_sha = mirror.merge(shas['master'], shas[1], 'Merge #1', AUTHOR)
+    assert mirror.output('rev-parse', merge_sha + '^1') == shas['master']
+    assert mirror.output('rev-parse', merge_sha + '^2') == shas[1]
+    assert mirror.output('log', '-1', '--format=%an <%ae>%n%B',
+                         merge_sha) == 'homu <homu@invalid>\nMerge #1'
+
+    rollup_sha = mirror.merge(merge_sha, shas[2], 'Merge #2', AUTHOR)
+    assert mirror.output('ls-tree', '--name-only', rollup_sha).split() == \
+        ['README', 'a', 'b']
+
+    assert mirror.merge(merge_sha, shas[3], 'Merge #3', AUTHOR) is None
+
+
+def test_push_updates_branches_atomically(mirror, origin):
+    url, shas = origin
+
+    merge_sha = mirror.merge(shas['master'], shas[1], 'Merge #1', AUTHOR)
+    trigger_sha = mirror.add_file(merge_sha, 'trigger', b'1\n', 'Trigger',
+                                  AUTHOR)
+    assert mirror.output('show', trigger_sha + ':trigger') == '1'
+    assert mirror.output('rev-parse', trigger_sha + '^') == merge_sha
+
+    mirror.push({'auto': merge_sha, 'merge_bot_master': trigger_sha})
+    assert git(url, 'rev-parse', 'refs/heads/auto') == merge_sha
+    assert git(url, 'rev-parse', 'refs/heads/merge_bot_master') == \
+        trigger_sha
+    assert mirror.base_sha('auto') == merge_sha
+
+    with pytest.raises(GitError):
+        mirror.push({'auto': shas[2], 'bad..ref': shas[2]})
+    assert git(url, 'rev-parse', 'refs/heads/auto') == merge_sha
+
+
+def test_base_sha_fetches_branches_that_moved(mirror, origin, tmp_path):
+    url, shas = origin
+
+    git(tmp_path / 'work', 'push', '--quiet', url,
+        '{}:refs/heads/master'.format(shas[2]))
+
+    assert mirror.base_sha('master') == shas['master']
+    assert mirror.base_sha('master', shas[2]) == shas[2]
+
+    # Branches the mirror has not seen yet are fetched too.
+    git(tmp_path / 'work', 'push', '--quiet', url,
+        '{}:refs/heads/beta'.format(shas[1]))
+    assert mirror.base_sha('beta') == shas[1]
@@ -0,0 +1,170 @@
+import random
+
+import pytest
+
+from homu.indexes import MergeShaIndex, SortedStates, merge_shas
+
+
+def check(make_state):
+    merge_shas.check({make_state.repo_label: make_state.repo_states})
+
+
+def test_ordered_follows_sort_key(make_state):
+    states = [make_state(num) for num in [3, 1, 2]]
+    repo_states = make_state.repo_states
+
+    assert [x.num for x in repo_states.ordered()] == [1, 2, 3]
+
+    states[0].priority = 10
+    assert [x.num for x in repo_states.ordered()] == [3, 1, 2]
+
+    states[1].approved_by = 'reviewer'
+    assert [x.num for x in repo_states.ordered()] == [1, 3, 2]
+
+    states[1].status = 'pending'
+    assert [x.num for x in repo_states.ordered()][0] == 1
+
+    del repo_states[1]
+    assert [x.num for x in repo_states.ordered()] == [3, 2]
+    assert len(repo_states.sorted_states) == 2
+
+
+def test_sorted_states_split_and_drop_blocks(monkeypatch):
+    monkeypatch.setattr(SortedStates, 'LOAD', 2)
+    rand = random.Random(0)
+    sorted_states = SortedStates()
+    entries = []
+
+    for i in range(200):
+        if entries and rand.random() < 0.4:
+            key, state = entries.pop(rand.randrange(len(entries)))
+            sorted_states.remove(key, state)
+        else:
+            # Keys repeat, and equal keys may end up in different blocks.
+            entries.append(((rand.randrange(20),), object()))
+            sorted_states.insert(*entries[-1])
+
+        keys = [key for block in sorted_states.keys for key in block]
+        assert keys == sorted(key for key, state in entries)
+        assert set(sorted_states) == {state for key, state in entries}
+        assert all(0 < len(x) <= 4 for x in sorted_states.keys)
+        assert sorted_states.maxes == [x[-1] for x in sorted_states.keys]
+
+
+def test_find_follows_assignments(make_state):
+    first = make_state(1, base_ref='master')
+    second = make_state(2, base_ref='beta')
+    repo_states = make_state.repo_states
+
+    assert repo_states.find('base_ref', 'master') == [first]
+    assert repo_states.find('head_sha', second.head_sha) == [second]
+
+    first.base_ref = 'beta'
+    assert repo_states.find('base_ref', 'master') == []
+    assert set(repo_states.find('base_ref', 'beta')) == {first, second}
+
+    old_sha = second.head_sha
+    second.head_advanced('f' * 40, use_db=False)
+    assert repo_states.find('head_sha', old_sha) == []
+    assert repo_states.find('head_sha', 'f' * 40) == [second]
+
+    repo_states.pop(2)
+    assert repo_states.find('base_ref', 'beta') == [first]
+    assert 'f' * 40 not in repo_states.indexes['head_sha']
+
+
+def test_replacing_a_state_unindexes_the_old_one(make_state):
+    old = make_state(1, base_ref='master')
+    new = make_state(1, base_ref='beta')
+    repo_states = make_state.repo_states
+
+    assert repo_states[1] is new
+    assert old.repo_states is None
+    assert repo_states.find('base_ref', 'master') == []
+    assert repo_states.ordered() == [new]
+
+
+def test_merge_sha_index_after_inserts(make_state):
+    states = [make_state(num) for num in range(1, 6)]
+    for state in states:
+        state.merge_sha = '{:040x}'.format(state.num + 100)
+    check(make_state)
+
+    for state in states:
+        assert merge_shas.find(state.merge_sha) is state
+
+
+def test_merge_sha_index_after_updates(make_state):
+    state = make_state(1)
+    other = make_state(2)
+
+    state.merge_sha = 'a' * 40
+    state.merge_sha = 'b' * 40
+    check(make_state)
+    with pytest.raises(KeyError):
+        merge_shas.find('a' * 40)
+
+    # A state taking over the merge commit of another leaves the other one's
+    # update from removing it.
+    other.merge_sha = 'b' * 40
+    state.merge_sha = 'c' * 40
+    assert merge_shas.find('b' * 40) is other
+    assert merge_shas.find('c' * 40) is state
+    check(make_state)
+
+    state.head_advanced('d' * 40, use_db=False)
+    assert state.merge_sha == ''
+    check(make_state)
+    with pytest.raises(KeyError):
+        merge_shas.find('c' * 40)
+
+
+def test_merge_sha_index_after_deletes(make_state):
+    states = [make_state(num) for num in range(1, 4)]
+    for state in states:
+        state.merge_sha = '{:040x}'.format(state.num + 200)
+
+    removed = make_state.repo_states.pop(2)
+    merge_shas.discard(removed)
+    check(make_state)
+    with pytest.raises(KeyError):
+        merge_shas.find(removed.merge_sha)
+
+    make_state.repo_states.clear()
+    for state in states:
+        merge_shas.discard(state)
+    check(make_state)
+    for state in states:
+        with pytest.raises(KeyError):
+            merge_shas.find(state.merge_sha)
+
+
+def test_check_reports_inconsistencies(make_state):
+    index = MergeShaIndex()
+    state = make_state(1)
+
+    index.update(state, '', 'a' * 40)
+    with pytest.raises(AssertionError, match='has merge_sha'):
+        index.check({make_state.repo_label: make_state.repo_states})
+
+    index.update(state, 'a' * 40, '')
+    state.merge_sha = 'b' * 40
+    with pytest.raises(AssertionError, match='missing from the index'):
+        index.check({make_state.repo_label: make_state.repo_states})
+
+
+def test_find_state_skips_replaced_states(make_state, monkeypatch):
+    from homu import server
+
+    state = make_state(1, merge_sha='e' * 40)
+    monkeypatch.setattr(server.g, 'states',
+                        {make_state.repo_label: make_state.repo_states},
+                        raising=False)
+    assert server.find_state('e' * 40) == (state, make_state.repo_label)
+
+    # A resync puts a new state in its place before the old one is cleaned.
+    make_state(1, merge_sha='f' * 40)
+    with pytest.raises(ValueError):
+        server.find_state('e' * 40)
+    with pytest.raises(ValueError):
+        server.find_state('0' * 40)
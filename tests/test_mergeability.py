@@ -0,0 +1,87 @@
+from types import SimpleNamespace
+
+from homu.mergeability import MergeabilityQueue
+
+
+def pull(num, **fields):
+    return SimpleNamespace(repo_label='repo', num=num, **dict(
+        {'approved_by': '', 'rollup': False, 'status': ''}, **fields))
+
+
+def test_checks_come_out_in_order():
+    que = MergeabilityQueue()
+    first, second = pull(1), pull(2)
+
+    que.put(first, 'first')
+    que.put(second, 'second')
+    assert que.get() == (first, 'first', 0)
+    assert que.get() == (second, 'second', 0)
+    assert len(que) == 0
+
+
+def test_queueing_again_replaces_the_pending_check():
+    que = MergeabilityQueue()
+    old, new = pull(1), pull(1)
+
+    que.put(old, 'old', delay=60)
+    que.put(new, 'new')
+    assert len(que) == 1
+    assert que.get() == (new, 'new', 0)
+    assert que.stats()['coalesced'] == 1
+    assert que.stats()['queued'] == 1
+
+
+def test_pull_requests_being_checked_are_checked_again_afterwards():
+    que = MergeabilityQueue()
+    state = pull(1)
+
+    que.put(state, 'first')
+    assert que.get()[1] == 'first'
+    que.put(state, 'second')
+    assert que.stats()['in_flight'] == 1
+
+    que.done(state)
+    assert que.get()[1] == 'second'
+
+
+def test_retries_back_off_and_give_up():
+    que = MergeabilityQueue()
+    state = pull(1)
+
+    for attempt in range(len(MergeabilityQueue.RETRY_DELAYS)):
+        assert que.retry(state, None, attempt)
+        entry = que.pending['repo', 1]
+        assert entry[3] == attempt + 1
+        del que.pending['repo', 1]
+
+    assert not que.retry(state, None, len(MergeabilityQueue.RETRY_DELAYS))
+    assert que.stats()['retried'] == len(MergeabilityQueue.RETRY_DELAYS)
+
+
+def test_lazy_queue_checks_the_head_of_the_queue():
+    que = MergeabilityQueue(lazy=True, eager=2)
+    states = [pull(1, approved_by='reviewer'), pull(2),
+              pull(3, rollup=True), pull(4, approved_by='reviewer')]
+    for state in states:
+        que.put(state)
+
+    assert len(que) == 0
+    assert que.stats()['parked'] == 4
+
+    que.refresh_head(states)
+    assert sorted(x[1] for x in que.pending) == [1, 3]
+    assert que.stats()['parked'] == 2
+
+    # Parked pull requests are checked once someone looks at them.
+    que.refresh([states[1]])
+    assert sorted(x[1] for x in que.pending) == [1, 2, 3]
+
+
+def test_eager_checks_skip_the_lazy_queue():
+    que = MergeabilityQueue(lazy=True)
+    state = pull(1)
+
+    que.put(state, 'parked')
+    que.put(state, 'eager', eager=True)
+    assert que.stats()['parked'] == 0
+    assert que.get() == (state, 'eager', 0)
@@ -0,0 +1,253 @@
+import hashlib
+import hmac
+import io
+import json
+import logging
+import urllib.parse
+
+import bottle
+import pytest
+
+from homu import server
+from homu.events import DeliveryCache
+from homu.slots import SlotScheduler
+
+SECRET = 'buildbot secret'
+TOKEN = 'travis token'
+GITHUB_SECRET = 'github secret'
+JENKINS_KEY = 'jenkins key'
+
+
+class Events:
+    def __init__(self):
+        self.queued = []
+        self.fail = False
+
+    def put(self, source, key, headers, payload):
+        if self.fail:
+            raise OSError('database is gone')
+        self.queued.append((source, key, headers, payload))
+
+
+@pytest.fixture
+def g(monkeypatch):
+    attrs = {
+        'repo_cfgs': {
+            'repo': {
+                'owner': 'owner',
+                'name': 'name',
+                'buildbot': {'secret': SECRET, 'url': 'http://buildbot'},
+                'travis': {'token': TOKEN},
+                'github': {'secret': GITHUB_SECRET},
+            },
+            'jenkins-repo': {'testrunners': {'builders': ['jenkins']}},
+        },
+        'repo_labels': {('owner', 'name'): 'repo'},
+        'cfg': {'jenkins': {'key': JENKINS_KEY}},
+        'events': Events(),
+        'deliveries': DeliveryCache(),
+        'logger': logging.getLogger('test'),
+        'states': {},
+        'slots': SlotScheduler(),
+        'queue_handler': lambda: None,
+    }
+    for name, value in attrs.items():
+        monkeypatch.setattr(server.g, name, value, raising=False)
+    return server.g
+
+
+def post(route, forms, headers={}, *, path='/', json_body=None):
+    if json_body is None:
+        body = urllib.parse.urlencode(forms).encode('utf-8')
+        content_type = 'application/x-www-form-urlencoded'
+    else:
+        body = json.dumps(json_body).encode('utf-8')
+        content_type = 'application/json'
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': path,
+        'CONTENT_TYPE': content_type,
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+    }
+    for name, value in headers.items():
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    bottle.request.bind(environ)
+    bottle.response.bind()
+    return route()
+
+
+def buildbot_forms(secret):
+    return {'secret': secret, 'packets': json.dumps([])}
+
+
+def travis_forms():
+    return {'payload': json.dumps({
+        'commit': 'a' * 40,
+        'repository': {'owner_name': 'owner', 'name': 'name'},
+    })}
+
+
+def test_buildbot_checks_the_secret_before_queueing(g):
+    with pytest.raises(bottle.HTTPError) as exc:
+        post(server.buildbot, buildbot_forms('wrong'))
+    assert exc.value.status_code == 400
+    assert g.events.queued == []
+
+    assert post(server.buildbot, buildbot_forms(SECRET)) == 'Accepted'
+    assert [x[0] for x in g.events.queued] == ['buildbot']
+
+
+def test_travis_checks_the_token_before_queueing(g):
+    with pytest.raises(bottle.HTTPError) as exc:
+        post(server.travis, travis_forms(), {'Authorization': 'wrong'})
+    assert exc.value.status_code == 400
+    assert g.events.queued == []
+
+    auth = hashlib.sha256('owner/name{}'.format(TOKEN).encode('utf-8'))
+    assert post(server.travis, travis_forms(),
+                {'Authorization': auth.hexdigest()}) == 'Accepted'
+    assert [x[:2] for x in g.events.queued] == [('travis', 'a' * 40)]
+
+
+def test_deduplicate_forgets_failed_deliveries(g):
+    handled = []
+
+    def handle():
+        handled.append(None)
+        if len(handled) == 1:
+            raise OSError('failed')
+        return 'OK'
+
+    with pytest.raises(OSError):
+        server.deduplicate('key', handle)
+    assert server.deduplicate('key', handle) == 'OK'
+    assert server.deduplicate('key', handle) == 'Duplicate delivery'
+    assert len(handled) == 2
+
+
+def post_github(delivery):
+    info = {
+        'repository': {'owner': {'login': 'owner'}, 'name': 'name'},
+        'issue': {'number': 1},
+    }
+    sig = hmac.new(GITHUB_SECRET.encode('utf-8'),
+                   json.dumps(info).encode('utf-8'), 'sha1').hexdigest()
+    return post(server.github, None, {
+        'X-GitHub-Delivery': delivery,
+        'X-Hub-Signature': 'sha1=' + sig,
+        'X-Github-Event': 'issue_comment',
+    }, json_body=info)
+
+
+def test_github_drops_deliveries_it_has_seen(g):
+    g.events.fail = True
+    with pytest.raises(OSError):
+        post_github('delivery-1')
+
+    g.events.fail = False
+    assert post_github('delivery-1') == 'Accepted'
+    assert post_github('delivery-1') == 'Duplicate delivery'
+    assert post_github('delivery-2') == 'Accepted'
+    assert [x[1] for x in g.events.queued] == ['repo#1', 'repo#1']
+
+
+def buildbot_payload(buildnumber, results=0):
+    build = {
+        'builderName': 'linux',
+        'properties': [['revision', 'a' * 40, 'Build'],
+                       ['buildnumber', buildnumber, 'Build']],
+        'results': results,
+    }
+    return urllib.parse.urlencode({
+        'secret': SECRET,
+        'packets': json.dumps([{'event': 'buildFinished',
+                                'payload': {'build': build}}]),
+    })
+
+
+def test_buildbot_rebuilds_are_not_duplicates(g, monkeypatch):
+    handled = []
+    monkeypatch.setattr(server, 'buildbot_finished',
+                        lambda info, props, forms, logger:
+                            handled.append(props['buildnumber']))
+
+    server.buildbot_event(buildbot_payload(7), g.logger)
+    # Buildbot sending the same packet again.
+    server.buildbot_event(buildbot_payload(7), g.logger)
+    assert handled == [7]
+
+    # A rebuild of the same revision with the same result.
+    server.buildbot_event(buildbot_payload(8), g.logger)
+    assert handled == [7, 8]
+
+
+def post_jenkins(url):
+    forms = {'commit': 'a' * 40, 'success': '1', 'url': url}
+    forms['hmac'] = hmac.HMAC(JENKINS_KEY.encode('utf-8'),
+                              '{}:1'.format('a' * 40).encode('utf-8'),
+                              hashlib.sha256).hexdigest()
+    return post(server.testrunner_callback, forms, path='/jenkins')
+
+
+def test_testrunner_rebuilds_are_not_duplicates(g):
+    assert post_jenkins('http://jenkins/job/1') == 'Accepted'
+    assert post_jenkins('http://jenkins/job/1') == 'Duplicate delivery'
+    assert post_jenkins('http://jenkins/job/2') == 'Accepted'
+    assert [x[:2] for x in g.events.queued] == [('jenkins', 'a' * 40)] * 2
+
+
+# Holds a slot for a build of sha by repo_label that no pull request is
+# waiting on anymore, as if it had been cancelled.
+def hold_slot(g, repo_label, sha):
+    g.slots.bind(g.slots.reserve(repo_label, ['ci']), sha)
+
+
+def test_forged_reports_do_not_release_slots(g):
+    hold_slot(g, 'repo', 'a' * 40)
+    hold_slot(g, 'jenkins-repo', 'b' * 40)
+
+    server.buildbot_finished({'text': []}, {'revision': 'a' * 40},
+                             {'secret': 'wrong'}, g.logger)
+    server.travis_event({'Authorization': 'wrong'},
+                        urllib.parse.urlencode(travis_forms()), g.logger)
+    assert g.slots.holder('a' * 40) == 'repo'
+
+    forms = {'commit': 'b' * 40, 'success': '1', 'hmac': 'wrong'}
+    with pytest.raises(bottle.HTTPError):
+        server.testrunner_event('jenkins', forms, g.logger)
+    assert g.slots.holder('b' * 40) == 'jenkins-repo'
+
+
+def test_authentic_reports_release_slots(g):
+    hold_slot(g, 'repo', 'a' * 40)
+    server.buildbot_finished({'text': []}, {'revision': 'a' * 40},
+                             {'secret': SECRET}, g.logger)
+    assert g.slots.holder('a' * 40) is None
+
+    hold_slot(g, 'repo', 'a' * 40)
+    auth = hashlib.sha256('owner/name{}'.format(TOKEN).encode('utf-8'))
+    server.travis_event({'Authorization': auth.hexdigest()},
+                        urllib.parse.urlencode(travis_forms()), g.logger)
+    assert g.slots.holder('a' * 40) is None
+
+
+def jenkins_forms(sha):
+    return {'commit': sha, 'success': '1',
+            'hmac': hmac.HMAC(JENKINS_KEY.encode('utf-8'),
+                              '{}:1'.format(sha).encode('utf-8'),
+                              hashlib.sha256).hexdigest()}
+
+
+def test_testrunner_reports_release_slots_of_their_repositories(g):
+    # The key of a builder is shared, so it only vouches for repositories
+    # that build with it.
+    hold_slot(g, 'repo', 'a' * 40)
+    with pytest.raises(bottle.HTTPError):
+        server.testrunner_event('jenkins', jenkins_forms('a' * 40), g.logger)
+    assert g.slots.holder('a' * 40) == 'repo'
+
+    hold_slot(g, 'jenkins-repo', 'b' * 40)
+    with pytest.raises(bottle.HTTPError):
+        server.testrunner_event('jenkins', jenkins_forms('b' * 40), g.logger)
+    assert g.slots.holder('b' * 40) is None
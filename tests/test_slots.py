@@ -0,0 +1,126 @@
+import pytest
+
+from homu.slots import SlotScheduler, build_pools
+
+
+def test_capacity_limits_reservations():
+    slots = SlotScheduler({'travis': 2})
+
+    first = slots.reserve('a', ['travis'])
+    second = slots.reserve('a', ['travis'])
+    assert first and second
+    assert slots.reserve('a', ['travis']) is None
+
+    slots.cancel(second)
+    assert slots.reserve('a', ['travis'])
+
+
+def test_pools_without_capacity_are_unlimited():
+    slots = SlotScheduler()
+
+    assert all(slots.reserve('a', ['travis', 'travis/travis'])
+               for _ in range(100))
+    assert slots.reserve('a', ['buildbot'])
+    assert slots.reserve('a', ['buildbot']) is None
+    assert slots.reserve('a', ['buildbot/try'])
+
+
+def test_a_reservation_needs_every_pool():
+    slots = SlotScheduler({'buildbot': 2, 'buildbot/linux': 1})
+
+    assert slots.reserve('a', ['buildbot', 'buildbot/linux'])
+    assert slots.reserve('a', ['buildbot', 'buildbot/linux']) is None
+    assert slots.reserve('a', ['buildbot', 'buildbot/mac'])
+    assert slots.stats()['pools']['buildbot']['held'] == 2
+
+
+def test_bound_reservations_are_released_by_sha():
+    slots = SlotScheduler({'travis': 1})
+
+    reservation = slots.reserve('a', ['travis'])
+    slots.bind(reservation, 'a' * 40)
+    # Cancelling a reservation that was bound to a build does nothing.
+    slots.cancel(reservation)
+    assert slots.reserve('a', ['travis']) is None
+
+    assert slots.holder('a' * 40) == 'a'
+    assert slots.holder('b' * 40) is None
+    assert not slots.release('b' * 40)
+    assert slots.release('a' * 40)
+    assert not slots.release('a' * 40)
+    assert slots.holder('a' * 40) is None
+    assert slots.reserve('a', ['travis'])
+
+
+def test_reservations_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('homu.slots.time.monotonic', lambda: now[0])
+    slots = SlotScheduler({'travis': 1}, timeout=60)
+
+    slots.bind(slots.reserve('a', ['travis']), 'a' * 40)
+    now[0] += 59
+    assert slots.reserve('a', ['travis']) is None
+    now[0] += 2
+    assert slots.reserve('a', ['travis'])
+    assert slots.stats()['expired'] == 1
+
+
+def test_full_pools_are_shared_with_waiting_repositories():
+    slots = SlotScheduler({'travis': 4})
+
+    slots.begin_pass()
+    held = [slots.reserve('a', ['travis']) for _ in range(4)]
+    assert slots.reserve('b', ['travis']) is None
+
+    # b is waiting, so a cannot take back more than half of the pool.
+    slots.begin_pass()
+    for reservation in held[:3]:
+        slots.cancel(reservation)
+    assert slots.reserve('a', ['travis'])
+    assert slots.reserve('a', ['travis']) is None
+    assert slots.reserve('b', ['travis'])
+    assert slots.reserve('b', ['travis'])
+    assert slots.reserve('b', ['travis']) is None
+    assert slots.stats()['pools']['travis']['waiting'] == ['a', 'b']
+
+
+def test_lower_priorities_do_not_hold_back_others():
+    slots = SlotScheduler({'travis': 2})
+
+    slots.begin_pass()
+    held = [slots.reserve('a', ['travis']) for _ in range(2)]
+    assert slots.reserve('b', ['travis'], priority=0) is None
+
+    for reservation in held:
+        slots.cancel(reservation)
+    assert slots.reserve('a', ['travis'], priority=1)
+    assert slots.reserve('a', ['travis'], priority=1)
+
+
+def test_order_prefers_priority_then_fewest_slots():
+    slots = SlotScheduler()
+
+    slots.reserve('a', ['travis'])
+    slots.reserve('a', ['travis'])
+    slots.reserve('b', ['travis'])
+
+    assert slots.order({'a': 0, 'b': 0, 'c': 0}) == ['c', 'b', 'a']
+    assert slots.order({'a': 5, 'b': 0, 'c': 0}) == ['a', 'c', 'b']
+
+
+@pytest.mark.parametrize('repo_cfg, builders, try_, pools', [
+    ({'buildbot': {}}, ['linux', 'mac'], False,
+     ['buildbot', 'buildbot/linux', 'buildbot/mac']),
+    ({'buildbot': {}}, ['try-linux'], True,
+     ['buildbot/try', 'buildbot/try/try-linux']),
+    ({'travis': {}}, ['travis'], False, ['travis', 'travis/travis']),
+    ({'testrunners': {}, 'slots': {'pool': 'ci-2'}}, ['jenkins'], False,
+     ['ci-2', 'ci-2/jenkins']),
+])
+def test_build_pools(repo_cfg, builders, try_, pools):
+    assert build_pools(repo_cfg, builders, try_) == pools
+
+
+def test_build_pools_needs_a_backend():
+    with pytest.raises(RuntimeError):
+        build_pools({}, [])
@@ -0,0 +1,175 @@
+from datetime import datetime, timedelta, timezone
+import logging
+
+import github3
+import pytest
+
+from bench.github_fixtures import Fixtures, FixtureServer
+from homu import sync
+from homu.main import synchronize
+from homu.mergeability import MergeabilityQueue
+
+logger = logging.getLogger('test')
+
+
+# The fixture server from the benchmarks, answering without delay. 60 pull
+# requests take two pages of GraphQL.
+@pytest.fixture
+def server():
+    server = FixtureServer(Fixtures(60), latency=0)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def repo_label(request, db):
+    repo_label = 'test-{}'.format(request.node.name)
+    yield repo_label
+    db.delete_repo(repo_label)
+
+
+def run_sync(server, repo_label, states, *, engine='rest', full=False):
+    fixtures = server.fixtures
+    repo_cfg = {'owner': fixtures.owner, 'name': fixtures.name,
+                'reviewers': ['reviewer'], 'sync': engine}
+
+    gh = github3.GitHubEnterprise(server.url, token='token')
+    # rate_limit() is not made relative to the enterprise URL.
+    gh._github_url = server.api_url
+
+    server.reset()
+    synchronize(repo_label, repo_cfg, logger, gh, states, {},
+                MergeabilityQueue(), 'homu', {}, full=full)
+    return server.reset()
+
+
+def summary(repo_states):
+    return {num: (x.title, x.body, x.head_sha, x.head_ref, x.base_ref,
+                  x.assignee, x.status)
+            for num, x in repo_states.items()}
+
+
+def test_graphql_reads_what_rest_reads(server, repo_label):
+    rest, graphql = {}, {}
+    run_sync(server, repo_label, rest, engine='rest')
+    requests = run_sync(server, repo_label + '-graphql', graphql,
+                        engine='graphql')
+
+    assert len(rest[repo_label]) == 60
+    assert summary(graphql[repo_label + '-graphql']) == \
+        summary(rest[repo_label])
+    assert requests['pulls'] == requests['issue_comments'] == 0
+    assert requests['graphql'] >= 2
+
+
+def test_failed_graphql_falls_back_to_rest(server, repo_label, monkeypatch,
+                                           caplog):
+    post = server.post
+    failed = []
+
+    # The second page of pull requests fails.
+    def failing_post(path, data):
+        if 'pullRequests(' in data['query'] and data['variables']['cursor']:
+            failed.append(data['variables']['cursor'])
+            return 200, {'errors': [{'message': 'timeout'}]}
+        return post(path, data)
+    monkeypatch.setattr(server, 'post', failing_post)
+
+    states = {}
+    with caplog.at_level(logging.WARNING):
+        requests = run_sync(server, repo_label, states, engine='graphql')
+
+    assert failed == ['50']
+    assert len(states[repo_label]) == 60
+    assert requests['pulls'] > 0
+    assert 'falling back to REST' in caplog.text
+
+
+def test_graphql_statuses_are_named_like_rest_ones(server):
+    pull = server.fixtures.pull(1)
+    node = server.graphql_pull(dict(pull, status='success'))
+    assert sync.graphql_record(None, None, node).homu_status == 'success'
+
+    node['commits']['nodes'][0]['commit']['status'] = {
+        'context': {'state': 'EXPECTED'}}
+    assert sync.graphql_record(None, None, node).homu_status == ''
+
+
+# Comments on a pull request, as GitHub would have it: with a new ID, and
+# the pull request updated at the time it was made. Timestamps only have
+# seconds, so comments made within the same one are a second apart.
+def add_comment(server, num, body, login='reviewer'):
+    fixtures = server.fixtures
+    pull = fixtures.pull(num)
+    now = max(datetime.now(timezone.utc).replace(microsecond=0),
+              pull['updated_at'] + timedelta(seconds=1))
+    comment_id = 1 + max(c['id'] for x in fixtures.pulls
+                         for c in x['issue_comments'] + x['review_comments'])
+
+    pull['issue_comments'].append({'id': comment_id, 'body': body,
+                                   'login': login, 'created_at': now})
+    pull['updated_at'] = now
+    return comment_id
+
+
+def test_unchanged_pulls_are_skipped(server, repo_label, db):
+    states = {}
+    run_sync(server, repo_label, states)
+    assert len(db.get_sync_cursors(repo_label)) == 60
+
+    requests = run_sync(server, repo_label, states)
+    assert set(requests) == {'repository', 'pulls', 'rate_limit'}
+    assert len(states[repo_label]) == 60
+
+
+def test_comments_are_read_from_the_cursor(server, repo_label, db):
+    pull = next(x for x in server.fixtures.pulls
+                if len(x['issue_comments']) < 100)
+    num = pull['number']
+    add_comment(server, num, '@homu r+ ' + pull['head_sha'])
+
+    states = {}
+    run_sync(server, repo_label, states)
+    assert states[repo_label][num].approved_by == 'reviewer'
+
+    # Comments the last synchronization saw are not parsed again.
+    states[repo_label][num].approved_by = ''
+    comment_id = add_comment(server, num, '@homu p=5')
+
+    requests = run_sync(server, repo_label, states)
+    assert requests['issue_comments'] == requests['review_comments'] == 1
+    assert 'statuses' not in requests
+    assert states[repo_label][num].priority == 5
+    assert states[repo_label][num].approved_by == ''
+    assert db.get_sync_cursors(repo_label)[num][2] == comment_id
+
+
+def test_cursor_advances_only_once_every_page_is_read(server, repo_label, db,
+                                                      monkeypatch):
+    states = {}
+    run_sync(server, repo_label, states)
+
+    # A discussion long enough to take two pages of comments.
+    pull = next(x for x in server.fixtures.pulls
+                if len(x['issue_comments']) > 100)
+    num = pull['number']
+    add_comment(server, num, '@homu r+ ' + pull['head_sha'])
+    cursor = db.get_sync_cursors(repo_label)[num]
+
+    get = server.get
+
+    def failing_get(path, params):
+        if path.endswith('/issues/{}/comments'.format(num)) and \
+                params.get('page') == '2':
+            return 500, {'message': 'Server Error'}, {}
+        return get(path, params)
+    monkeypatch.setattr(server, 'get', failing_get)
+
+    with pytest.raises(github3.models.GitHubError):
+        run_sync(server, repo_label, states)
+    assert db.get_sync_cursors(repo_label)[num] == cursor
+
+    monkeypatch.setattr(server, 'get', get)
+    run_sync(server, repo_label, states)
+    assert states[repo_label][num].approved_by == 'reviewer'
+    assert db.get_sync_cursors(repo_label)[num] != cursor